@@ -0,0 +1,92 @@
+"""
+Benchmark notebook context rendering on large notebooks
+
+Compares rendering every cell from scratch (the render cache cleared before
+each run) with the memoized path, where a chat turn only re-renders the
+cells that changed since the previous turn. Both request forms are measured:
+full notebook content, whose cells are hashed while rendering, and cells
+referenced from the saved notebook, which the server extension has already
+hashed (resolving them is part of the timed turn).
+
+Usage:
+    python benchmarks/bench_context.py [--cells 5000] [--changed 1] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from jupyterlab_ai_assistant.llm.context import build_chat_context, clear_render_cache  # noqa: E402
+from jupyterlab_ai_assistant.notebook import SavedNotebookIndex, resolve_notebook_cells  # noqa: E402
+
+
+def make_notebook(cells: int) -> dict:
+    """Build a notebook of code cells with outputs and a few markdown cells"""
+    notebook = []
+    for i in range(cells):
+        if i % 10 == 0:
+            notebook.append({"cell_type": "markdown", "source": f"## Section {i}\n\nNotes on step {i}."})
+            continue
+        notebook.append({
+            "cell_type": "code",
+            "source": "\n".join(f"value_{i}_{j} = compute({i}, {j})" for j in range(12)),
+            "outputs": [{"output_type": "stream", "text": f"step {i}: " + "ok " * 200}]
+        })
+    return {"cells": notebook}
+
+
+def change_cells(notebook: dict, count: int, turn: int) -> dict:
+    """Copy the notebook with the source of the last ``count`` cells edited"""
+    cells = list(notebook["cells"])
+    for i in range(len(cells) - count, len(cells)):
+        cells[i] = {**cells[i], "source": cells[i]["source"] + f"\n# edit {turn}"}
+    return {"cells": cells}
+
+
+def run(notebook: dict, changed: int, repeat: int, cached: bool, referenced: bool) -> float:
+    """Average seconds per chat turn"""
+    saved_cells = SavedNotebookIndex().put("bench.ipynb", 0, notebook)
+    hashes = list(saved_cells)
+
+    def turn_content(current: dict) -> dict:
+        if not referenced:
+            return current
+        # Unchanged cells by hash, edited cells inline, as sent by the frontend
+        references = [{"hash": h} for h in hashes[:len(hashes) - changed]]
+        references.extend(current["cells"][len(hashes) - changed:])
+        return resolve_notebook_cells(saved_cells, references)[0]
+
+    clear_render_cache()
+    build_chat_context(turn_content(notebook), [], "gemini-1.5-pro", 0)
+    total = 0.0
+    for turn in range(repeat):
+        current = change_cells(notebook, changed, turn)
+        if not cached:
+            clear_render_cache()
+        start = time.perf_counter()
+        build_chat_context(turn_content(current), [], "gemini-1.5-pro", 0)
+        total += time.perf_counter() - start
+    return total / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cells", type=int, default=5000, help="Cells in the notebook")
+    parser.add_argument("--changed", type=int, default=1, help="Cells edited between turns")
+    parser.add_argument("--repeat", type=int, default=20, help="Chat turns to average over")
+    args = parser.parse_args()
+
+    notebook = make_notebook(args.cells)
+    print(f"{args.cells} cells, {args.changed} changed per turn, {args.repeat} turns")
+    for label, referenced in (("full content", False), ("saved notebook references", True)):
+        uncached = run(notebook, args.changed, args.repeat, cached=False, referenced=referenced)
+        cached = run(notebook, args.changed, args.repeat, cached=True, referenced=referenced)
+        print(f"{label}:")
+        print(f"  uncached: {uncached * 1000:8.2f} ms/turn")
+        print(f"  cached:   {cached * 1000:8.2f} ms/turn")
+        print(f"  speedup:  {uncached / cached:8.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark the startup cost of the server extension and of each provider
+
+Imports the package as the Jupyter server does, in a fresh interpreter per
+run, and reports the import time and the peak resident memory. Then
+creates an instance of each provider in turn, which imports its SDK, to
+show what a provider costs on first use.
+
+Usage:
+    python benchmarks/bench_import.py [--repeat 5] [--providers ollama,openai,anthropic,gemini]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Run in a fresh interpreter, printing JSON measurements
+_PROBE = """
+import json, resource, sys, time
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+start = time.perf_counter()
+import jupyterlab_ai_assistant.handlers
+result = {"import": [time.perf_counter() - start, rss()]}
+
+from jupyterlab_ai_assistant.llm import get_llm_instance
+for llm_type in sys.argv[1:]:
+    start = time.perf_counter()
+    get_llm_instance(llm_type)
+    result[llm_type] = [time.perf_counter() - start, rss()]
+print(json.dumps(result))
+"""
+
+
+def probe(providers):
+    """Measure one fresh interpreter; returns {step: [seconds, peak MiB]}"""
+    env = {**os.environ, "PYTHONPATH": SRC + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", _PROBE, *providers],
+        env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to measure")
+    parser.add_argument("--providers", default="ollama,openai,anthropic,gemini",
+                        help="Providers to create after the import, in order")
+    args = parser.parse_args()
+
+    providers = [p for p in args.providers.split(",") if p]
+    runs = [probe(providers) for _ in range(args.repeat)]
+    print(f"{'step':<12} {'median ms':>10} {'peak RSS MiB':>13}")
+    for step in ["import", *providers]:
+        seconds = statistics.median(run[step][0] for run in runs)
+        peak = statistics.median(run[step][1] for run in runs)
+        print(f"{step:<12} {seconds * 1000:>10.0f} {peak:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Benchmark the server-side request pipeline against stored baselines
+
+Synthetic notebooks of increasing size are run through the steps a chat
+request takes before it reaches a provider:
+
+- ``json``: decoding the request body as the handlers do, and encoding it
+  again, with ``codec`` (orjson when installed)
+- ``context``: fitting the notebook into the prompt with ``build_chat_context``,
+  with the render cache cleared so every cell is formatted
+- ``messages``: building the system prompt and each provider's messages, as
+  ``BaseLLM._chat_request`` followed by the provider's conversion
+
+Each notebook profile stresses a different part of the cells: ``code`` has
+short outputs, ``outputs`` long stream outputs that get truncated,
+``images`` base64 PNG outputs that are parsed but never rendered, and
+``tracebacks`` long ANSI-coloured error tracebacks.
+
+Every case records the median and minimum time of its runs and the peak
+memory allocated by one run, measured separately with tracemalloc. Results
+are compared with ``baselines.json`` by minimum time, the figure least
+affected by other load on the machine, and by peak memory, which is exact;
+cases slower or larger than the threshold are flagged. Times on shared or
+single-core machines easily vary by a third between runs, so run on an
+idle machine or raise ``--threshold`` before trusting a time regression. Baselines are only meaningful on the machine that
+recorded them, so record new ones with ``--save`` before comparing changes.
+
+Usage:
+    python benchmarks/bench_pipeline.py [--filter context/] [--repeat 7] [--threshold 0.25]
+    python benchmarks/bench_pipeline.py --save    # record the current results as baselines
+    python benchmarks/bench_pipeline.py --check   # exit with status 1 on regressions
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from jupyterlab_ai_assistant import codec  # noqa: E402
+from jupyterlab_ai_assistant.llm.anthropic import AnthropicLLM  # noqa: E402
+from jupyterlab_ai_assistant.llm.context import build_chat_context, clear_render_cache  # noqa: E402
+from jupyterlab_ai_assistant.llm.gemini import GeminiLLM  # noqa: E402
+from jupyterlab_ai_assistant.llm.ollama import OllamaLLM  # noqa: E402
+from jupyterlab_ai_assistant.llm.openai import OpenAILLM  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# Cells per notebook size
+SIZES = {"small": 20, "medium": 200, "large": 2000}
+
+PROFILES = ("code", "outputs", "images", "tracebacks")
+
+# Shortest time of one timed sample
+MIN_SAMPLE_SECONDS = 0.05
+
+# Chat history sent along with every request
+HISTORY_TURNS = 40
+
+# A 64 KiB PNG, as a plot of a few hundred points would be
+_IMAGE = base64.b64encode(os.urandom(48 * 1024)).decode("ascii")
+
+_TRACEBACK = [
+    "\x1b[0;31m---------------------------------------------------------------------------\x1b[0m",
+    "\x1b[0;31mValueError\x1b[0m                                Traceback (most recent call last)",
+] + [
+    f"File \x1b[0;32m/opt/conda/lib/python3.11/site-packages/pandas/core/frame.py:{line}\x1b[0m, in "
+    f"\x1b[0;36mDataFrame.__getitem__\x1b[0;34m(self, key)\x1b[0m\n"
+    f"\x1b[1;32m   {line - 1}\x1b[0m     indexer = self.columns.get_loc(key)\n"
+    f"\x1b[0;32m-> {line}\x1b[0m     return self._get_item_cache(key)"
+    for line in range(3000, 3060)
+] + ["\x1b[0;31mValueError\x1b[0m: cannot reindex on an axis with duplicate labels"]
+
+
+def make_cell(profile: str, i: int) -> Dict[str, Any]:
+    """Build the ``i``-th cell of a notebook of the given profile"""
+    if i % 10 == 0:
+        return {"cell_type": "markdown", "source": f"## Step {i}\n\nLoad and clean the data for step {i}."}
+
+    source = "\n".join(f"frame_{i}_{j} = frame.groupby('key_{j}').agg({{'value': 'mean'}})" for j in range(8))
+    outputs: List[Dict[str, Any]] = [{"output_type": "stream", "name": "stdout", "text": f"step {i} done\n"}]
+    if profile == "outputs":
+        outputs = [{"output_type": "stream", "name": "stdout",
+                    "text": "".join(f"row {r}: {r * i % 977:>6} {'x' * 40}\n" for r in range(400))}]
+    elif profile == "images" and i % 3 == 0:
+        outputs.append({
+            "output_type": "display_data",
+            "data": {"image/png": _IMAGE, "text/plain": "<Figure size 640x480 with 1 Axes>"},
+            "metadata": {}
+        })
+    elif profile == "tracebacks" and i % 4 == 0:
+        outputs = [{"output_type": "error", "ename": "ValueError",
+                    "evalue": "cannot reindex on an axis with duplicate labels", "traceback": _TRACEBACK}]
+    return {"cell_type": "code", "source": source, "outputs": outputs}
+
+
+def make_notebook(profile: str, cells: int) -> Dict[str, Any]:
+    """Build a notebook of the given profile, the last cell active"""
+    return {"cells": [make_cell(profile, i) for i in range(cells)], "active_cell_index": cells - 1}
+
+
+def make_history(turns: int) -> List[Dict[str, Any]]:
+    """Build a chat history of alternating user and assistant messages"""
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"Why does step {i} print a warning about dtypes?"})
+        history.append({"role": "assistant", "content": "The column mixes strings and numbers. " * 20})
+    return history
+
+
+def _request_body(notebook: Dict[str, Any], history: List[Dict[str, Any]]) -> bytes:
+    """Body of a chat request as the frontend sends it"""
+    return json.dumps({
+        "llm_type": "openai", "model": "gpt-4o", "prompt": "Why is the last cell slow?",
+        "messages": history, "notebook_content": notebook
+    }).encode("utf-8")
+
+
+def _providers() -> Dict[str, Tuple[Any, Callable[[Any, str, List[Dict[str, Any]]], Any]]]:
+    """Providers by name, with the conversion of a conversation to their request format"""
+    return {
+        "openai": (OpenAILLM("gpt-4o"), lambda llm, system, msgs: llm._openai_messages(system, msgs)),
+        "anthropic": (AnthropicLLM("claude-3-5-sonnet-20241022"),
+                      lambda llm, system, msgs: (llm._claude_system(system), llm._claude_messages(msgs))),
+        "gemini": (GeminiLLM("gemini-1.5-pro"), lambda llm, system, msgs: llm._gemini_contents(system, msgs)),
+        "ollama": (OllamaLLM("llama3"), lambda llm, system, msgs: llm._ollama_messages(system, msgs)),
+    }
+
+
+def cases() -> Dict[str, Callable[[], Any]]:
+    """
+    Build the benchmark cases
+
+    Returns:
+        Mapping of case name to a callable doing one run
+    """
+    history = make_history(HISTORY_TURNS)
+    providers = _providers()
+    result: Dict[str, Callable[[], Any]] = {}
+
+    for profile in PROFILES:
+        for size, cells in SIZES.items():
+            notebook = make_notebook(profile, cells)
+            body = _request_body(notebook, history)
+            data = json.loads(body)
+            result[f"json/decode/{profile}/{size}"] = lambda body=body: codec.loads(body)
+            result[f"json/encode/{profile}/{size}"] = lambda data=data: codec.dumps(data)
+
+            def context(notebook=notebook):
+                clear_render_cache()
+                return build_chat_context(notebook, history, "gpt-4o", 4096)
+
+            result[f"context/{profile}/{size}"] = context
+
+    # Provider message building on a notebook that fills the larger windows
+    notebook = make_notebook("outputs", SIZES["medium"])
+    for name, (llm, convert) in providers.items():
+        def messages(llm=llm, convert=convert):
+            clear_render_cache()
+            system, chat_messages, _ = llm._chat_request("Why is the last cell slow?", history, notebook)
+            return convert(llm, system, chat_messages)
+
+        result[f"messages/{name}/medium"] = messages
+    # Grouped by step, in order of size within each group
+    return dict(sorted(result.items(), key=lambda item: item[0].split("/")[0]))
+
+
+def _time(run: Callable[[], Any], repeat: int) -> Tuple[float, float]:
+    """
+    Time a callable
+
+    Returns:
+        Tuple of the median and minimum seconds of one run
+    """
+    start = time.perf_counter()
+    run()
+    number = max(1, int(MIN_SAMPLE_SECONDS / max(time.perf_counter() - start, 1e-6)))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        times.append((time.perf_counter() - start) / number)
+    return statistics.median(times), min(times)
+
+
+def measure(run: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """
+    Time a case and measure its peak memory
+
+    Fast cases are run several times per sample, so that each sample takes
+    at least ``MIN_SAMPLE_SECONDS`` and timer noise stays small.
+
+    Args:
+        run: Callable doing one run of the case
+        repeat: Timed samples, after one warm-up run
+
+    Returns:
+        ``median_ms``, ``min_ms`` and ``peak_kib`` of one run of the case
+    """
+    median, fastest = _time(run, repeat)
+
+    # Separately, since tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "median_ms": round(median * 1000, 3),
+        "min_ms": round(fastest * 1000, 3),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def _change(current: float, baseline: float) -> float:
+    """Relative change from a baseline"""
+    return (current - baseline) / baseline if baseline else 0.0
+
+
+def report(results: Dict[str, Dict[str, float]], baselines: Dict[str, Dict[str, float]],
+           threshold: float) -> List[str]:
+    """
+    Print results next to their baselines
+
+    Args:
+        results: Measurements by case
+        baselines: Stored measurements by case
+        threshold: Relative increase of time or memory flagged as a regression
+
+    Returns:
+        Names of the cases that regressed
+    """
+    regressions = []
+    print(f"{'case':<34} {'min ms':>10} {'baseline':>10} {'change':>8}   "
+          f"{'peak KiB':>10} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:<34} {result['min_ms']:>10.3f} {'-':>10} {'new':>8}   "
+                  f"{result['peak_kib']:>10.1f} {'-':>10} {'new':>8}")
+            continue
+
+        # The fastest run is the one least disturbed by other processes
+        time_change = _change(result["min_ms"], baseline["min_ms"])
+        memory_change = _change(result["peak_kib"], baseline["peak_kib"])
+        regressed = time_change > threshold or memory_change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<34} {result['min_ms']:>10.3f} {baseline['min_ms']:>10.3f} {time_change:>+8.1%}   "
+              f"{result['peak_kib']:>10.1f} {baseline['peak_kib']:>10.1f} {memory_change:>+8.1%}"
+              f"{'   REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed samples per case")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Relative slowdown or memory growth reported as a regression")
+    parser.add_argument("--baselines", default=BASELINES, help="Baselines file")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if any case regressed")
+    args = parser.parse_args()
+
+    stored: Dict[str, Any] = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+    baselines = stored.get("cases", {})
+    if stored:
+        print(f"Baselines recorded on {stored.get('machine')} with Python {stored.get('python')}")
+
+    results = {}
+    for name, run in cases().items():
+        if args.filter in name:
+            results[name] = measure(run, args.repeat)
+    regressions = report(results, baselines, args.threshold)
+
+    if args.save:
+        # Keep the baselines of cases that were filtered out
+        stored = {
+            "machine": platform.machine() + " " + platform.system(),
+            "python": platform.python_version(),
+            "cases": {**baselines, **results},
+        }
+        with open(args.baselines, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved {len(results)} baselines to {args.baselines}")
+    elif regressions:
+        print(f"{len(regressions)} of {len(results)} cases regressed by more than {args.threshold:.0%}")
+        if args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import json
 import logging
 
@@ -7,12 +8,189 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# LLM handlers
+from src.jupyterlab_ai_assistant import codec, metrics, service
+from src.jupyterlab_ai_assistant.admission import AdmissionRejected
+from src.jupyterlab_ai_assistant.catalog import CATALOG_FIRST_WAIT, model_catalog
+from src.jupyterlab_ai_assistant.conversations import UnknownConversation, request_max_history
+from src.jupyterlab_ai_assistant.llm import get_llm_instance
+from src.jupyterlab_ai_assistant.streaming import SSE_HEADERS, sse_event
+from src.jupyterlab_ai_assistant.jobs import JobLimitExceeded, get_job_manager
+from src.jupyterlab_ai_assistant.fallback import fallback_chain, race_stages, request_deadline, run_with_fallback
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """Flask JSON using the fast codec of the server extension"""
+
+    def dumps(self, obj, **kwargs):
+        """Serialize compactly; indentation and key sorting are not supported"""
+        return codec.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return codec.loads(s)
+
+
 # Create Flask app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "jupyterlab_ai_assistant_secret")
+app.json = CodecJSONProvider(app)
 
-# LLM handlers
-from src.jupyterlab_ai_assistant.llm import get_llm_instance
+
+# ``endpoint`` metrics labels of the LLM routes
+METRICS_ENDPOINTS = {
+    "/ai-assistant/llm": "chat",
+    "/ai-assistant/fix-error": "fix",
+    "/ai-assistant/fix-errors": "fix_batch",
+}
+
+
+def stream_with_fallback(chain, start_stream, field, note, endpoint, deadline=None,
+                         timed_out=None, on_done=None):
+    """
+    Stream events from the fallback chain as ``race_stages`` runs it: the
+    first LLM to produce output wins, and slow or failing LLMs are hedged
+    or replaced by the next one within the deadline.
+
+    Args:
+        chain: Stages from ``fallback_chain``
+        start_stream: Callable taking (llm_type, model) and returning an event iterator
+        field: Name of the result field in the final event ("content" or "fixed_code")
+        note: Callable taking the fallback provider name and returning the
+            text put in front of its output
+        endpoint: Kind of request, for the fallback metrics
+        deadline: Seconds until the request gives up, None for no limit
+        timed_out: Fields of the final event sent if the deadline passes
+        on_done: Called with the final event of the winning LLM before it is sent
+
+    Yields:
+        Server-Sent Events messages
+
+    Raises:
+        AdmissionRejected: If every LLM in the chain was saturated
+    """
+    requested = chain[0][0]
+    events = race_stages(chain, start_stream, deadline)
+    try:
+        prefix = None
+        for stage, event in events:
+            if event is None:
+                yield sse_event({"type": "done", **timed_out})
+                return
+            if prefix is None:
+                prefix = note(get_llm_instance(*stage).provider_name) if stage != chain[0] else ""
+                if prefix and event["type"] == "delta":
+                    yield sse_event({"type": "delta", "content": prefix})
+            if event["type"] == "done":
+                if stage != chain[0] and not event.get("error"):
+                    metrics.FALLBACKS.labels(requested, stage[0], endpoint).inc()
+                    event = {**event, field: prefix + event.get(field, "")}
+                if on_done is not None:
+                    on_done(event)
+            yield sse_event(event)
+    finally:
+        events.close()
+
+
+def event_stream(events):
+    """
+    Wrap Server-Sent Events messages in a streaming Flask response
+
+    The first message is produced before the response starts, so that a
+    request rejected by admission control is still answered with 429.
+    """
+    first = next(events, None)
+
+    def messages():
+        # Streamed responses have no length for ``record_payload``, so count here
+        size = 0
+        try:
+            if first is not None:
+                size += len(first)
+                yield first
+            for message in events:
+                size += len(message)
+                yield message
+        finally:
+            endpoint = METRICS_ENDPOINTS.get(request.path)
+            if endpoint:
+                metrics.PAYLOAD_BYTES.labels(endpoint, "response").observe(size)
+
+    return Response(stream_with_context(messages()), headers=SSE_HEADERS)
+
+
+def rejected(error):
+    """Answer 429 Too Many Requests because a provider is saturated"""
+    response = jsonify({"message": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+
+def request_data():
+    """
+    Parse the JSON body of a request, which may be gzip or zstd compressed
+
+    Raises:
+        codec.BodyError: If the body cannot be decoded, answered by ``invalid_body``
+    """
+    body = codec.decode_body(request.get_data(), request.headers.get("Content-Encoding"))
+    try:
+        return codec.loads(body)
+    except ValueError:
+        raise codec.BodyError("Invalid JSON in body of request")
+
+
+@app.errorhandler(codec.BodyError)
+def invalid_body(error):
+    return jsonify({"message": str(error)}), error.status
+
+
+def request_user():
+    """Tell users apart for admission control; the Flask app has no accounts, so by client address"""
+    return request.remote_addr
+
+
+def submit_job(user, endpoint, start):
+    """
+    Run a request as a background job, answering 202 Accepted with its id
+
+    Jobs are meant for long generations, so they stay with the requested
+    provider instead of falling back to another one.
+
+    Args:
+        user: Who submits the job
+        endpoint: Kind of request, for the metrics
+        start: Starts the request and returns its events; called on a job worker
+    """
+    try:
+        job = get_job_manager().submit(user, endpoint, start)
+    except JobLimitExceeded as e:
+        return jsonify({"message": str(e)}), 429
+    response = jsonify(job)
+    response.headers["Location"] = f"/ai-assistant/jobs/{job['job_id']}"
+    return response, 202
+
+@app.after_request
+def record_payload(response):
+    """Record the sizes of LLM request and response bodies"""
+    endpoint = METRICS_ENDPOINTS.get(request.path)
+    if endpoint:
+        metrics.PAYLOAD_BYTES.labels(endpoint, "request").observe(request.content_length or 0)
+        if not response.is_streamed:
+            metrics.PAYLOAD_BYTES.labels(endpoint, "response").observe(response.content_length or 0)
+    return response
+
+# Registered after record_payload so that it runs first, and the compressed size is recorded
+@app.after_request
+def compress_response(response):
+    """Compress large responses for clients that accept it; streams stay uncompressed to flush each event"""
+    if response.is_streamed or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+    body, encoding = codec.compress(response.get_data(), request.headers.get("Accept-Encoding"))
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 @app.route('/')
 def index():
@@ -20,57 +198,13 @@ def index():
 
 @app.route('/ai-assistant/config', methods=['GET'])
 def get_llm_config():
-    """Return LLM configuration"""
+    """Return the models of every provider from the model catalog, or 304 if the client's copy is current"""
     try:
-        # Get available LLM configurations
-        available_models = [
-            {
-                "id": "openai",
-                "name": "OpenAI",
-                "models": [
-                    {"id": "gpt-4o", "name": "GPT-4o"},
-                    {"id": "gpt-4-turbo", "name": "GPT-4 Turbo"},
-                    {"id": "gpt-3.5-turbo", "name": "GPT-3.5 Turbo"}
-                ],
-                "defaultModel": "gpt-4o",
-                "local": False
-            },
-            {
-                "id": "anthropic",
-                "name": "Anthropic",
-                "models": [
-                    {"id": "claude-3-5-sonnet-20241022", "name": "Claude 3.5 Sonnet"},
-                    {"id": "claude-3-opus-20240229", "name": "Claude 3 Opus"},
-                    {"id": "claude-3-sonnet-20240229", "name": "Claude 3 Sonnet"},
-                    {"id": "claude-3-haiku-20240307", "name": "Claude 3 Haiku"}
-                ],
-                "defaultModel": "claude-3-5-sonnet-20241022",
-                "local": False
-            },
-            {
-                "id": "gemini",
-                "name": "Google Gemini",
-                "models": [
-                    {"id": "gemini-pro", "name": "Gemini Pro"},
-                    {"id": "gemini-ultra", "name": "Gemini Ultra"}
-                ],
-                "defaultModel": "gemini-pro",
-                "local": False
-            },
-            {
-                "id": "ollama",
-                "name": "Ollama (Local)",
-                "models": [
-                    {"id": "llama3", "name": "Llama 3"},
-                    {"id": "mistral", "name": "Mistral"},
-                    {"id": "codellama", "name": "Code Llama"}
-                ],
-                "defaultModel": "llama3",
-                "local": True
-            }
-        ]
-        
-        return jsonify({"available_models": available_models})
+        body, etag = model_catalog.snapshot(wait=CATALOG_FIRST_WAIT)
+        response = app.response_class(body, mimetype="application/json")
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Error getting LLM config: {e}")
         return jsonify({"error": str(e)}), 500
@@ -78,35 +212,88 @@ def get_llm_config():
 @app.route('/ai-assistant/llm', methods=['POST'])
 def llm_request():
     """Handle LLM request"""
+    data = request_data()
+    deadline = request_deadline(data)
+    max_history = request_max_history(data)
     try:
-        data = request.json
-        
         llm_type = data.get("llm_type", "openai")
         prompt = data.get("prompt", "")
         messages = data.get("messages", [])
         notebook_content = data.get("notebook_content", {})
+        model = data.get("model")
+        use_cache = not data.get("no_cache", False)
+        
+        user = request_user()
+        
+        # With a conversation id the server keeps the history, and the
+        # client sends its messages only if the server does not have them
+        conversation_id = data.get("conversation_id")
+        if conversation_id:
+            try:
+                messages = service.conversation_history(user, conversation_id, data.get("messages"), max_history)
+            except UnknownConversation:
+                return jsonify({
+                    "message": "Unknown conversation, send its messages instead",
+                    "unknown_conversation": True
+                }), 404
         
         logger.debug(f"LLM request: {llm_type}, prompt: {prompt[:50]}...")
         
-        # Get LLM instance
-        llm = get_llm_instance(llm_type)
+        chain = fallback_chain(llm_type, model, data.get("fallback"))
+        
+        def start_stream(stage_type, stage_model):
+            return service.stream_response(
+                stage_type, stage_model, prompt, messages, notebook_content, use_cache, user
+            )
         
-        # Generate response
-        result = llm.generate_response(prompt, messages, notebook_content)
+        def start_job():
+            events = start_stream(llm_type, model)
+            if not conversation_id:
+                return events
+            return service.record_stream(events, llm_type, model, user, conversation_id, prompt, max_history)
         
-        # Check if there was an error with the primary LLM and fallback to OpenAI if needed
-        if llm_type != "openai" and result.get("error", False):
-            logger.info(f"Primary LLM {llm_type} failed, falling back to OpenAI")
-            fallback_llm = get_llm_instance("openai")
-            fallback_result = fallback_llm.generate_response(prompt, messages, notebook_content)
+        if data.get("job"):
+            return submit_job(user, "chat", start_job)
+        
+        timed_out = {
+            "content": f"Error: No response within the {deadline:.1f}s deadline" if deadline else "",
+            "has_code": False,
+            "error": True
+        }
+        
+        if data.get("stream"):
+            def record(event):
+                if conversation_id:
+                    service.record_turn(llm_type, model, user, conversation_id, prompt, event, max_history)
             
-            # If the fallback was successful, use it but add a note about the fallback
-            if not fallback_result.get("error", False):
-                fallback_content = fallback_result.get("content", "")
-                fallback_result["content"] = f"[Note: Using OpenAI as fallback due to issues with {llm_type}]\n\n{fallback_content}"
-                return jsonify(fallback_result)
+            return event_stream(stream_with_fallback(
+                chain,
+                start_stream,
+                "content",
+                lambda provider: f"[Note: Using {provider} as fallback due to issues with {llm_type}]\n\n",
+                "chat",
+                deadline,
+                timed_out,
+                record
+            ))
+        
+        # Try the requested LLM first, falling back along the chain within the deadline
+        stage, result = run_with_fallback(chain, start_stream, deadline=deadline)
+        
+        if result is None:
+            return jsonify(timed_out), 504
+        
+        if conversation_id:
+            service.record_turn(llm_type, model, user, conversation_id, prompt, result, max_history)
+        
+        # If a fallback was used, add a note about it
+        if stage != chain[0] and not result.get("error", False):
+            metrics.FALLBACKS.labels(llm_type, stage[0], "chat").inc()
+            result["content"] = f"[Note: Using {result['provider']} as fallback due to issues with {llm_type}]\n\n{result['content']}"
         
         return jsonify(result)
+    except AdmissionRejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error handling LLM request: {e}")
         return jsonify({"error": str(e)}), 500
@@ -114,35 +301,128 @@ def llm_request():
 @app.route('/ai-assistant/fix-error', methods=['POST'])
 def fix_error():
     """Handle error fixing request"""
+    data = request_data()
+    deadline = request_deadline(data)
     try:
-        data = request.json
-        
         llm_type = data.get("llm_type", "openai")
         code = data.get("code", "")
         errors = data.get("errors", [])
+        model = data.get("model")
+        use_cache = not data.get("no_cache", False)
+        
+        user = request_user()
         
         logger.debug(f"Error fix request: {llm_type}, code length: {len(code)}")
         
-        # Get LLM instance
-        llm = get_llm_instance(llm_type)
+        if data.get("job"):
+            return submit_job(user, "fix", lambda: service.stream_fix_errors(
+                llm_type, model, code, errors, use_cache, user
+            ))
         
-        # Fix errors
-        fixed_code = llm.fix_errors(code, errors)
+        chain = fallback_chain(llm_type, model, data.get("fallback"))
         
-        # Check if there was an error message returned (error messages start with # Error:)
-        if llm_type != "openai" and fixed_code.startswith("# Error:"):
-            logger.info(f"Primary LLM {llm_type} error fixing failed, falling back to OpenAI")
-            fallback_llm = get_llm_instance("openai")
-            fallback_fixed_code = fallback_llm.fix_errors(code, errors)
-            
-            # If the fallback was successful, use it but add a note about the fallback
-            if not fallback_fixed_code.startswith("# Error:"):
-                return jsonify({"fixed_code": f"# Note: Using OpenAI as fallback due to issues with {llm_type}\n{fallback_fixed_code}"})
+        def start_stream(stage_type, stage_model):
+            return service.stream_fix_errors(stage_type, stage_model, code, errors, use_cache, user)
+        
+        timed_out = {
+            "fixed_code": f"# Error: No fix within the {deadline:.1f}s deadline\n{code}" if deadline else code,
+            "error": True
+        }
+        
+        if data.get("stream"):
+            return event_stream(stream_with_fallback(
+                chain,
+                start_stream,
+                "fixed_code",
+                lambda provider: f"# Note: Using {provider} as fallback due to issues with {llm_type}\n",
+                "fix",
+                deadline,
+                timed_out
+            ))
+        
+        # Try the requested LLM first, falling back along the chain within the deadline
+        stage, result = run_with_fallback(chain, start_stream, deadline=deadline)
+        
+        if result is None:
+            return jsonify(timed_out), 504
+        
+        # If a fallback was used, add a note about it
+        if stage != chain[0] and not result.get("error", False):
+            metrics.FALLBACKS.labels(llm_type, stage[0], "fix").inc()
+            result["fixed_code"] = f"# Note: Using {result['provider']} as fallback due to issues with {llm_type}\n{result['fixed_code']}"
         
-        return jsonify({"fixed_code": fixed_code})
+        return jsonify(result)
+    except AdmissionRejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error fixing code: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/ai-assistant/fix-errors', methods=['POST'])
+def fix_errors_batch():
+    """Handle a request to fix the errors of many cells at once"""
+    data = request_data()
+    try:
+        llm_type = data.get("llm_type", "openai")
+        items = data.get("items", [])
+        model = data.get("model")
+        use_cache = not data.get("no_cache", False)
+        
+        logger.debug(f"Batch error fix request: {llm_type}, {len(items)} cells")
+        
+        # No fallback chain here: each fix already runs in the request executor
+        events = service.fix_errors_batch(llm_type, model, items, use_cache, user=request_user())
+        if data.get("stream"):
+            return event_stream(sse_event(event) for event in events)
+        
+        return jsonify({"results": [event for event in events if event["type"] == "result"]})
     except Exception as e:
         logger.error(f"Error fixing code: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/ai-assistant/speculate-fix', methods=['POST'])
+def speculate_fix():
+    """Start fixing the errors of a cell that just failed, so the fix is ready when asked for"""
+    data = request_data()
+    try:
+        status = service.speculate_fix(
+            data.get("llm_type", "openai"), data.get("model"), data.get("code", ""),
+            data.get("errors", []), request_user()
+        )
+        return jsonify({"status": status}), 202
+    except Exception as e:
+        logger.error(f"Error starting a speculative fix: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/ai-assistant/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return the progress of a job past ``offset``, waiting up to ``wait`` seconds for some, or follow it with ``stream``"""
+    try:
+        offset = max(0, int(request.args.get("offset", "0")))
+        wait = float(request.args.get("wait", "0"))
+    except ValueError:
+        return jsonify({"message": "offset and wait must be numbers"}), 400
+    jobs = get_job_manager()
+    if request.args.get("stream") or "text/event-stream" in request.headers.get("Accept", ""):
+        return event_stream(sse_event(event) for event in jobs.events(request_user(), job_id, offset))
+    
+    job = jobs.wait(request_user(), job_id, offset, wait)
+    if job is None:
+        return jsonify({"message": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/ai-assistant/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job"""
+    job = get_job_manager().cancel(request_user(), job_id)
+    if job is None:
+        return jsonify({"message": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/ai-assistant/metrics', methods=['GET'])
+def get_metrics():
+    """Return the assistant's metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -1,15 +1,16 @@
 import React, { useState, useEffect, useRef } from 'react';
 import ReactDOM from 'react-dom';
 import { ReactWidget } from '@jupyterlab/apputils';
-import { INotebookTracker, NotebookPanel } from '@jupyterlab/notebook';
+import { INotebookTracker, NotebookActions, NotebookPanel } from '@jupyterlab/notebook';
 import { ISettingRegistry } from '@jupyterlab/settingregistry';
 import { IThemeManager } from '@jupyterlab/apputils';
 import { CommandRegistry } from '@lumino/commands';
 import { Message } from './Message';
 import { ErrorFixer } from './ErrorFixer';
 import { SettingsPanel } from './SettingsPanel';
-import { requestAPI } from '../services/LLMService';
-import { extractNotebookContent, extractErrorsFromOutputs } from '../services/NotebookService';
+import { APIError, StreamEvent, requestAPI, streamAPI } from '../services/LLMService';
+import { AssistantSocket } from '../services/AssistantSocket';
+import { extractErrorsFromOutputs, withNotebookContext } from '../services/NotebookService';
 
 interface ChatMessage {
   id: string;
@@ -28,6 +29,7 @@ interface LLMConfig {
   models: Array<{id: string, name: string}>;
   defaultModel: string;
   local?: boolean;
+  auto?: boolean;
 }
 
 interface ChatPanelProps {
@@ -60,6 +62,16 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
     anthropic: '',
     gemini: ''
   });
+  const [maxHistoryLength, setMaxHistoryLength] = useState(10);
+  const [speculativeFixes, setSpeculativeFixes] = useState(true);
+  
+  // The server keeps the history of this conversation, once it has been sent
+  const conversationId = useRef(`${Date.now()}-${Math.random().toString(36).slice(2)}`);
+  const conversationSynced = useRef(false);
+  
+  // Chat requests go over one WebSocket, so that they can be stopped
+  const socket = useRef<AssistantSocket | null>(null);
+  const abortController = useRef<AbortController | null>(null);
   
   const chatRef = useRef<HTMLDivElement>(null);
   const textareaRef = useRef<HTMLTextAreaElement>(null);
@@ -69,6 +81,15 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
     fetchLLMConfig();
   }, []);
   
+  // Closing the panel cancels the requests still running
+  useEffect(() => {
+    socket.current = new AssistantSocket();
+    return () => {
+      socket.current?.dispose();
+      socket.current = null;
+    };
+  }, []);
+  
   // Scroll to bottom when messages change
   useEffect(() => {
     if (chatRef.current) {
@@ -95,6 +116,16 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
           if (savedSelectedLLM) {
             setSelectedLLM(savedSelectedLLM);
           }
+          
+          const savedMaxHistoryLength = settings.get('maxHistoryLength').composite as number;
+          if (typeof savedMaxHistoryLength === 'number') {
+            setMaxHistoryLength(savedMaxHistoryLength);
+          }
+          
+          const savedSpeculativeFixes = settings.get('speculativeFixes').composite as boolean;
+          if (typeof savedSpeculativeFixes === 'boolean') {
+            setSpeculativeFixes(savedSpeculativeFixes);
+          }
         })
         .catch(error => {
           console.error('Failed to load settings:', error);
@@ -102,6 +133,36 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
     }
   }, [settingRegistry]);
   
+  // Start fixing a cell as soon as it fails, so the fix is ready when asked for
+  useEffect(() => {
+    if (!speculativeFixes) {
+      return;
+    }
+    
+    const onExecuted: Parameters<typeof NotebookActions.executed.connect>[0] = (_, { notebook, cell }) => {
+      const cellIndex = notebook.widgets.indexOf(cell);
+      const error = extractErrorsFromOutputs(notebook).find(error => error.cellIndex === cellIndex);
+      if (!error) {
+        return;
+      }
+      // Same fields as fixError, so that its request finds this fix
+      requestAPI('speculate-fix', {
+        method: 'POST',
+        body: JSON.stringify({
+          llm_type: selectedLLM,
+          model: selectedModels[selectedLLM],
+          errors: [{ message: error.message }],
+          code: error.code
+        })
+      }).catch(reason => console.debug('Could not prepare a fix:', reason));
+    };
+    
+    NotebookActions.executed.connect(onExecuted);
+    return () => {
+      NotebookActions.executed.disconnect(onExecuted);
+    };
+  }, [speculativeFixes, selectedLLM, selectedModels]);
+  
   // Save settings when they change
   useEffect(() => {
     if (settingRegistry) {
@@ -137,43 +198,82 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
     setInput('');
     setLoading(true);
     
-    // Get current notebook content
-    const notebookContent = notebookTracker.currentWidget 
-      ? extractNotebookContent(notebookTracker.currentWidget.content)
-      : {};
+    const assistantId = `assistant-${Date.now()}`;
+    let streamed = '';
+    const controller = new AbortController();
+    abortController.current = controller;
     
     try {
-      const response = await requestAPI<ChatMessage>('llm', {
-        method: 'POST',
-        body: JSON.stringify({
-          llm_type: selectedLLM,
-          prompt: input,
-          messages: messages.map(({ role, content }) => ({ role, content })),
-          notebook_content: notebookContent
-        })
-      });
+      // Send the current notebook, by reference to its saved copy when possible,
+      // and the history only if the server does not have it yet
+      const send = (withHistory: boolean) => withNotebookContext(notebookTracker.currentWidget, notebookFields => (socket.current as AssistantSocket).request('chat', {
+        llm_type: selectedLLM,
+        model: selectedModels[selectedLLM],
+        prompt: input,
+        conversation_id: conversationId.current,
+        max_history: maxHistoryLength,
+        ...(withHistory ? { messages: messages.map(({ role, content }) => ({ role, content })) } : {}),
+        ...notebookFields
+      }, event => {
+        if (event.type !== 'delta') {
+          return;
+        }
+        // Render the answer while it is being generated
+        streamed += event.content || '';
+        const partialMessage: ChatMessage = {
+          id: assistantId,
+          role: 'assistant',
+          content: streamed,
+          timestamp: new Date(),
+          hasCode: streamed.includes('```')
+        };
+        setMessages(prevMessages => [
+          ...prevMessages.filter(message => message.id !== assistantId),
+          partialMessage
+        ]);
+      }, controller.signal));
+      
+      let response: StreamEvent;
+      try {
+        response = await send(!conversationSynced.current);
+      } catch (error) {
+        // The server dropped the conversation, e.g. after a restart
+        if (error instanceof APIError && error.status === 404 && error.data.unknown_conversation) {
+          response = await send(true);
+        } else {
+          throw error;
+        }
+      }
+      conversationSynced.current = true;
       
       if (response) {
         const assistantMessage: ChatMessage = {
-          id: `assistant-${Date.now()}`,
+          id: assistantId,
           role: 'assistant',
-          content: response.content,
+          content: response.content || '',
           timestamp: new Date(),
-          hasCode: response.hasCode || false,
+          hasCode: response.has_code || false,
           model: response.model,
           provider: response.provider,
           error: response.error
         };
         
-        setMessages(prevMessages => [...prevMessages, assistantMessage]);
+        setMessages(prevMessages => [
+          ...prevMessages.filter(message => message.id !== assistantId),
+          assistantMessage
+        ]);
       }
     } catch (error) {
+      // Stopped by the user, the answer so far stays in the chat
+      if (controller.signal.aborted) {
+        return;
+      }
       console.error('Error sending message:', error);
       
       const errorMessage: ChatMessage = {
         id: `error-${Date.now()}`,
         role: 'assistant',
-        content: `Error: Failed to get response from ${selectedLLM}. Please check your API keys and connection.`,
+        content: failureMessage(error, `Error: Failed to get response from ${selectedLLM}. Please check your API keys and connection.`),
         timestamp: new Date(),
         hasCode: false,
         error: true
@@ -181,10 +281,15 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
       
       setMessages(prevMessages => [...prevMessages, errorMessage]);
     } finally {
+      abortController.current = null;
       setLoading(false);
     }
   };
   
+  const stopGeneration = () => {
+    abortController.current?.abort();
+  };
+  
   const handleKeyDown = (e: React.KeyboardEvent) => {
     if (e.key === 'Enter' && !e.shiftKey) {
       e.preventDefault();
@@ -260,48 +365,89 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
     // Add a system message about fixing all errors
     addSystemMessage(`Found ${errors.length} errors in the notebook. Trying to fix them...`);
     
-    // Request error fixes for each error
-    errors.forEach(error => {
-      fixError(error);
-    });
+    // Fix all cells in one request, showing each fix as soon as it is ready
+    fixErrorsBatch(errors);
   };
   
-  const fixError = async (error: { cellIndex: number, message: string, code: string }) => {
+  const addFixMessage = (
+    cellIndex: number,
+    response: { fixed_code: string, model?: string, provider?: string }
+  ) => {
+    const assistantMessage: ChatMessage = {
+      id: `assistant-${Date.now()}-${cellIndex}`,
+      role: 'assistant',
+      content: `I've fixed the error in cell ${cellIndex + 1}:\n\n\`\`\`python\n${response.fixed_code}\n\`\`\``,
+      timestamp: new Date(),
+      hasCode: true,
+      model: response.model || selectedModels[selectedLLM],
+      provider: response.provider || getLLMProviderName(selectedLLM)
+    };
+    
+    setMessages(prevMessages => [...prevMessages, assistantMessage]);
+  };
+  
+  const fixErrorsBatch = async (errors: { cellIndex: number, message: string, code: string }[]) => {
     setLoading(true);
     
     try {
-      const response = await requestAPI<{ fixed_code: string }>('fix-error', {
-        method: 'POST',
-        body: JSON.stringify({
-          llm_type: selectedLLM,
-          errors: [{ message: error.message }],
-          code: error.code
-        })
+      await streamAPI('fix-errors', {
+        llm_type: selectedLLM,
+        model: selectedModels[selectedLLM],
+        items: errors.map(error => ({
+          cell_index: error.cellIndex,
+          code: error.code,
+          errors: [{ message: error.message }]
+        }))
+      }, event => {
+        if (event.type === 'result' && event.fixed_code) {
+          addFixMessage(event.cell_index, event as any);
+        }
       });
+    } catch (error) {
+      console.error('Error fixing code:', error);
       
-      if (response && response.fixed_code) {
-        const assistantMessage: ChatMessage = {
-          id: `assistant-${Date.now()}`,
-          role: 'assistant',
-          content: `I've fixed the error in cell ${error.cellIndex + 1}:\n\n\`\`\`python\n${response.fixed_code}\n\`\`\``,
-          timestamp: new Date(),
-          hasCode: true,
-          model: selectedModels[selectedLLM],
-          provider: getLLMProviderName(selectedLLM)
-        };
-        
-        setMessages(prevMessages => [...prevMessages, assistantMessage]);
-        
-        // Show the error fixer UI
+      const errorMessage: ChatMessage = {
+        id: `error-${Date.now()}`,
+        role: 'assistant',
+        content: failureMessage(error, `Error: Failed to fix the code. Please try again.`),
+        timestamp: new Date(),
+        hasCode: false,
+        error: true
+      };
+      
+      setMessages(prevMessages => [...prevMessages, errorMessage]);
+    } finally {
+      setLoading(false);
+    }
+  };
+  
+  const fixError = async (error: { cellIndex: number, message: string, code: string }) => {
+    setLoading(true);
+    const controller = new AbortController();
+    abortController.current = controller;
+    
+    try {
+      const response = await (socket.current as AssistantSocket).request('fix', {
+        llm_type: selectedLLM,
+        model: selectedModels[selectedLLM],
+        errors: [{ message: error.message }],
+        code: error.code
+      }, () => undefined, controller.signal);
+      
+      if (response && response.fixed_code && !response.error) {
         // The actual applying of the code will be handled by buttons in the UI
+        addFixMessage(error.cellIndex, response as { fixed_code: string, model?: string, provider?: string });
       }
     } catch (error) {
+      if (controller.signal.aborted) {
+        return;
+      }
       console.error('Error fixing code:', error);
       
       const errorMessage: ChatMessage = {
         id: `error-${Date.now()}`,
         role: 'assistant',
-        content: `Error: Failed to fix the code. Please try again.`,
+        content: failureMessage(error, `Error: Failed to fix the code. Please try again.`),
         timestamp: new Date(),
         hasCode: false,
         error: true
@@ -309,10 +455,19 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
       
       setMessages(prevMessages => [...prevMessages, errorMessage]);
     } finally {
+      abortController.current = null;
       setLoading(false);
     }
   };
   
+  const failureMessage = (error: any, message: string) => {
+    // The server is saturated and tells when to retry
+    if (error instanceof APIError && error.status === 429) {
+      return `Error: ${getLLMProviderName(selectedLLM)} is busy. Please try again in ${error.data.retry_after || 'a few'} seconds.`;
+    }
+    return message;
+  };
+  
   const addSystemMessage = (content: string) => {
     const systemMessage: ChatMessage = {
       id: `system-${Date.now()}`,
@@ -372,7 +527,11 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
             </select>
             <button
               className="jp-AIAssistant-settingsButton"
-              onClick={() => setShowSettings(true)}
+              onClick={() => {
+                // Pick up models listed since the panel opened; unchanged lists cost a 304
+                fetchLLMConfig();
+                setShowSettings(true);
+              }}
               title="Settings"
             >
               ⚙️
@@ -404,7 +563,7 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
                 onCopyCode={copyToClipboard}
               />
             ))}
-            {loading && (
+            {loading && messages[messages.length - 1]?.role !== 'assistant' && (
               <div className="jp-AIAssistant-message jp-AIAssistant-assistantMessage">
                 <div>Thinking...</div>
               </div>
@@ -421,13 +580,22 @@ const ChatPanelComponent: React.FC<ChatPanelProps> = ({
                 onKeyDown={handleKeyDown}
                 ref={textareaRef}
               />
-              <button
-                className="jp-Button jp-mod-styled jp-mod-accept jp-AIAssistant-sendButton"
-                onClick={handleSendMessage}
-                disabled={loading || !input.trim()}
-              >
-                Send
-              </button>
+              {loading && abortController.current ? (
+                <button
+                  className="jp-Button jp-mod-styled jp-mod-warn jp-AIAssistant-sendButton"
+                  onClick={stopGeneration}
+                >
+                  Stop
+                </button>
+              ) : (
+                <button
+                  className="jp-Button jp-mod-styled jp-mod-accept jp-AIAssistant-sendButton"
+                  onClick={handleSendMessage}
+                  disabled={loading || !input.trim()}
+                >
+                  Send
+                </button>
+              )}
             </div>
           </div>
         </>
@@ -6,6 +6,7 @@ interface LLMConfig {
   models: Array<{id: string, name: string}>;
   defaultModel: string;
   local?: boolean;
+  auto?: boolean;
 }
 
 interface SettingsPanelProps {
@@ -29,7 +30,7 @@ export const SettingsPanel: React.FC<SettingsPanelProps> = ({
     <div className="jp-AIAssistant-settings">
       <h3>AI Assistant Settings</h3>
       
-      {llmConfigs.map(config => (
+      {llmConfigs.filter(config => !config.auto).map(config => (
         <div key={config.id} className="jp-AIAssistant-settingsGroup">
           <h4>{config.name}</h4>
           
@@ -0,0 +1,293 @@
+import asyncio
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Request priorities, lower is served first
+PRIORITY_FIX = 0
+PRIORITY_CHAT = 1
+PRIORITY_BATCH = 2
+# Work nobody asked for yet, which only takes a free slot and never waits
+PRIORITY_SPECULATIVE = 3
+
+
+def _parse_limits(value: str) -> Dict[str, int]:
+    """Parse a comma-separated list of ``llm_type:limit`` entries"""
+    limits = {}
+    for entry in value.split(","):
+        llm_type, _, limit = entry.strip().partition(":")
+        if llm_type and limit:
+            limits[llm_type] = int(limit)
+    return limits
+
+
+# Concurrent provider calls per provider; local models get fewer since they share one machine
+ADMISSION_LIMITS = _parse_limits(os.environ.get("AI_ASSISTANT_PROVIDER_LIMITS", "ollama:2"))
+ADMISSION_DEFAULT_LIMIT = int(os.environ.get("AI_ASSISTANT_PROVIDER_LIMIT", "8"))
+
+# Requests waiting for a provider, in total and per user, before new ones are rejected
+ADMISSION_QUEUE_SIZE = int(os.environ.get("AI_ASSISTANT_QUEUE_SIZE", "64"))
+ADMISSION_USER_QUEUE_SIZE = int(os.environ.get("AI_ASSISTANT_USER_QUEUE_SIZE", "8"))
+
+# Seconds a request waits for a provider before it is rejected
+ADMISSION_TIMEOUT = float(os.environ.get("AI_ASSISTANT_QUEUE_TIMEOUT", "30"))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a provider is saturated and the request cannot wait for it"""
+
+    def __init__(self, message: str, retry_after: int):
+        """
+        Args:
+            message: Why the request was rejected
+            retry_after: Seconds after which the client may retry
+        """
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """A request waiting for a provider"""
+
+    __slots__ = ("user", "priority", "seq", "future")
+
+    def __init__(self, user: str, priority: int, seq: int):
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.future: Future = Future()
+
+
+class AdmissionController:
+    """
+    Limit concurrent provider calls and share them fairly between users
+
+    Each provider runs at most its limit of calls at once; further requests
+    wait in a bounded queue. When a call finishes, the next waiter is picked
+    by priority (error fixes before chat before batch fixes), then by how few
+    calls its user already has running on the provider, then round-robin
+    between users, then by arrival. So one user's script can use all
+    capacity while nobody else needs it, but others are served as soon as a
+    call finishes. Speculative work never waits, it only takes a free
+    slot. Requests that find the
+    queue full, or wait longer than the timeout, are rejected with an
+    estimate of when to retry. Thread-safe; async callers wait through
+    ``asyncio.wrap_future`` rather than blocking the event loop.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None,
+                 default_limit: int = ADMISSION_DEFAULT_LIMIT,
+                 queue_size: int = ADMISSION_QUEUE_SIZE,
+                 user_queue_size: int = ADMISSION_USER_QUEUE_SIZE,
+                 timeout: float = ADMISSION_TIMEOUT):
+        """
+        Initialize the controller
+
+        Args:
+            limits: Concurrent calls by provider, defaults to ``ADMISSION_LIMITS``
+            default_limit: Concurrent calls for providers not in ``limits``
+            queue_size: Waiting requests per provider
+            user_queue_size: Waiting requests per user and provider
+            timeout: Seconds a request may wait
+        """
+        self.limits = ADMISSION_LIMITS if limits is None else limits
+        self.default_limit = default_limit
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.timeout = timeout
+        self._active: Dict[str, int] = {}
+        self._user_active: Dict[Tuple[str, str], int] = {}
+        # Sequence number of the last slot granted to each user
+        self._user_granted: Dict[Tuple[str, str], int] = {}
+        self._waiters: Dict[str, List[_Waiter]] = {}
+        # Smoothed seconds a call holds its slot, for Retry-After estimates
+        self._hold: Dict[str, float] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def limit(self, provider: str) -> int:
+        """Concurrent calls allowed for a provider"""
+        return self.limits.get(provider, self.default_limit)
+
+    def has_free_slot(self, provider: str) -> bool:
+        """
+        Check, without waiting, whether a new call to a provider would be admitted at once
+
+        The slot is not taken, so a call made right after may still have to
+        wait or, if speculative, be rejected.
+
+        Args:
+            provider: LLM type the call would go to
+        """
+        with self._lock:
+            return not self._waiters.get(provider) and self._active.get(provider, 0) < self.limit(provider)
+
+    def _retry_after(self, provider: str) -> int:
+        """Estimate the seconds until a provider can take a new request"""
+        waiting = len(self._waiters.get(provider, ()))
+        hold = self._hold.get(provider, 5.0)
+        return max(1, math.ceil((waiting + 1) / max(1, self.limit(provider)) * hold))
+
+    def _grant(self, provider: str, user: str) -> None:
+        """Take a slot for a user; the lock must be held"""
+        self._active[provider] = self._active.get(provider, 0) + 1
+        self._user_active[(provider, user)] = self._user_active.get((provider, user), 0) + 1
+        self._user_granted[(provider, user)] = next(self._seq)
+
+    def _forget_idle(self, provider: str, user: str) -> None:
+        """Drop the state kept on a user with no slot and no waiting request; the lock must be held"""
+        if (provider, user) in self._user_active:
+            return
+        if any(waiter.user == user for waiter in self._waiters.get(provider, ())):
+            return
+        self._user_granted.pop((provider, user), None)
+
+    def _enqueue(self, provider: str, user: str, priority: int) -> Future:
+        """
+        Take a slot or join the queue
+
+        Returns:
+            Future resolved once the request holds a slot
+
+        Raises:
+            AdmissionRejected: If the queue is full, or there is no free slot for speculative work
+        """
+        with self._lock:
+            waiters = self._waiters.setdefault(provider, [])
+            if not waiters and self._active.get(provider, 0) < self.limit(provider):
+                self._grant(provider, user)
+                future: Future = Future()
+                future.set_result(None)
+                return future
+
+            if priority >= PRIORITY_SPECULATIVE:
+                raise AdmissionRejected(f"No free slot of {provider} for speculative work",
+                                        self._retry_after(provider))
+            if len(waiters) >= self.queue_size:
+                raise AdmissionRejected(f"Too many requests waiting for {provider}",
+                                        self._retry_after(provider))
+            if sum(1 for waiter in waiters if waiter.user == user) >= self.user_queue_size:
+                raise AdmissionRejected(f"Too many of your requests waiting for {provider}",
+                                        self._retry_after(provider))
+
+            waiter = _Waiter(user, priority, next(self._seq))
+            waiters.append(waiter)
+            return waiter.future
+
+    def _dequeue(self, provider: str, future: Future) -> bool:
+        """
+        Leave the queue after giving up on waiting
+
+        Returns:
+            True if the request left the queue, False if it already holds a
+            slot and must release it
+        """
+        with self._lock:
+            waiters = self._waiters.get(provider, [])
+            for waiter in waiters:
+                if waiter.future is future:
+                    waiters.remove(waiter)
+                    self._forget_idle(provider, waiter.user)
+                    return True
+        return False
+
+    def _release(self, provider: str, user: str, held: Optional[float]) -> None:
+        """Free a slot, held for ``held`` seconds if it was used, and hand it to the next waiter"""
+        granted = []
+        with self._lock:
+            self._active[provider] -= 1
+            self._user_active[(provider, user)] -= 1
+            if not self._user_active[(provider, user)]:
+                del self._user_active[(provider, user)]
+            if held is not None:
+                previous = self._hold.get(provider)
+                self._hold[provider] = held if previous is None else 0.8 * previous + 0.2 * held
+
+            waiters = self._waiters.get(provider, [])
+            while waiters and self._active[provider] < self.limit(provider):
+                waiter = min(waiters, key=lambda w: (
+                    w.priority,
+                    self._user_active.get((provider, w.user), 0),
+                    self._user_granted.get((provider, w.user), -1),
+                    w.seq
+                ))
+                waiters.remove(waiter)
+                self._grant(provider, waiter.user)
+                granted.append(waiter.future)
+            self._forget_idle(provider, user)
+
+        for future in granted:
+            future.set_result(None)
+
+    def _timed_out(self, provider: str) -> AdmissionRejected:
+        """Rejection for a request that waited too long"""
+        with self._lock:
+            retry_after = self._retry_after(provider)
+        return AdmissionRejected(f"Timed out after {self.timeout:g}s waiting for {provider}", retry_after)
+
+    @contextmanager
+    def admit(self, provider: str, user: Optional[str], priority: int) -> Iterator[None]:
+        """
+        Hold a slot of a provider for the duration of the block
+
+        Blocks the calling thread while waiting, so it must not be called
+        from the threads of ``get_executor``, which admitted calls may need
+        to finish; work run off the calling thread uses
+        ``get_request_executor`` instead.
+
+        Args:
+            provider: LLM type the call goes to
+            user: Who makes the request, None for an anonymous user
+            priority: One of the ``PRIORITY_*`` constants
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait times out
+        """
+        user = user or ""
+        future = self._enqueue(provider, user, priority)
+        try:
+            future.result(self.timeout)
+        except FutureTimeoutError:
+            if self._dequeue(provider, future):
+                logger.info(f"Request of {user or 'anonymous user'} timed out waiting for {provider}")
+                raise self._timed_out(provider)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(provider, user, time.monotonic() - started)
+
+    @asynccontextmanager
+    async def aadmit(self, provider: str, user: Optional[str], priority: int) -> AsyncIterator[None]:
+        """Async version of ``admit``"""
+        user = user or ""
+        future = self._enqueue(provider, user, priority)
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            if self._dequeue(provider, future):
+                logger.info(f"Request of {user or 'anonymous user'} timed out waiting for {provider}")
+                raise self._timed_out(provider)
+        except asyncio.CancelledError:
+            if not self._dequeue(provider, future):
+                self._release(provider, user, None)
+            raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(provider, user, time.monotonic() - started)
+
+
+# Process-wide controller of provider calls made by ``service``
+admission = AdmissionController()
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+# Tokens each user may spend per hour on fixes started before they asked for
+# one; 0 disables speculative fixes
+SPECULATIVE_TOKENS_PER_HOUR = int(os.environ.get("AI_ASSISTANT_SPECULATIVE_TOKENS_PER_HOUR", "20000"))
+
+# Speculative fixes each user may have running at once
+SPECULATIVE_CONCURRENCY = int(os.environ.get("AI_ASSISTANT_SPECULATIVE_CONCURRENCY", "1"))
+
+
+class TokenBudget:
+    """
+    Tokens each user may spend within a sliding time window
+
+    Work is charged its estimated tokens up front with ``reserve``, which
+    refuses it if the user's spending in the window would exceed the limit or
+    the user already has ``concurrency`` reservations running, and then
+    ``settle`` replaces the estimate with the tokens actually spent.
+    Thread-safe.
+    """
+
+    def __init__(self, tokens: int = SPECULATIVE_TOKENS_PER_HOUR,
+                 concurrency: int = SPECULATIVE_CONCURRENCY, window: float = 3600.0):
+        """
+        Initialize the budget
+
+        Args:
+            tokens: Tokens each user may spend per window
+            concurrency: Reservations each user may hold at once
+            window: Seconds over which spending is counted
+        """
+        self.tokens = tokens
+        self.concurrency = concurrency
+        self.window = window
+        # Per user, [time, tokens] charges in the window, oldest first
+        self._charges: Dict[str, Deque[List[float]]] = {}
+        self._running: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _spent_locked(self, user: str, now: float) -> float:
+        """Tokens a user spent in the window, dropping older charges; the lock must be held"""
+        charges = self._charges.get(user)
+        if not charges:
+            return 0
+        while charges and charges[0][0] <= now - self.window:
+            charges.popleft()
+        if not charges:
+            del self._charges[user]
+            return 0
+        return sum(charge[1] for charge in charges)
+
+    def spent(self, user: Optional[str]) -> int:
+        """Tokens a user spent in the window, including reservations not settled yet"""
+        with self._lock:
+            return int(self._spent_locked(user or "", time.monotonic()))
+
+    def reserve(self, user: Optional[str], tokens: int) -> Optional[List[float]]:
+        """
+        Charge a user the estimated tokens of some work
+
+        Args:
+            user: Who the work is for, None for an anonymous user
+            tokens: Estimated tokens of the work
+
+        Returns:
+            The reservation, to pass to ``settle`` once the work is done, or
+            None if it would exceed the user's budget or concurrency
+        """
+        user = user or ""
+        now = time.monotonic()
+        with self._lock:
+            if self._running.get(user, 0) >= self.concurrency:
+                return None
+            if self._spent_locked(user, now) + tokens > self.tokens:
+                return None
+            reservation = [now, float(tokens)]
+            self._charges.setdefault(user, deque()).append(reservation)
+            self._running[user] = self._running.get(user, 0) + 1
+            return reservation
+
+    def settle(self, user: Optional[str], reservation: List[float], tokens: int) -> None:
+        """
+        Replace the estimate of finished work with the tokens it spent
+
+        Args:
+            user: User passed to ``reserve``
+            reservation: Reservation returned by ``reserve``
+            tokens: Tokens actually spent, 0 if none were
+        """
+        user = user or ""
+        with self._lock:
+            reservation[1] = float(tokens)
+            self._running[user] -= 1
+            if not self._running[user]:
+                del self._running[user]
+
+
+# Process-wide budget of speculative error fixes
+speculative_budget = TokenBudget()
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Time-to-live of cached responses in seconds; 0 disables the cache
+CACHE_TTL = float(os.environ.get("AI_ASSISTANT_CACHE_TTL", "3600"))
+
+# Size limits of the in-process and on-disk tiers
+CACHE_MEMORY_BYTES = int(float(os.environ.get("AI_ASSISTANT_CACHE_MEMORY_MB", "32")) * 1024 * 1024)
+CACHE_DISK_BYTES = int(float(os.environ.get("AI_ASSISTANT_CACHE_DISK_MB", "256")) * 1024 * 1024)
+
+# Directory of the on-disk tier, shared by all processes on the machine
+CACHE_DIR = os.environ.get(
+    "AI_ASSISTANT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "jupyterlab_ai_assistant")
+)
+
+
+def _digest(value: Any) -> str:
+    """Hash a JSON-serializable value independently of dict key order"""
+    encoded = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def notebook_digest(notebook_content: Dict[str, Any]) -> str:
+    """
+    Hash the parts of a notebook that end up in the prompt
+
+    Args:
+        notebook_content: Dictionary containing cells, outputs, and other notebook content
+
+    Returns:
+        Hex digest of the cell types, sources and outputs
+    """
+    return _digest([
+        [cell.get("cell_type", ""), cell.get("source", ""), cell.get("outputs", [])]
+        for cell in notebook_content.get("cells", [])
+    ])
+
+
+def chat_cache_key(llm_type: str, model: str, prompt: str, messages: List[Dict[str, Any]],
+                   notebook_content: Dict[str, Any]) -> str:
+    """
+    Build the cache key of a chat request
+
+    Messages are reduced to role and whitespace-trimmed content, so client-side
+    fields such as ids and timestamps do not defeat the cache.
+
+    Args:
+        llm_type: The LLM type answering the request
+        model: The model answering the request
+        prompt: Current prompt/question from the user
+        messages: Chat history
+        notebook_content: Content of the notebook including code cells and outputs
+
+    Returns:
+        Hex digest identifying the request
+    """
+    return _digest({
+        "kind": "chat",
+        "llm_type": llm_type,
+        "model": model,
+        "prompt": prompt.strip(),
+        "messages": [
+            [msg.get("role", "user"), (msg.get("content") or "").strip()]
+            for msg in messages
+        ],
+        "notebook": notebook_digest(notebook_content),
+        # Decides which cells survive when the notebook exceeds the context window
+        "active_cell": notebook_content.get("active_cell_index")
+    })
+
+
+def fix_cache_key(llm_type: str, model: str, code: str, errors: List[Dict[str, Any]]) -> str:
+    """
+    Build the cache key of an error fixing request
+
+    Args:
+        llm_type: The LLM type answering the request
+        model: The model answering the request
+        code: The code with errors
+        errors: List of error messages and details
+
+    Returns:
+        Hex digest identifying the request
+    """
+    return _digest({
+        "kind": "fix",
+        "llm_type": llm_type,
+        "model": model,
+        "code": code,
+        "errors": [error.get("message", "") for error in errors]
+    })
+
+
+class ResponseCache:
+    """
+    Two-tier cache of LLM responses
+
+    An in-process LRU tier answers repeated requests without I/O, and an
+    SQLite tier in WAL mode is shared by every process using the same cache
+    directory (e.g. all gunicorn workers). Entries expire after ``ttl``
+    seconds and each tier evicts least recently used entries beyond its
+    byte limit. Failures of the disk tier are logged and otherwise ignored.
+    """
+
+    # Evict from the disk tier every this many writes
+    EVICT_EVERY = 50
+
+    def __init__(self, path: Optional[str] = None, ttl: float = CACHE_TTL,
+                 memory_bytes: int = CACHE_MEMORY_BYTES, disk_bytes: int = CACHE_DISK_BYTES):
+        """
+        Initialize the cache
+
+        Args:
+            path: SQLite database file, None for a memory-only cache
+            ttl: Seconds an entry stays valid
+            memory_bytes: Size limit of the in-process tier
+            disk_bytes: Size limit of the on-disk tier
+        """
+        self.path = path
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._memory: "OrderedDict[str, Tuple[float, int, str]]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                connection = self._connection()
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            except Exception as e:
+                logger.warning(f"Response cache at {path} is unavailable, using memory only: {e}")
+                self.path = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether responses are cached at all"""
+        return self.ttl > 0
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get this thread's connection to the disk tier"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str, memory_only: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached response
+
+        Args:
+            key: Cache key from ``chat_cache_key``/``fix_cache_key``
+            memory_only: Only check the in-process tier, which never blocks
+
+        Returns:
+            The cached response, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, size, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return json.loads(value)
+                del self._memory[key]
+                self._memory_size -= size
+
+        if memory_only or not self.path:
+            return None
+
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at <= now:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+
+        self._remember(key, value, expires_at)
+        return json.loads(value)
+
+    def set(self, key: str, response: Dict[str, Any]) -> None:
+        """
+        Store a response in both tiers
+
+        Args:
+            key: Cache key from ``chat_cache_key``/``fix_cache_key``
+            response: JSON-serializable response
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        value = json.dumps(response)
+        expires_at = now + self.ttl
+        self._remember(key, value, expires_at)
+
+        if not self.path:
+            return
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires_at, now)
+            )
+            with self._lock:
+                self._writes += 1
+                evict = self._writes % self.EVICT_EVERY == 0
+            if evict:
+                self._evict_disk(connection, now)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    def clear(self) -> None:
+        """Remove every entry from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        if self.path:
+            try:
+                self._connection().execute("DELETE FROM responses")
+            except Exception as e:
+                logger.warning(f"Response cache clear failed: {e}")
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        """Put an entry in the in-process tier, evicting the least recently used"""
+        size = len(value)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_size -= previous[1]
+            self._memory[key] = (expires_at, size, value)
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, (_, evicted_size, _) = self._memory.popitem(last=False)
+                self._memory_size -= evicted_size
+
+    def _evict_disk(self, connection: sqlite3.Connection, now: float) -> None:
+        """Drop expired entries, then the least recently used ones beyond the size limit"""
+        connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        excess = total - self.disk_bytes
+        freed = 0
+        stale_keys = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            stale_keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        connection.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    Get the process-wide response cache
+
+    Returns:
+        ResponseCache backed by ``responses.sqlite3`` in ``CACHE_DIR``
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3"))
+        return _response_cache
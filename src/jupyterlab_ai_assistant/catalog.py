@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import codec, metrics
+from .llm import AUTO_LLM_TYPE, get_llm_instance
+from .llm.base import get_executor
+from .llm.registry import ProviderRegistry, provider_registry
+
+logger = logging.getLogger(__name__)
+
+# Seconds the model catalog is served before it is refreshed in the background
+CATALOG_TTL = float(os.environ.get("AI_ASSISTANT_CATALOG_TTL", "300"))
+
+# Seconds after the first refresh starts during which requests wait for it to
+# complete; a provider that takes longer is listed with its default model
+# until it answers
+CATALOG_FIRST_WAIT = float(os.environ.get("AI_ASSISTANT_CATALOG_FIRST_WAIT", "2"))
+
+# Entry for automatic model selection, listed after the providers
+_AUTO_ENTRY = {
+    "id": AUTO_LLM_TYPE,
+    "name": "Auto (fastest suitable model)",
+    "models": [],
+    "default_model": "",
+    "defaultModel": "",
+    "local": False,
+    "auto": True
+}
+
+
+def _entry(llm_type: str, name: str, default_model: str, models: List[Dict[str, Any]],
+           local: bool = False) -> Dict[str, Any]:
+    """
+    Build a catalog entry
+
+    The default model is given both as ``default_model``, as the providers
+    name it, and as ``defaultModel``, as the frontend reads it.
+
+    Args:
+        llm_type: Provider type
+        name: Display name of the provider
+        default_model: Model used when a request names none
+        models: ``{"id", "name"}`` dicts of the models to offer
+        local: Whether the models run on this machine
+
+    Returns:
+        The entry
+    """
+    if default_model and not any(model.get("id") == default_model for model in models):
+        models = [{"id": default_model, "name": default_model}, *models]
+    return {
+        "id": llm_type,
+        "name": name,
+        "models": models,
+        "default_model": default_model,
+        "defaultModel": default_model,
+        "local": local
+    }
+
+
+class ModelCatalog:
+    """
+    Models offered by every registered provider, as served by ``/ai-assistant/config``
+
+    Each provider's ``get_config()`` is called on its own background thread,
+    so a slow or offline provider (such as an Ollama server that is not
+    running) holds up neither the others nor any request: until it answers,
+    it is listed as it was at the last refresh, or with just its default
+    model. Requests are served the cached body at once, with an ETag for
+    conditional requests, and one older than ``ttl`` seconds starts a
+    refresh. Providers are imported by the first refresh, not at startup.
+    Thread-safe.
+    """
+
+    def __init__(self, ttl: float = CATALOG_TTL, registry: ProviderRegistry = provider_registry):
+        """
+        Initialize an empty catalog
+
+        Args:
+            ttl: Seconds between refreshes
+            registry: Providers to list
+        """
+        self.ttl = ttl
+        self._registry = registry
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._listing: Set[str] = set()
+        self._refreshed_at: Optional[float] = None
+        self._first_refresh_at: Optional[float] = None
+        self._body = b""
+        self._etag = ""
+        self._first_refresh = threading.Event()
+        self._lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """Start listing the models of every provider, skipping providers still listing from the last refresh"""
+        llm_types = self._registry.types()
+        with self._lock:
+            self._refreshed_at = time.monotonic()
+            if self._first_refresh_at is None:
+                self._first_refresh_at = self._refreshed_at
+            started = [llm_type for llm_type in llm_types if llm_type not in self._listing]
+            self._listing.update(started)
+            if not self._listing:
+                self._first_refresh.set()
+        for llm_type in started:
+            threading.Thread(target=self._list_models, args=(llm_type,),
+                             name=f"ai-assistant-catalog-{llm_type}", daemon=True).start()
+
+    def _list_models(self, llm_type: str) -> None:
+        """List one provider's models and publish them; runs on a background thread"""
+        started = time.monotonic()
+        entry = None
+        try:
+            config = get_llm_instance(llm_type).get_config() or {}
+            if config.get("available") is False:
+                logger.warning(f"Not listing the models of the {llm_type} provider, it could not be loaded")
+            else:
+                entry = _entry(llm_type, config.get("name") or llm_type,
+                               config.get("default_model") or "", list(config.get("models") or []),
+                               bool(config.get("local")))
+                metrics.list_models(llm_type, [model.get("id") for model in entry["models"]])
+        except Exception as e:
+            logger.warning(f"Could not list the models of the {llm_type} provider: {e}")
+        logger.debug(f"Listed the {llm_type} models in {time.monotonic() - started:.2f}s")
+
+        with self._lock:
+            self._listing.discard(llm_type)
+            if entry is not None:
+                self._entries[llm_type] = entry
+            self._publish()
+            if not self._listing:
+                self._first_refresh.set()
+
+    def _publish(self) -> None:
+        """Serialize the catalog and compute its ETag; the lock must be held"""
+        entries = [
+            self._entries.get(llm_type)
+            or _entry(llm_type, llm_type, self._registry.default_model(llm_type, load=False), [])
+            for llm_type in self._registry.types()
+        ]
+        self._body = codec.dumps({"available_models": [*entries, _AUTO_ENTRY]})
+        # Weak, since the body may be sent compressed
+        self._etag = f'W/"{hashlib.sha1(self._body).hexdigest()}"'
+
+    def _first_refresh_wait(self, wait: float) -> float:
+        """Seconds left to wait for the first refresh, at most ``wait`` from its start"""
+        if self._first_refresh.is_set():
+            return 0.0
+        with self._lock:
+            started = self._first_refresh_at
+        return wait if started is None else started + wait - time.monotonic()
+
+    def snapshot(self, wait: float = 0.0) -> Tuple[bytes, str]:
+        """
+        Get the catalog, starting a refresh in the background if it is stale
+
+        Args:
+            wait: Seconds from the start of the first refresh to wait for it to
+                complete, so only requests in that window wait
+
+        Returns:
+            Tuple of the JSON body and its ETag
+        """
+        with self._lock:
+            stale = self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.ttl
+        if stale:
+            self.refresh()
+        remaining = self._first_refresh_wait(wait)
+        if remaining > 0:
+            self._first_refresh.wait(remaining)
+        with self._lock:
+            if not self._body:
+                self._publish()
+            return self._body, self._etag
+
+    async def asnapshot(self) -> Tuple[bytes, str]:
+        """Async version of ``snapshot``; waits for the first refresh in the executor, up to ``CATALOG_FIRST_WAIT``"""
+        if self._first_refresh_at is not None and self._first_refresh_wait(CATALOG_FIRST_WAIT) <= 0:
+            return self.snapshot()
+        return await asyncio.get_running_loop().run_in_executor(
+            get_executor(), self.snapshot, CATALOG_FIRST_WAIT
+        )
+
+
+# Process-wide catalog served by the config endpoints
+model_catalog = ModelCatalog()
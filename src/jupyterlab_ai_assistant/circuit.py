@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+from typing import Dict, Hashable, Optional
+
+# Consecutive provider failures after which a breaker opens
+BREAKER_FAILURES = int(os.environ.get("AI_ASSISTANT_BREAKER_FAILURES", "5"))
+
+# Seconds an open breaker refuses calls before letting a probe call through
+BREAKER_COOLDOWN = float(os.environ.get("AI_ASSISTANT_BREAKER_COOLDOWN", "30"))
+
+
+class _Breaker:
+    """State of one breaker"""
+
+    __slots__ = ("failures", "opened_at", "probe_at")
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_at: Optional[float] = None
+
+
+class CircuitBreaker:
+    """
+    Circuit breakers per key, e.g. (llm_type, model)
+
+    A breaker opens after ``failures`` consecutive provider failures and then
+    refuses calls for ``cooldown`` seconds, so requests fail at once instead
+    of waiting for a provider that is down. After the cooldown one probe
+    call is let through (half-open): its success closes the breaker, its
+    failure opens it again. A probe that never reports back is replaced
+    after another cooldown. Thread-safe.
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        """
+        Initialize the breakers
+
+        Args:
+            failures: Consecutive failures that open a breaker
+            cooldown: Seconds an open breaker refuses calls
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        self._breakers: Dict[Hashable, _Breaker] = {}
+        self._lock = threading.Lock()
+
+    def _refuses(self, breaker: Optional[_Breaker], now: float) -> bool:
+        """Whether a breaker refuses calls at the moment; the lock must be held"""
+        if breaker is None or breaker.opened_at is None:
+            return False
+        if now - breaker.opened_at < self.cooldown:
+            return True
+        return breaker.probe_at is not None and now - breaker.probe_at < self.cooldown
+
+    def allow(self, key: Hashable) -> bool:
+        """
+        Check whether a call may be made, taking the probe slot of a half-open breaker
+
+        Args:
+            key: What the call goes to, e.g. (llm_type, model)
+
+        Returns:
+            True if the call may be made, in which case its outcome must be
+            reported with ``record_success`` or ``record_failure``
+        """
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if self._refuses(breaker, now):
+                return False
+            if breaker is not None and breaker.opened_at is not None:
+                breaker.probe_at = now
+            return True
+
+    def is_open(self, key: Hashable) -> bool:
+        """
+        Check whether calls are refused at the moment, without taking the probe slot
+
+        Args:
+            key: What the calls go to
+
+        Returns:
+            True if a call would be refused
+        """
+        with self._lock:
+            return self._refuses(self._breakers.get(key), time.monotonic())
+
+    def state(self, key: Hashable) -> str:
+        """
+        Get the state of a breaker
+
+        Args:
+            key: What the calls go to
+
+        Returns:
+            ``"closed"``, ``"open"`` or ``"half-open"``
+        """
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None or breaker.opened_at is None:
+                return "closed"
+            return "open" if now - breaker.opened_at < self.cooldown else "half-open"
+
+    def record_success(self, key: Hashable) -> None:
+        """
+        Record a call the provider answered, closing the breaker
+
+        Args:
+            key: What the call went to
+        """
+        with self._lock:
+            self._breakers.pop(key, None)
+
+    def release(self, key: Hashable) -> None:
+        """
+        Give back the probe slot of a call abandoned before its outcome was known
+
+        The breaker stays as it is, and the next call after it becomes the probe.
+
+        Args:
+            key: What the call went to
+        """
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is not None:
+                breaker.probe_at = None
+
+    def record_failure(self, key: Hashable) -> None:
+        """
+        Record a call that failed because of the provider
+
+        Args:
+            key: What the call went to
+        """
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = _Breaker()
+            breaker.failures += 1
+            # A failed probe opens the breaker again at once
+            if breaker.opened_at is not None or breaker.failures >= self.failures:
+                breaker.opened_at = time.monotonic()
+                breaker.probe_at = None
+
+
+# Process-wide breakers of the providers, keyed by (llm_type, model)
+circuit_breaker = CircuitBreaker()
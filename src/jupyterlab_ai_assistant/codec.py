@@ -0,0 +1,205 @@
+import gzip
+import json
+import os
+import zlib
+from typing import Any, List, Optional, Tuple, Union
+
+# orjson parses and serializes several times faster than the json module,
+# which matters for request bodies carrying whole notebooks; used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# zstd is offered for compressed bodies when zstandard is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Decompressed request bodies larger than this are refused, so a small
+# compressed body cannot expand into all of the server's memory
+MAX_BODY_BYTES = int(float(os.environ.get("AI_ASSISTANT_MAX_BODY_MB", "256")) * 1024 * 1024)
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = int(os.environ.get("AI_ASSISTANT_COMPRESS_MIN_BYTES", "1024"))
+
+# Compression levels, chosen for speed since bodies are compressed per request
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+# Chunk size when decompressing within MAX_BODY_BYTES
+_CHUNK_BYTES = 1024 * 1024
+
+
+class BodyError(ValueError):
+    """Raised for a request body that cannot be decoded"""
+
+    def __init__(self, message: str, status: int = 400):
+        """
+        Args:
+            message: What is wrong with the body
+            status: HTTP status to answer with
+        """
+        super().__init__(message)
+        self.status = status
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Parse JSON
+
+    Args:
+        data: JSON text, as bytes in UTF-8 or as a string
+
+    Returns:
+        The parsed value
+
+    Raises:
+        ValueError: If the text is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialize a value as compact UTF-8 JSON
+
+    Args:
+        value: JSON-serializable value
+
+    Returns:
+        The JSON text
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Values orjson refuses, such as integers beyond 64 bits
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _gunzip(body: bytes) -> bytes:
+    """Decompress a gzip body within MAX_BODY_BYTES"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+    if len(data) > MAX_BODY_BYTES or decompressor.unconsumed_tail:
+        raise BodyError(f"Request body exceeds {MAX_BODY_BYTES} bytes", 413)
+    if not decompressor.eof:
+        raise BodyError("Truncated gzip request body")
+    return data
+
+
+def _unzstd(body: bytes) -> bytes:
+    """Decompress a zstd body within MAX_BODY_BYTES"""
+    parts = []
+    size = 0
+    with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+        while True:
+            chunk = reader.read(_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                raise BodyError(f"Request body exceeds {MAX_BODY_BYTES} bytes", 413)
+            parts.append(chunk)
+    return b"".join(parts)
+
+
+def decode_body(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Undo the compression of a request body
+
+    Args:
+        body: Body as received
+        content_encoding: Value of the Content-Encoding header, if any
+
+    Returns:
+        The uncompressed body
+
+    Raises:
+        BodyError: If the encoding is not supported or the body is corrupt or too large
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    try:
+        if encoding == "identity":
+            return body
+        if encoding in ("gzip", "x-gzip"):
+            return _gunzip(body)
+        if encoding == "zstd" and zstandard is not None:
+            return _unzstd(body)
+    except zlib.error as e:
+        raise BodyError(f"Invalid gzip request body: {e}")
+    except BodyError:
+        raise
+    except Exception as e:
+        # zstandard.ZstdError
+        raise BodyError(f"Invalid {encoding} request body: {e}")
+    raise BodyError(f"Unsupported Content-Encoding, use {' or '.join(encodings())}", 415)
+
+
+def encodings() -> List[str]:
+    """
+    Compression formats supported for request and response bodies
+
+    Returns:
+        Content codings, most preferred first
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def accepted_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the compression of a response from the client's Accept-Encoding header
+
+    Args:
+        accept_encoding: Value of the Accept-Encoding header, if any
+
+    Returns:
+        The preferred supported coding the client accepts, or None
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for entry in accept_encoding.split(","):
+        coding, _, params = entry.strip().lower().partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip()] = weight
+
+    candidates = [c for c in encodings() if weights.get(c, weights.get("*", 0.0)) > 0]
+    if not candidates:
+        return None
+    # Highest weight, ties broken by our preference
+    return max(candidates, key=lambda c: (weights.get(c, weights.get("*", 0.0)), -encodings().index(c)))
+
+
+def compress(data: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """
+    Compress a response body if the client accepts it and it is large enough to gain
+
+    Args:
+        data: Response body
+        accept_encoding: Value of the client's Accept-Encoding header, if any
+
+    Returns:
+        Tuple of the body to send and its Content-Encoding, None if uncompressed
+    """
+    if len(data) < COMPRESS_MIN_BYTES:
+        return data, None
+    encoding = accepted_encoding(accept_encoding)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), encoding
+    if encoding == "gzip":
+        # mtime=0 keeps the output identical for identical bodies
+        return gzip.compress(data, GZIP_LEVEL, mtime=0), encoding
+    return data, None
@@ -0,0 +1,383 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .cache import CACHE_DIR
+from .codec import BodyError
+from .llm.context import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Days a conversation is kept after its last turn
+CONVERSATION_TTL = float(os.environ.get("AI_ASSISTANT_CONVERSATION_TTL_DAYS", "7")) * 24 * 3600
+
+# Size limit of the in-process tier; conversations beyond it are only kept on disk
+CONVERSATION_MEMORY_BYTES = int(float(os.environ.get("AI_ASSISTANT_CONVERSATION_MEMORY_MB", "16")) * 1024 * 1024)
+
+# Estimated tokens of verbatim history beyond which older turns are folded into the summary
+HISTORY_TOKENS = int(os.environ.get("AI_ASSISTANT_HISTORY_TOKENS", "4000"))
+
+# Messages kept verbatim when the client does not say, as the frontend's maxHistoryLength default
+DEFAULT_MAX_HISTORY = 10
+
+# Hard limit on the messages stored per conversation, for when summarizing keeps failing
+MAX_STORED_MESSAGES = 200
+
+# Attempts to apply a change to a conversation that other requests keep changing
+_UPDATE_ATTEMPTS = 5
+
+
+class UnknownConversation(Exception):
+    """Raised for a conversation the server does not have, so the client must send its messages"""
+
+
+def _key(user: Optional[str], conversation_id: str) -> str:
+    """Store key of a conversation; conversations are private to the user who started them"""
+    return json.dumps([user or "", str(conversation_id)])
+
+
+class ConversationStore:
+    """
+    Chat histories kept on the server, by user and conversation id
+
+    Every conversation is stored in an SQLite database in WAL mode, shared by
+    every process using the same cache directory, and the most recently used
+    ones are also kept in memory up to ``memory_bytes``. Each change bumps a
+    conversation's version and is only written if the stored version is the
+    one it was based on, so concurrent turns, possibly in other processes,
+    are applied one after the other instead of overwriting each other.
+    Conversations expire ``ttl`` seconds after their last change. If the
+    database is unavailable, conversations are kept in memory only.
+    """
+
+    # Drop expired conversations from disk every this many writes
+    EVICT_EVERY = 50
+
+    def __init__(self, path: Optional[str] = None, ttl: float = CONVERSATION_TTL,
+                 memory_bytes: int = CONVERSATION_MEMORY_BYTES):
+        """
+        Initialize the store
+
+        Args:
+            path: SQLite database file, None to keep conversations in memory only
+            ttl: Seconds a conversation is kept after its last change
+            memory_bytes: Size limit of the in-process tier
+        """
+        self.path = path
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+
+        self._memory: "OrderedDict[str, Tuple[int, int, float, Dict[str, Any]]]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._connection().execute(
+                    "CREATE TABLE IF NOT EXISTS conversations ("
+                    "key TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL, "
+                    "expires_at REAL NOT NULL)"
+                )
+            except Exception as e:
+                logger.warning(f"Conversation store at {path} is unavailable, using memory only: {e}")
+                self.path = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get this thread's connection to the database"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, user: Optional[str], conversation_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a conversation
+
+        Args:
+            user: Who the conversation belongs to
+            conversation_id: Id chosen by the client
+
+        Returns:
+            The conversation, see ``new_conversation``, or None if it is
+            unknown or expired. It must not be modified, use ``update``.
+        """
+        key = _key(user, conversation_id)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[2] <= now:
+                del self._memory[key]
+                self._memory_size -= entry[1]
+                entry = None
+        if not self.path:
+            return entry[3] if entry is not None else None
+
+        try:
+            connection = self._connection()
+            if entry is not None:
+                # Another process may have changed it since
+                row = connection.execute("SELECT version FROM conversations WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[0] == entry[0]:
+                    with self._lock:
+                        if key in self._memory:
+                            self._memory.move_to_end(key)
+                    return entry[3]
+
+            row = connection.execute(
+                "SELECT data, version, expires_at FROM conversations WHERE key = ?", (key,)
+            ).fetchone()
+        except Exception as e:
+            logger.warning(f"Conversation store read failed: {e}")
+            return entry[3] if entry is not None else None
+        if row is None or row[2] <= now:
+            return None
+        data, version, expires_at = row
+        conversation = json.loads(data)
+        self._remember(key, version, len(data), expires_at, conversation)
+        return conversation
+
+    def update(self, user: Optional[str], conversation_id: str,
+               change: Callable[[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """
+        Change a conversation, retrying if it was changed concurrently
+
+        Args:
+            user: Who the conversation belongs to
+            conversation_id: Id chosen by the client
+            change: Gets the current conversation, or None if there is none,
+                and returns the new one, or None to leave it as it is. Called
+                again with the newer conversation after a concurrent change.
+
+        Returns:
+            The conversation after the change
+
+        Raises:
+            RuntimeError: If concurrent changes kept winning
+        """
+        key = _key(user, conversation_id)
+        for _ in range(_UPDATE_ATTEMPTS):
+            current = self.get(user, conversation_id)
+            changed = change(current)
+            if changed is None:
+                return current
+            version = current["version"] if current is not None else 0
+            changed = {**changed, "version": version + 1}
+            if self._write(key, version, changed):
+                return changed
+        raise RuntimeError(f"Conversation {conversation_id} is changed too often to update")
+
+    def _write(self, key: str, version: int, conversation: Dict[str, Any]) -> bool:
+        """Store a conversation if its stored version is still ``version``"""
+        data = json.dumps(conversation)
+        expires_at = time.time() + self.ttl
+        if not self.path:
+            with self._lock:
+                entry = self._memory.get(key)
+                if (entry[0] if entry is not None else 0) != version:
+                    return False
+                self._remember_locked(key, conversation["version"], len(data), expires_at, conversation)
+            return True
+
+        connection = self._connection()
+        if version == 0:
+            # Replaces an expired conversation, which the cleanup has not dropped yet
+            cursor = connection.execute(
+                "INSERT INTO conversations (key, data, version, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET data = excluded.data, version = excluded.version, "
+                "expires_at = excluded.expires_at WHERE conversations.expires_at <= ?",
+                (key, data, conversation["version"], expires_at, time.time())
+            )
+        else:
+            cursor = connection.execute(
+                "UPDATE conversations SET data = ?, version = ?, expires_at = ? WHERE key = ? AND version = ?",
+                (data, conversation["version"], expires_at, key, version)
+            )
+        if cursor.rowcount != 1:
+            return False
+        self._remember(key, conversation["version"], len(data), expires_at, conversation)
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            try:
+                connection.execute("DELETE FROM conversations WHERE expires_at <= ?", (time.time(),))
+            except Exception as e:
+                logger.warning(f"Dropping expired conversations failed: {e}")
+        return True
+
+    def _remember(self, key: str, version: int, size: int, expires_at: float,
+                  conversation: Dict[str, Any]) -> None:
+        """Put a conversation in the in-process tier, evicting the least recently used"""
+        with self._lock:
+            self._remember_locked(key, version, size, expires_at, conversation)
+
+    def _remember_locked(self, key: str, version: int, size: int, expires_at: float,
+                         conversation: Dict[str, Any]) -> None:
+        """``_remember`` with the lock held"""
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_size -= previous[1]
+        if size > self.memory_bytes:
+            return
+        self._memory[key] = (version, size, expires_at, conversation)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes:
+            _, (_, evicted_size, _, _) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+
+def new_conversation(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Start a conversation
+
+    Args:
+        messages: History held by the client; only user and assistant messages are kept
+
+    Returns:
+        Conversation with a ``summary`` of the turns folded so far, the
+        ``messages`` after them, and ``start``, the number of messages
+        folded or dropped before ``messages``
+    """
+    kept = [
+        {"role": msg["role"], "content": msg.get("content") or ""}
+        for msg in messages
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant")
+    ]
+    start = max(0, len(kept) - MAX_STORED_MESSAGES)
+    return {"summary": "", "start": start, "messages": kept[start:]}
+
+
+def append_turn(conversation: Optional[Dict[str, Any]], prompt: str, answer: str) -> Dict[str, Any]:
+    """
+    Add a user prompt and the assistant's answer to a conversation
+
+    Args:
+        conversation: The conversation, None to start one
+        prompt: What the user asked
+        answer: What the assistant answered
+
+    Returns:
+        The new conversation
+    """
+    conversation = conversation or new_conversation([])
+    messages = conversation["messages"] + [
+        {"role": "user", "content": prompt},
+        {"role": "assistant", "content": answer}
+    ]
+    dropped = max(0, len(messages) - MAX_STORED_MESSAGES)
+    return {**conversation, "start": conversation["start"] + dropped, "messages": messages[dropped:]}
+
+
+def _from_user_turn(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop leading assistant messages, since providers expect history to start with a user turn"""
+    for index, msg in enumerate(messages):
+        if msg["role"] == "user":
+            return messages[index:]
+    return []
+
+
+def request_max_history(data: Dict[str, Any]) -> Optional[int]:
+    """
+    Read the number of recent messages the client wants sent verbatim
+
+    Args:
+        data: Decoded request body, which may contain ``max_history``
+
+    Returns:
+        ``max_history``, or None if the client sent none
+
+    Raises:
+        BodyError: If ``max_history`` is not a non-negative integer
+    """
+    max_history = data.get("max_history")
+    if max_history is None:
+        return None
+    if isinstance(max_history, bool) or not isinstance(max_history, int) or max_history < 0:
+        raise BodyError("max_history must be a non-negative integer")
+    return max_history
+
+
+def prompt_history(conversation: Dict[str, Any], max_history: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Get the history to send to the LLM with the next turn of a conversation
+
+    Args:
+        conversation: The conversation
+        max_history: Number of recent messages to send verbatim, ``DEFAULT_MAX_HISTORY`` if None
+
+    Returns:
+        The summary of the folded turns as an exchange, if there is one,
+        then at most ``max_history`` recent messages
+    """
+    limit = DEFAULT_MAX_HISTORY if max_history is None else max(0, max_history)
+    messages = conversation["messages"]
+    recent = _from_user_turn(messages[max(0, len(messages) - limit):] if limit else [])
+    if not conversation["summary"]:
+        return recent
+    return [
+        {"role": "user", "content": f"Summary of our conversation so far:\n{conversation['summary']}"},
+        {"role": "assistant", "content": "Understood, I will take it into account."},
+        *recent
+    ]
+
+
+def fold_count(conversation: Dict[str, Any], max_history: Optional[int] = None) -> int:
+    """
+    Decide how many of the oldest messages to fold into the summary
+
+    Compaction is due once the verbatim messages exceed ``max_history`` or
+    ``HISTORY_TOKENS``. It then folds messages until half of both limits
+    remain, so it is not due again on the next turn, and the remaining
+    history starts with a user turn.
+
+    Args:
+        conversation: The conversation
+        max_history: Limit on verbatim messages, ``DEFAULT_MAX_HISTORY`` if None
+
+    Returns:
+        Number of messages to fold, 0 if compaction is not due
+    """
+    limit = DEFAULT_MAX_HISTORY if max_history is None else max(0, max_history)
+    messages = conversation["messages"]
+    tokens = [estimate_tokens(msg["content"]) + 4 for msg in messages]
+    remaining = sum(tokens)
+    if len(messages) <= limit and remaining <= HISTORY_TOKENS:
+        return 0
+
+    count = 0
+    while count < len(messages) and (len(messages) - count > limit // 2 or remaining > HISTORY_TOKENS // 2):
+        remaining -= tokens[count]
+        count += 1
+    while count < len(messages) and messages[count]["role"] != "user":
+        count += 1
+    return count
+
+
+_conversation_store: Optional[ConversationStore] = None
+_conversation_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    Get the process-wide conversation store
+
+    Returns:
+        ConversationStore backed by ``conversations.sqlite3`` in ``CACHE_DIR``
+    """
+    global _conversation_store
+    with _conversation_store_lock:
+        if _conversation_store is None:
+            _conversation_store = ConversationStore(os.path.join(CACHE_DIR, "conversations.sqlite3"))
+        return _conversation_store
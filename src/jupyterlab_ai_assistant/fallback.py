@@ -0,0 +1,296 @@
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .admission import AdmissionRejected
+from .codec import BodyError
+from .circuit import circuit_breaker
+from .llm import resolve_llm
+from .llm.base import get_request_executor
+from .llm.router import AUTO_LLM_TYPE
+from .stats import latency_tracker
+
+logger = logging.getLogger(__name__)
+
+# Providers tried, in order, after the requested one fails
+FALLBACK_CHAIN = [t.strip() for t in os.environ.get("AI_ASSISTANT_FALLBACK_CHAIN", "openai").split(",") if t.strip()]
+
+# Default request deadline in seconds when the client does not send one; unset means no deadline
+DEFAULT_DEADLINE = float(os.environ["AI_ASSISTANT_DEADLINE"]) if os.environ.get("AI_ASSISTANT_DEADLINE") else None
+
+# Longest deadline in seconds a client may ask for; longer ones are shortened to it
+MAX_DEADLINE = float(os.environ.get("AI_ASSISTANT_MAX_DEADLINE", "600"))
+
+# Latency percentile of a provider after which the next provider is started
+# in parallel (hedged); unset disables hedging
+HEDGE_PERCENTILE = float(os.environ["AI_ASSISTANT_HEDGE_PERCENTILE"]) if os.environ.get("AI_ASSISTANT_HEDGE_PERCENTILE") else None
+
+Stage = Tuple[str, Optional[str]]
+
+# Starts the stream of a stage, taking (llm_type, model) and returning its events
+StartStream = Callable[[str, Optional[str]], Iterator[Dict[str, Any]]]
+
+
+def fallback_chain(llm_type: str, model: Optional[str] = None,
+                   fallbacks: Optional[List[str]] = None) -> List[Stage]:
+    """
+    Build the ordered list of providers to try for a request
+
+    Args:
+        llm_type: The requested LLM type
+        model: The requested model, or None for the provider default
+        fallbacks: LLM types to fall back to, defaults to ``FALLBACK_CHAIN``
+
+    Returns:
+        List of (llm_type, model) stages starting with the requested one
+    """
+    chain = [(llm_type, model)]
+    seen = {llm_type}
+    for fallback_type in (FALLBACK_CHAIN if fallbacks is None else fallbacks):
+        if fallback_type not in seen:
+            seen.add(fallback_type)
+            chain.append((fallback_type, None))
+    return chain
+
+
+def is_stage_open(stage: Stage) -> bool:
+    """
+    Check whether the circuit breaker of a stage is open, so that calling it would fail at once
+
+    Args:
+        stage: Stage from ``fallback_chain``
+
+    Returns:
+        True if the stage should be skipped; routed stages never are
+    """
+    return stage[0] != AUTO_LLM_TYPE and circuit_breaker.is_open(resolve_llm(*stage))
+
+
+def request_deadline(data: Dict[str, Any]) -> Optional[float]:
+    """
+    Read the request deadline sent by the client
+
+    Args:
+        data: Decoded request body, which may contain ``deadline_ms``
+
+    Returns:
+        Deadline in seconds from now, at most ``MAX_DEADLINE``, or
+        ``DEFAULT_DEADLINE`` if the client sent none
+
+    Raises:
+        BodyError: If ``deadline_ms`` is not a positive number
+    """
+    deadline_ms = data.get("deadline_ms")
+    if deadline_ms is None:
+        return DEFAULT_DEADLINE
+    if isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float, str)):
+        raise BodyError("deadline_ms must be a positive number of milliseconds")
+    try:
+        deadline = float(deadline_ms) / 1000
+    except ValueError:
+        raise BodyError("deadline_ms must be a positive number of milliseconds")
+    if math.isnan(deadline) or deadline <= 0:
+        raise BodyError("deadline_ms must be a positive number of milliseconds")
+    return min(deadline, MAX_DEADLINE)
+
+
+def _pump(start_stream: StartStream, index: int, stage: Stage,
+          events: "queue.Queue[Tuple[int, str, Any]]", cancelled: threading.Event) -> None:
+    """
+    Run the stream of one stage, passing its events on until it ends or is cancelled
+
+    Runs in the request executor. Puts ``(index, "event", event)`` for each
+    event, then ``(index, "error", exception)`` if the stream raised or
+    ``(index, "end", None)``. A cancelled stream is closed, which frees its
+    admission slot and closes the provider response.
+    """
+    try:
+        if cancelled.is_set():
+            return
+        stream = start_stream(*stage)
+        try:
+            for event in stream:
+                if cancelled.is_set():
+                    break
+                events.put((index, "event", event))
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+    except Exception as e:
+        events.put((index, "error", e))
+        return
+    events.put((index, "end", None))
+
+
+def race_stages(chain: List[Stage], start_stream: StartStream,
+                deadline: Optional[float] = None,
+                hedge_percentile: Optional[float] = HEDGE_PERCENTILE
+                ) -> Iterator[Tuple[Optional[Stage], Optional[Dict[str, Any]]]]:
+    """
+    Stream from the stages of a fallback chain until one of them produces output
+
+    A stage that fails before its first output starts the next one
+    immediately. A stage that is still silent also starts the next one in
+    parallel once its share of the remaining deadline (split evenly over the
+    stages left) has passed, or, with hedging, once it exceeds its recent
+    ``hedge_percentile`` latency. The first stage to produce output, or to
+    finish successfully, wins and its events are passed on; once output
+    reached the caller the fallback can no longer take over. The other
+    stages are cancelled: their streams are closed at their next event,
+    which aborts the provider response. A stage still waiting for admission
+    or for its first event notices only then. A stage whose provider is
+    saturated counts as failed. Stages whose circuit breaker is open are
+    skipped, except for the last one. Closing the returned iterator cancels
+    every stage still running.
+
+    Args:
+        chain: Stages from ``fallback_chain``
+        start_stream: Function taking (llm_type, model) and returning the
+            events of ``service.stream_response`` or ``service.stream_fix_errors``
+        deadline: Seconds until the request gives up, None for no limit
+        hedge_percentile: Latency percentile that triggers a hedged call, None to disable
+
+    Yields:
+        Tuples of the winning stage and one of its events. If every stage
+        failed, the final event of the first failure; if the deadline passed
+        first, a final ``(None, None)``.
+
+    Raises:
+        AdmissionRejected: If every stage was rejected by admission control
+    """
+    executor = get_request_executor()
+    start = time.monotonic()
+    deadline_at = start + deadline if deadline else None
+    events: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+    # Cancellation flags of the stages still running, by index in the chain
+    running: Dict[int, threading.Event] = {}
+    winner: Optional[int] = None
+    first_failure: Optional[Tuple[Stage, Dict[str, Any]]] = None
+    rejection: Optional[AdmissionRejected] = None
+    next_stage = 0
+    next_stage_at: Optional[float] = None
+
+    def launch():
+        nonlocal next_stage, next_stage_at
+        while next_stage < len(chain) - 1 and is_stage_open(chain[next_stage]):
+            logger.info(f"Skipping {chain[next_stage][0]}, its circuit breaker is open")
+            next_stage += 1
+        index = next_stage
+        stage = chain[index]
+        next_stage += 1
+        running[index] = threading.Event()
+        executor.submit(_pump, start_stream, index, stage, events, running[index])
+
+        now = time.monotonic()
+        next_stage_at = None
+        if next_stage < len(chain):
+            waits = []
+            if deadline_at is not None:
+                waits.append((deadline_at - now) / (len(chain) - next_stage + 1))
+            # Routed stages have no model of their own to take statistics from
+            if hedge_percentile is not None and stage[0] != AUTO_LLM_TYPE:
+                hedge_after = latency_tracker.percentile(resolve_llm(*stage), hedge_percentile)
+                if hedge_after is not None:
+                    waits.append(hedge_after)
+            if waits:
+                next_stage_at = now + min(waits)
+
+    def cancel_losers():
+        for index, cancelled in running.items():
+            if index != winner:
+                cancelled.set()
+
+    try:
+        launch()
+        while running:
+            wake_times = [t for t in (None if winner is not None else next_stage_at, deadline_at) if t is not None]
+            timeout = max(0.0, min(wake_times) - time.monotonic()) if wake_times else None
+            try:
+                index, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                index, kind, value = None, None, None
+
+            if index is not None:
+                stage = chain[index]
+                if kind != "event":
+                    running.pop(index, None)
+                if index == winner:
+                    if kind == "error":
+                        raise value
+                    if kind == "end":
+                        return
+                    yield stage, value
+                elif winner is None:
+                    if kind == "error":
+                        if not isinstance(value, AdmissionRejected):
+                            raise value
+                        logger.info(f"LLM {stage[0]} rejected the request: {value}")
+                        rejection = rejection or value
+                    elif kind == "event":
+                        if value["type"] == "done" and value.get("error"):
+                            logger.info(f"LLM {stage[0]} failed after {time.monotonic() - start:.2f}s")
+                            first_failure = first_failure or (stage, value)
+                        else:
+                            winner = index
+                            cancel_losers()
+                            yield stage, value
+
+            now = time.monotonic()
+            if deadline_at is not None and now >= deadline_at:
+                logger.info(f"Request deadline of {deadline:.2f}s exceeded")
+                yield None, None
+                return
+
+            if winner is None and next_stage < len(chain):
+                if not running:
+                    launch()
+                elif next_stage_at is not None and now >= next_stage_at:
+                    logger.info(f"Starting {chain[next_stage][0]} in parallel with slower LLMs")
+                    launch()
+
+        if first_failure is None:
+            if rejection is not None:
+                raise rejection
+            return
+        yield first_failure
+    finally:
+        for cancelled in running.values():
+            cancelled.set()
+
+
+def run_with_fallback(chain: List[Stage], start_stream: StartStream,
+                      deadline: Optional[float] = None,
+                      hedge_percentile: Optional[float] = HEDGE_PERCENTILE
+                      ) -> Tuple[Optional[Stage], Optional[Dict[str, Any]]]:
+    """
+    Call the stages of a fallback chain until one succeeds, as ``race_stages`` does
+
+    Args:
+        chain: Stages from ``fallback_chain``
+        start_stream: As for ``race_stages``
+        deadline: Seconds until the request gives up, None for no limit
+        hedge_percentile: Latency percentile that triggers a hedged call, None to disable
+
+    Returns:
+        Tuple of the stage that produced the result and the result, with the
+        fields of its final event. If every stage failed this is the first
+        failure; if the deadline passed first both are None.
+
+    Raises:
+        AdmissionRejected: If every stage was rejected by admission control
+    """
+    events = race_stages(chain, start_stream, deadline, hedge_percentile)
+    try:
+        for stage, event in events:
+            if event is None:
+                break
+            if event["type"] == "done":
+                return stage, {key: value for key, value in event.items() if key != "type"}
+        return None, None
+    finally:
+        events.close()
@@ -1,56 +1,597 @@
-import json
+import asyncio
+import functools
+
 import tornado
-from jupyter_server.base.handlers import APIHandler
-from jupyter_server.utils import url_path_join
+from jupyter_server.base.handlers import APIHandler, JupyterHandler
+from jupyter_server.base.websocket import WebSocketMixin
+from jupyter_server.utils import ensure_async, url_path_join
 import tornado.web
+from tornado.escape import json_encode, utf8
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+
+from . import codec, metrics, service
+from .admission import AdmissionRejected
+from .catalog import model_catalog
+from .conversations import UnknownConversation, request_max_history
+from .jobs import JobLimitExceeded, get_job_manager
+from .llm.base import get_executor
+from .notebook import SavedNotebookIndex, resolve_notebook_cells
+from .streaming import SSE_HEADERS, sse_event
+
+try:
+    from jupyter_server.auth.decorator import ws_authenticated
+except ImportError:
+    # Only in later jupyter_server 2 releases
+    def ws_authenticated(method):
+        """Refuse the WebSocket upgrade of a user who is not logged in with 403"""
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.current_user is None:
+                raise tornado.web.HTTPError(403)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+# Saved notebooks referenced by path in LLM requests
+saved_notebooks = SavedNotebookIndex()
+
+
+class PayloadMetricsMixin:
+    """Record the sizes of request and response bodies in ``metrics.PAYLOAD_BYTES``"""
+    
+    # ``endpoint`` label of the handler's payloads
+    metrics_endpoint = ''
+    
+    _response_bytes = 0
+    
+    def write(self, chunk):
+        """Write a chunk of the response, counting its size"""
+        if not isinstance(chunk, dict):
+            chunk = utf8(chunk)
+            self._response_bytes += len(chunk)
+        else:
+            self._response_bytes += len(utf8(json_encode(chunk)))
+        super().write(chunk)
+    
+    def clear(self):
+        """Reset the response, and its counted size"""
+        super().clear()
+        self._response_bytes = 0
+    
+    def on_finish(self):
+        """Record the payload sizes once the response is sent"""
+        super().on_finish()
+        if self.request.method == 'POST':
+            metrics.PAYLOAD_BYTES.labels(self.metrics_endpoint, 'request').observe(len(self.request.body))
+        metrics.PAYLOAD_BYTES.labels(self.metrics_endpoint, 'response').observe(self._response_bytes)
+
+
+class JSONBodyMixin:
+    """Parse compressed JSON request bodies and compress JSON responses, with the fast codec"""
+    
+    def get_json_body(self):
+        """
+        Parse the JSON request body, undoing a gzip or zstd Content-Encoding
+        
+        Raises:
+            tornado.web.HTTPError: If the body cannot be decoded
+        """
+        try:
+            body = codec.decode_body(self.request.body, self.request.headers.get('Content-Encoding'))
+            return codec.loads(body)
+        except codec.BodyError as e:
+            raise tornado.web.HTTPError(e.status, str(e))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, 'Invalid JSON in body of request') from e
+    
+    def finish_json(self, value):
+        """
+        Finish the response with a JSON body, compressed if the client accepts it
+        
+        Args:
+            value: JSON-serializable response
+        """
+        self.finish_encoded(codec.dumps(value))
+    
+    def finish_encoded(self, body):
+        """
+        Finish the response with an already serialized JSON body, compressed if the client accepts it
+        
+        Args:
+            body: JSON text as UTF-8 bytes
+        """
+        body, encoding = codec.compress(body, self.request.headers.get('Accept-Encoding'))
+        self.set_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.set_header('Content-Encoding', encoding)
+        self.finish(body)
 
-from .llm import get_llm_instance
+
+class AdmissionMixin:
+    """Identify the user for admission control and report rejections"""
+    
+    @property
+    def user_id(self):
+        """Name of the authenticated Jupyter user making the request"""
+        user = self.current_user
+        if isinstance(user, dict):
+            return user.get('name')
+        return getattr(user, 'username', None) or (user if isinstance(user, str) else None)
+    
+    def reject(self, error):
+        """
+        Answer 429 Too Many Requests because a provider is saturated
+        
+        Args:
+            error: The ``AdmissionRejected`` raised for the request
+        """
+        self.clear()
+        self.set_status(429)
+        self.set_header('Retry-After', str(error.retry_after))
+        self.finish(codec.dumps({'message': str(error), 'retry_after': error.retry_after}))
 
 
-class LLMHandler(APIHandler):
+class StreamingMixin(AdmissionMixin):
+    """Write streaming LLM events to the client as Server-Sent Events"""
+    
+    async def write_events(self, events):
+        """
+        Send each event as soon as it is produced, then finish the response
+        
+        Stops consuming ``events`` if the client disconnects, which closes the
+        provider stream. A request rejected by admission control is answered
+        with 429 instead, which happens before the first event.
+        
+        Args:
+            events: Async iterator of events from ``astream_response``/``astream_fix_errors``
+        """
+        for name, value in SSE_HEADERS.items():
+            self.set_header(name, value)
+        try:
+            async for event in events:
+                self.write(sse_event(event))
+                await self.flush()
+        except StreamClosedError:
+            return
+        except AdmissionRejected as e:
+            self.reject(e)
+            return
+        finally:
+            await events.aclose()
+        self.finish()
+
+
+class JobMixin(AdmissionMixin):
+    """Run requests as background jobs the client polls, see ``jobs.JobManager``"""
+    
+    async def submit_job(self, start):
+        """
+        Start a job and answer 202 Accepted with its id, or 429 if the user has too many jobs
+        
+        Args:
+            start: Starts the request and returns its events; called on a job worker
+        """
+        try:
+            job = await asyncio.get_running_loop().run_in_executor(
+                get_executor(), get_job_manager().submit, self.user_id, self.metrics_endpoint, start
+            )
+        except JobLimitExceeded as e:
+            self.set_status(429)
+            self.finish_json({'message': str(e)})
+            return
+        self.set_status(202)
+        self.set_header('Location', url_path_join(self.base_url, 'ai-assistant', 'jobs', job['job_id']))
+        self.finish_json(job)
+
+
+class ChatRequestError(Exception):
+    """A chat request that cannot be answered as sent, with the status and body of the answer"""
+    
+    def __init__(self, status, body):
+        super().__init__(body['message'])
+        self.status = status
+        self.body = body
+
+
+class ChatRequestMixin(AdmissionMixin):
+    """Resolve the notebook and history a chat request refers to"""
+    
+    async def load_saved_cells(self, path):
+        """
+        Get the cells of the saved copy of a notebook, indexed by cell hash
+        
+        Args:
+            path: Notebook path relative to the server root
+            
+        Returns:
+            Mapping of cell hash to compacted cell
+        """
+        model = await ensure_async(self.contents_manager.get(path, content=False, type='notebook'))
+        cells = saved_notebooks.get(path, model['last_modified'])
+        if cells is None:
+            model = await ensure_async(self.contents_manager.get(path, content=True, type='notebook'))
+            # Hashing and compacting every cell of a large notebook would block the event loop
+            cells = await asyncio.get_running_loop().run_in_executor(
+                get_executor(), saved_notebooks.put, path, model['last_modified'], model['content']
+            )
+        return cells
+    
+    async def chat_context(self, data):
+        """
+        Get the notebook and the history of a chat request
+        
+        Args:
+            data: The request body
+            
+        Returns:
+            Tuple of the notebook content and the messages to send with the prompt
+            
+        Raises:
+            ChatRequestError: 400 if ``max_history`` is invalid, 409 if cells
+                sent by hash are not in the saved notebook, 404 if the server
+                does not have the conversation
+        """
+        try:
+            max_history = request_max_history(data)
+        except codec.BodyError as e:
+            raise ChatRequestError(e.status, {'message': str(e)})
+        
+        messages = data.get('messages', [])
+        notebook_content = data.get('notebook_content', {})
+        
+        # Unchanged cells may be sent as hashes of cells in the saved notebook
+        notebook_path = data.get('notebook_path')
+        if notebook_path:
+            saved_cells = await self.load_saved_cells(notebook_path)
+            notebook_content, missing = resolve_notebook_cells(saved_cells, data.get('notebook_cells', []))
+            if missing:
+                raise ChatRequestError(409, {
+                    'message': 'Some cells are not in the saved notebook, send their content instead',
+                    'missing_cells': missing
+                })
+            notebook_content['active_cell_index'] = data.get('active_cell_index')
+        
+        # With a conversation id the server keeps the history, and the
+        # client sends its messages only if the server does not have them
+        conversation_id = data.get('conversation_id')
+        if conversation_id:
+            try:
+                messages = await service.aconversation_history(
+                    self.user_id, conversation_id, data.get('messages'), max_history
+                )
+            except UnknownConversation:
+                raise ChatRequestError(404, {
+                    'message': 'Unknown conversation, send its messages instead',
+                    'unknown_conversation': True
+                })
+        return notebook_content, messages
+
+
+class LLMHandler(PayloadMetricsMixin, JSONBodyMixin, StreamingMixin, JobMixin, ChatRequestMixin, APIHandler):
+    metrics_endpoint = 'chat'
+    
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         """Handle LLM request"""
-        data = json.loads(self.request.body.decode('utf-8'))
+        data = self.get_json_body()
         llm_type = data.get('llm_type', 'openai')
         prompt = data.get('prompt', '')
-        messages = data.get('messages', [])
-        notebook_content = data.get('notebook_content', {})
         
-        llm = get_llm_instance(llm_type)
-        response = llm.generate_response(prompt, messages, notebook_content)
+        try:
+            notebook_content, messages = await self.chat_context(data)
+        except ChatRequestError as e:
+            self.set_status(e.status)
+            self.finish_json(e.body)
+            return
+        
+        model = data.get('model')
+        use_cache = not data.get('no_cache', False)
+        conversation_id = data.get('conversation_id')
+        max_history = request_max_history(data)
+        
+        if data.get('job'):
+            user = self.user_id
+            
+            def start():
+                events = service.stream_response(
+                    llm_type, model, prompt, messages, notebook_content, use_cache, user
+                )
+                if not conversation_id:
+                    return events
+                return service.record_stream(events, llm_type, model, user, conversation_id, prompt, max_history)
+            
+            await self.submit_job(start)
+            return
         
-        self.finish(json.dumps(response))
+        if data.get('stream'):
+            events = service.astream_response(
+                llm_type, model, prompt, messages, notebook_content, use_cache, self.user_id
+            )
+            if conversation_id:
+                events = service.arecord_stream(
+                    events, llm_type, model, self.user_id, conversation_id, prompt, max_history
+                )
+            await self.write_events(events)
+            return
+        
+        try:
+            response = await service.agenerate_response(
+                llm_type, model, prompt, messages, notebook_content, use_cache, self.user_id
+            )
+        except AdmissionRejected as e:
+            self.reject(e)
+            return
+        
+        if conversation_id:
+            await service.arecord_turn(
+                llm_type, model, self.user_id, conversation_id, prompt, response, max_history
+            )
+        self.finish_json(response)
 
 
-class ErrorFixHandler(APIHandler):
+class ErrorFixHandler(PayloadMetricsMixin, JSONBodyMixin, StreamingMixin, JobMixin, APIHandler):
+    metrics_endpoint = 'fix'
+    
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         """Handle error fixing request"""
-        data = json.loads(self.request.body.decode('utf-8'))
+        data = self.get_json_body()
         llm_type = data.get('llm_type', 'openai')
         errors = data.get('errors', [])
         code = data.get('code', '')
         
-        llm = get_llm_instance(llm_type)
-        fixed_code = llm.fix_errors(code, errors)
+        model = data.get('model')
+        use_cache = not data.get('no_cache', False)
+        
+        if data.get('job'):
+            user = self.user_id
+            await self.submit_job(lambda: service.stream_fix_errors(llm_type, model, code, errors, use_cache, user))
+            return
+        
+        if data.get('stream'):
+            await self.write_events(service.astream_fix_errors(
+                llm_type, model, code, errors, use_cache, self.user_id
+            ))
+            return
+        
+        try:
+            response = await service.afix_errors_response(llm_type, model, code, errors, use_cache, self.user_id)
+        except AdmissionRejected as e:
+            self.reject(e)
+            return
+        
+        self.finish_json(response)
+
+
+class BatchErrorFixHandler(PayloadMetricsMixin, JSONBodyMixin, StreamingMixin, APIHandler):
+    metrics_endpoint = 'fix_batch'
+    
+    @tornado.web.authenticated
+    async def post(self):
+        """Handle a request to fix the errors of many cells at once"""
+        data = self.get_json_body()
+        llm_type = data.get('llm_type', 'openai')
+        items = data.get('items', [])
+        
+        model = data.get('model')
+        use_cache = not data.get('no_cache', False)
+        
+        events = service.afix_errors_batch(llm_type, model, items, use_cache, user=self.user_id)
+        if data.get('stream'):
+            await self.write_events(events)
+            return
+        
+        results = [event async for event in events if event['type'] == 'result']
+        
+        self.finish_json({'results': results})
+
+
+class SpeculativeFixHandler(PayloadMetricsMixin, JSONBodyMixin, APIHandler):
+    metrics_endpoint = 'speculative'
+    
+    @tornado.web.authenticated
+    async def post(self):
+        """Start fixing the errors of a cell that just failed, so the fix is ready when asked for"""
+        data = self.get_json_body()
+        status = await service.aspeculate_fix(
+            data.get('llm_type', 'openai'), data.get('model'), data.get('code', ''),
+            data.get('errors', []), self.user_id
+        )
+        self.set_status(202)
+        self.finish_json({'status': status})
+
+
+class JobHandler(JSONBodyMixin, StreamingMixin, APIHandler):
+    
+    def get_offset(self):
+        """Length of the job output the client already has, from the ``offset`` argument"""
+        try:
+            return max(0, int(self.get_argument('offset', '0')))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'offset must be an integer')
+    
+    def finish_job(self, job):
+        """Answer with a job snapshot, or 404 if the job is unknown or expired"""
+        if job is None:
+            self.set_status(404)
+            self.finish_json({'message': 'Unknown job'})
+            return
+        self.finish_json(job)
+    
+    @tornado.web.authenticated
+    async def get(self, job_id):
+        """
+        Return the progress of a job past ``offset``, waiting up to ``wait``
+        seconds for some, or follow it as Server-Sent Events with ``stream``
+        """
+        offset = self.get_offset()
+        jobs = get_job_manager()
+        if self.get_argument('stream', None) or 'text/event-stream' in self.request.headers.get('Accept', ''):
+            await self.write_events(jobs.aevents(self.user_id, job_id, offset))
+            return
+        
+        try:
+            wait = float(self.get_argument('wait', '0'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'wait must be a number')
+        self.finish_job(await jobs.await_progress(self.user_id, job_id, offset, wait))
+    
+    @tornado.web.authenticated
+    async def delete(self, job_id):
+        """Cancel a job"""
+        self.finish_job(await asyncio.get_running_loop().run_in_executor(
+            get_executor(), get_job_manager().cancel, self.user_id, job_id
+        ))
+
+
+class AssistantSocketHandler(WebSocketMixin, WebSocketHandler, ChatRequestMixin, JupyterHandler):
+    """
+    Chat and error fixing requests multiplexed over one WebSocket
+    
+    The client sends ``{"id", "type": "chat" | "fix", ...}`` messages with
+    the fields of a POST to ``/llm`` or ``/fix-error``, and
+    ``{"id", "type": "cancel"}`` to stop a request. The server answers with
+    the request's streaming events tagged with its ``id``; a request that
+    cannot be answered ends with an ``error`` event carrying the HTTP status
+    of the equivalent POST, and a cancelled one with a ``cancelled`` event.
+    Cancelling a request, or closing the connection, cancels its task, which
+    closes the provider stream and so aborts the upstream call.
+    """
+    
+    def initialize(self):
+        """Start with no requests in flight"""
+        self._requests = {}
+    
+    def set_default_headers(self):
+        """Skip the headers of ``JupyterHandler``, which do not apply to WebSockets"""
+    
+    @ws_authenticated
+    async def get(self, *args, **kwargs):
+        """Upgrade the connection to a WebSocket"""
+        await super().get(*args, **kwargs)
+    
+    def on_message(self, message):
+        """Start or cancel a request"""
+        try:
+            data = codec.loads(message)
+            if not isinstance(data, dict):
+                raise ValueError('Expected an object')
+        except ValueError:
+            self.send_event(None, {'type': 'error', 'status': 400, 'message': 'Invalid JSON in message'})
+            return
+        request_id = data.get('id')
+        kind = data.get('type')
+        if not isinstance(request_id, (str, int)):
+            self.send_event(None, {'type': 'error', 'status': 400, 'message': 'Expected a string or integer id'})
+            return
+        
+        if kind == 'cancel':
+            task = self._requests.get(request_id)
+            if task is not None:
+                task.cancel()
+            return
+        if kind not in ('chat', 'fix') or request_id in self._requests:
+            self.send_event(request_id, {
+                'type': 'error', 'status': 400,
+                'message': 'Expected a chat, fix or cancel message with an id not in use'
+            })
+            return
         
-        self.finish(json.dumps({'fixed_code': fixed_code}))
+        task = asyncio.ensure_future(self.answer(request_id, kind, data))
+        self._requests[request_id] = task
+        task.add_done_callback(lambda _: self._requests.pop(request_id, None))
+    
+    async def request_events(self, kind, data):
+        """
+        Start a request
+        
+        Args:
+            kind: ``chat`` or ``fix``
+            data: The request message
+            
+        Returns:
+            Async iterator of its streaming events
+            
+        Raises:
+            ChatRequestError: If a chat request cannot be answered as sent
+        """
+        llm_type = data.get('llm_type', 'openai')
+        model = data.get('model')
+        use_cache = not data.get('no_cache', False)
+        if kind == 'fix':
+            return service.astream_fix_errors(
+                llm_type, model, data.get('code', ''), data.get('errors', []), use_cache, self.user_id
+            )
+        
+        prompt = data.get('prompt', '')
+        notebook_content, messages = await self.chat_context(data)
+        events = service.astream_response(
+            llm_type, model, prompt, messages, notebook_content, use_cache, self.user_id
+        )
+        if data.get('conversation_id'):
+            events = service.arecord_stream(
+                events, llm_type, model, self.user_id, data['conversation_id'], prompt,
+                request_max_history(data)
+            )
+        return events
+    
+    async def answer(self, request_id, kind, data):
+        """Stream the events of a request to the client; runs as the request's task"""
+        try:
+            events = await self.request_events(kind, data)
+            try:
+                async for event in events:
+                    self.send_event(request_id, event)
+            finally:
+                await events.aclose()
+        except ChatRequestError as e:
+            self.send_event(request_id, {'type': 'error', 'status': e.status, **e.body})
+        except AdmissionRejected as e:
+            self.send_event(request_id, {
+                'type': 'error', 'status': 429, 'message': str(e), 'retry_after': e.retry_after
+            })
+        except asyncio.CancelledError:
+            metrics.CANCELLED.labels(kind).inc()
+            self.send_event(request_id, {'type': 'cancelled'})
+            raise
+        except Exception as e:
+            self.log.error(f"AI assistant {kind} request failed: {e}")
+            self.send_event(request_id, {'type': 'error', 'status': 500, 'message': str(e)})
+    
+    def send_event(self, request_id, event):
+        """Send an event of a request, unless the connection is closed"""
+        try:
+            self.write_message(codec.dumps({'id': request_id, **event}).decode('utf-8'))
+        except WebSocketClosedError:
+            pass
+    
+    def on_close(self):
+        """Cancel the requests still in flight, which aborts their provider calls"""
+        for task in list(self._requests.values()):
+            task.cancel()
+
+
+class LLMConfigHandler(JSONBodyMixin, APIHandler):
+    _etag = None
+    
+    def compute_etag(self):
+        """ETag of the model catalog, which ``finish`` compares with If-None-Match to answer 304"""
+        return self._etag
+    
+    @tornado.web.authenticated
+    async def get(self):
+        """Return the models of every provider from the model catalog"""
+        body, self._etag = await model_catalog.asnapshot()
+        self.set_header('Cache-Control', 'no-cache')
+        self.finish_encoded(body)
 
 
-class LLMConfigHandler(APIHandler):
+class MetricsHandler(JupyterHandler):
     @tornado.web.authenticated
     def get(self):
-        """Return LLM configuration"""
-        config = {
-            'available_models': [
-                {'id': 'openai', 'name': 'OpenAI ChatGPT', 'default_model': 'gpt-4o'},
-                {'id': 'anthropic', 'name': 'Anthropic Claude', 'default_model': 'claude-3-5-sonnet-20241022'},
-                {'id': 'gemini', 'name': 'Google Gemini', 'default_model': 'gemini-pro'},
-                {'id': 'ollama', 'name': 'Ollama', 'default_model': 'llama3', 'local': True}
-            ]
-        }
-        self.finish(json.dumps(config))
+        """Return the assistant's metrics in the Prometheus text format"""
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.finish(metrics.render())
 
 
 def setup_handlers(web_app):
@@ -61,7 +602,12 @@ def setup_handlers(web_app):
     handlers = [
         (url_path_join(base_url, "ai-assistant", "llm"), LLMHandler),
         (url_path_join(base_url, "ai-assistant", "fix-error"), ErrorFixHandler),
-        (url_path_join(base_url, "ai-assistant", "config"), LLMConfigHandler)
+        (url_path_join(base_url, "ai-assistant", "fix-errors"), BatchErrorFixHandler),
+        (url_path_join(base_url, "ai-assistant", "speculate-fix"), SpeculativeFixHandler),
+        (url_path_join(base_url, "ai-assistant", "jobs", r"([^/]+)"), JobHandler),
+        (url_path_join(base_url, "ai-assistant", "ws"), AssistantSocketHandler),
+        (url_path_join(base_url, "ai-assistant", "config"), LLMConfigHandler),
+        (url_path_join(base_url, "ai-assistant", "metrics"), MetricsHandler)
     ]
     
     web_app.add_handlers(host_pattern, handlers)
@@ -0,0 +1,529 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+from . import metrics
+from .admission import AdmissionRejected
+from .cache import CACHE_DIR
+from .llm.base import get_executor
+
+logger = logging.getLogger(__name__)
+
+# Jobs generating at once; further jobs wait for a worker
+JOB_WORKERS = int(os.environ.get("AI_ASSISTANT_JOB_WORKERS", "4"))
+
+# Seconds a job is kept after its last progress
+JOB_TTL = float(os.environ.get("AI_ASSISTANT_JOB_TTL", "900"))
+
+# Size limit of the stored output of jobs; the oldest finished jobs are dropped beyond it
+JOB_STORE_BYTES = int(float(os.environ.get("AI_ASSISTANT_JOB_STORE_MB", "32")) * 1024 * 1024)
+
+# Unfinished jobs each user may have
+USER_JOBS = int(os.environ.get("AI_ASSISTANT_USER_JOBS", "4"))
+
+# Longest a poll waits for progress, below gunicorn's default 30 s worker timeout
+MAX_POLL_WAIT = 25.0
+
+# Seconds between writes of a running job's partial output to disk
+_FLUSH_SECONDS = 0.5
+
+# Seconds between reads of a job running in another process while waiting for progress
+_POLL_SECONDS = 0.25
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+_FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobLimitExceeded(Exception):
+    """Raised when a user submits a job while they have too many unfinished ones"""
+
+
+class _Job:
+    """A job submitted to this process"""
+
+    __slots__ = ("id", "user", "endpoint", "status", "content", "result", "updated",
+                 "cancelled", "changed", "future", "flushed_at")
+
+    def __init__(self, job_id: str, user: str, endpoint: str):
+        self.id = job_id
+        self.user = user
+        self.endpoint = endpoint
+        self.status = QUEUED
+        self.content = ""
+        self.result: Optional[Dict[str, Any]] = None
+        self.updated = time.time()
+        self.cancelled = False
+        # Resolved and replaced on every change, for waiting pollers
+        self.changed: Future = Future()
+        self.future: Optional[Future] = None
+        self.flushed_at = 0.0
+
+    def record(self) -> Dict[str, Any]:
+        """The job's state as stored; the manager's lock must be held"""
+        return {"id": self.id, "user": self.user, "endpoint": self.endpoint, "status": self.status,
+                "content": self.content, "result": self.result, "updated": self.updated}
+
+
+def _snapshot(record: Dict[str, Any], offset: int) -> Dict[str, Any]:
+    """
+    Build the answer to a poll
+
+    Args:
+        record: The job's state
+        offset: Length of the output the client already has
+
+    Returns:
+        Dict with the job's ``job_id``, ``status``, the output past ``offset``
+        under ``content``, the length of the output under ``offset``, and once
+        it finished, the fields of the request's final event under ``result``
+    """
+    snapshot = {
+        "job_id": record["id"],
+        "status": record["status"],
+        "content": record["content"][max(0, offset):],
+        "offset": len(record["content"])
+    }
+    if record["status"] in _FINISHED:
+        snapshot["result"] = record["result"]
+    return snapshot
+
+
+class JobManager:
+    """
+    Generations run in the background, with their progress kept for clients to poll
+
+    A job consumes the events of a streamed chat or error fixing request on
+    the manager's own worker pool, so it is bound neither by the lifetime of
+    the HTTP request nor by a server worker timeout. It collects the text of
+    the deltas and the fields of the final event. Clients poll for the text
+    past the offset they already have, waiting for progress up to
+    ``MAX_POLL_WAIT``, or subscribe to it as events, and may cancel the job.
+
+    Progress is written to an SQLite database in WAL mode, at most every
+    ``_FLUSH_SECONDS`` while the job runs, so every process using the same
+    cache directory can answer polls, such as the other gunicorn workers.
+    Pollers of a job running in this process are woken at once. Jobs are
+    dropped ``ttl`` seconds after their last progress, and the oldest
+    finished ones once the stored output exceeds ``store_bytes``. If the
+    database is unavailable, jobs are kept in memory only. Thread-safe.
+    """
+
+    def __init__(self, path: Optional[str] = None, workers: int = JOB_WORKERS, ttl: float = JOB_TTL,
+                 store_bytes: int = JOB_STORE_BYTES, user_jobs: int = USER_JOBS):
+        """
+        Initialize the manager
+
+        Args:
+            path: SQLite database file, None to keep jobs in memory only
+            workers: Jobs running at once
+            ttl: Seconds a job is kept after its last progress
+            store_bytes: Size limit of the stored output
+            user_jobs: Unfinished jobs each user may have
+        """
+        self.path = path
+        self.workers = workers
+        self.ttl = ttl
+        self.store_bytes = store_bytes
+        self.user_jobs = user_jobs
+
+        # Jobs submitted to this process, oldest first
+        self._jobs: "OrderedDict[str, _Job]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._connection().execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "id TEXT PRIMARY KEY, user TEXT NOT NULL, endpoint TEXT NOT NULL, status TEXT NOT NULL, "
+                    "content TEXT NOT NULL, result TEXT, cancelled INTEGER NOT NULL DEFAULT 0, "
+                    "size INTEGER NOT NULL, expires_at REAL NOT NULL)"
+                )
+            except Exception as e:
+                logger.warning(f"Job store at {path} is unavailable, using memory only: {e}")
+                self.path = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get this thread's connection to the database"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Get the worker pool, creating it on first use"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="ai-assistant-job")
+            return self._executor
+
+    def submit(self, user: Optional[str], endpoint: str,
+               start: Callable[[], Iterator[Dict[str, Any]]]) -> Dict[str, Any]:
+        """
+        Start a job
+
+        Args:
+            user: Who submits the job; only they can see it
+            endpoint: Kind of request, e.g. ``chat`` or ``fix``, for the metrics
+            start: Starts the request and returns its events, as
+                ``service.stream_response`` does; called on a worker
+
+        Returns:
+            Snapshot of the job, see ``get``
+
+        Raises:
+            JobLimitExceeded: If the user has ``user_jobs`` unfinished jobs
+        """
+        job = _Job(secrets.token_urlsafe(16), user or "", endpoint)
+        with self._lock:
+            unfinished = sum(1 for other in self._jobs.values()
+                             if other.user == job.user and other.status not in _FINISHED)
+            if unfinished >= self.user_jobs:
+                raise JobLimitExceeded(f"{unfinished} jobs are still running, wait for one to finish")
+            self._jobs[job.id] = job
+            record = job.record()
+        self._write(record)
+        job.future = self._get_executor().submit(self._run, job, start)
+        return _snapshot(record, 0)
+
+    def _run(self, job: _Job, start: Callable[[], Iterator[Dict[str, Any]]]) -> None:
+        """Run a job to completion; runs on a worker"""
+        if job.cancelled:
+            self._finish(job, CANCELLED, None)
+            return
+        self._update(job, status=RUNNING)
+
+        status, result = FAILED, None
+        events = None
+        try:
+            events = start()
+            for event in events:
+                if job.cancelled:
+                    status = CANCELLED
+                    break
+                if event["type"] == "delta":
+                    self._update(job, content=event.get("content", ""))
+                elif event["type"] == "done":
+                    status, result = DONE, {k: v for k, v in event.items() if k != "type"}
+        except AdmissionRejected as e:
+            result = {"error": True, "message": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            logger.warning(f"Job {job.id} failed: {e}")
+            result = {"error": True, "message": str(e)}
+        finally:
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+        self._finish(job, status, result)
+
+    def _update(self, job: _Job, status: Optional[str] = None, content: str = "") -> None:
+        """Record progress of a running job, writing it to disk at most every ``_FLUSH_SECONDS``"""
+        with self._lock:
+            if status is not None:
+                job.status = status
+            job.content += content
+            job.updated = time.time()
+            changed, job.changed = job.changed, Future()
+            flush = status is not None or time.monotonic() - job.flushed_at >= _FLUSH_SECONDS
+            if flush:
+                job.flushed_at = time.monotonic()
+                record = job.record()
+        changed.set_result(None)
+        # Another process may have asked to cancel it
+        if flush and not self._write(record, running=True):
+            job.cancelled = True
+
+    def _finish(self, job: _Job, status: str, result: Optional[Dict[str, Any]]) -> None:
+        """Record the end of a job and drop expired jobs"""
+        with self._lock:
+            job.status = status
+            job.result = result
+            job.updated = time.time()
+            changed, job.changed = job.changed, Future()
+            record = job.record()
+        changed.set_result(None)
+        self._write(record)
+        metrics.JOBS.labels(job.endpoint, status).inc()
+        self._evict()
+
+    def _write(self, record: Dict[str, Any], running: bool = False) -> bool:
+        """
+        Store a job's state on disk
+
+        Args:
+            record: The job's state
+            running: Whether the job is running, in which case the state is
+                not written if the job was cancelled
+
+        Returns:
+            False if the job was cancelled meanwhile
+        """
+        if not self.path:
+            return True
+        result = json.dumps(record["result"]) if record["result"] is not None else None
+        size = len(record["content"]) + len(result or "")
+        try:
+            cursor = self._connection().execute(
+                "INSERT INTO jobs (id, user, endpoint, status, content, result, size, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET status = excluded.status, "
+                "content = excluded.content, result = excluded.result, size = excluded.size, "
+                "expires_at = excluded.expires_at WHERE NOT (? AND jobs.cancelled)",
+                (record["id"], record["user"], record["endpoint"], record["status"], record["content"],
+                 result, size, record["updated"] + self.ttl, running)
+            )
+            return cursor.rowcount == 1
+        except Exception as e:
+            logger.warning(f"Job store write failed: {e}")
+            return True
+
+    def _evict(self) -> None:
+        """Drop expired jobs, then the oldest finished ones while the stored output is too large"""
+        now = time.time()
+        with self._lock:
+            # Unfinished jobs are kept however old, they are still making progress
+            finished = [job for job in self._jobs.values() if job.status in _FINISHED]
+            size = sum(len(job.content) + len(json.dumps(job.result or {})) for job in finished)
+            for job in finished:
+                if job.updated + self.ttl > now and size <= self.store_bytes:
+                    break
+                size -= len(job.content) + len(json.dumps(job.result or {}))
+                del self._jobs[job.id]
+        if not self.path:
+            return
+
+        try:
+            connection = self._connection()
+            connection.execute("DELETE FROM jobs WHERE expires_at <= ?", (now,))
+            size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM jobs").fetchone()[0]
+            if size <= self.store_bytes:
+                return
+            dropped = []
+            for job_id, job_size in connection.execute(
+                "SELECT id, size FROM jobs WHERE status IN (?, ?, ?) ORDER BY expires_at", _FINISHED
+            ):
+                if size <= self.store_bytes:
+                    break
+                dropped.append((job_id,))
+                size -= job_size
+            connection.executemany("DELETE FROM jobs WHERE id = ?", dropped)
+        except Exception as e:
+            logger.warning(f"Dropping old jobs failed: {e}")
+
+    def _load(self, user: Optional[str], job_id: str) -> Optional[Dict[str, Any]]:
+        """Read a job's state, from memory if it was submitted to this process"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                # Finished jobs stay in memory until the next eviction, but expire on time
+                expired = job.status in _FINISHED and job.updated + self.ttl <= time.time()
+                return job.record() if job.user == (user or "") and not expired else None
+        if not self.path:
+            return None
+        try:
+            row = self._connection().execute(
+                "SELECT endpoint, status, content, result, expires_at FROM jobs WHERE id = ? AND user = ?",
+                (job_id, user or "")
+            ).fetchone()
+        except Exception as e:
+            logger.warning(f"Job store read failed: {e}")
+            return None
+        if row is None or row[4] <= time.time():
+            return None
+        endpoint, status, content, result, _ = row
+        return {"id": job_id, "user": user or "", "endpoint": endpoint, "status": status,
+                "content": content, "result": json.loads(result) if result is not None else None}
+
+    def get(self, user: Optional[str], job_id: str, offset: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job
+
+        Args:
+            user: Who asks; other users' jobs are not found
+            job_id: Id returned by ``submit``
+            offset: Length of the output the client already has
+
+        Returns:
+            Snapshot of the job, see ``_snapshot``, or None if it is unknown or expired
+        """
+        record = self._load(user, job_id)
+        return _snapshot(record, offset) if record is not None else None
+
+    def _changed(self, job_id: str) -> Optional[Future]:
+        """Future resolved on the next change of a job running in this process, None for other jobs"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.changed if job is not None and job.status not in _FINISHED else None
+
+    def wait(self, user: Optional[str], job_id: str, offset: int = 0,
+             timeout: float = MAX_POLL_WAIT) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job once it made progress past ``offset``, finished, or ``timeout`` passed
+
+        Args:
+            user: Who asks
+            job_id: Id returned by ``submit``
+            offset: Length of the output the client already has
+            timeout: Seconds to wait, at most ``MAX_POLL_WAIT``
+
+        Returns:
+            As ``get``
+        """
+        deadline = time.monotonic() + min(max(0.0, timeout), MAX_POLL_WAIT)
+        while True:
+            changed = self._changed(job_id)
+            snapshot = self.get(user, job_id, offset)
+            remaining = deadline - time.monotonic()
+            if snapshot is None or snapshot["status"] in _FINISHED or snapshot["offset"] > offset or remaining <= 0:
+                return snapshot
+            if changed is not None:
+                try:
+                    changed.result(remaining)
+                except FutureTimeoutError:
+                    pass
+            else:
+                time.sleep(min(_POLL_SECONDS, remaining))
+
+    async def await_progress(self, user: Optional[str], job_id: str, offset: int = 0,
+                             timeout: float = MAX_POLL_WAIT) -> Optional[Dict[str, Any]]:
+        """Async version of ``wait``; jobs of other processes are read in the executor"""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + min(max(0.0, timeout), MAX_POLL_WAIT)
+        while True:
+            changed = self._changed(job_id)
+            if changed is not None or not self.path:
+                snapshot = self.get(user, job_id, offset)
+            else:
+                snapshot = await loop.run_in_executor(get_executor(), self.get, user, job_id, offset)
+            remaining = deadline - time.monotonic()
+            if snapshot is None or snapshot["status"] in _FINISHED or snapshot["offset"] > offset or remaining <= 0:
+                return snapshot
+            if changed is not None:
+                try:
+                    await asyncio.wait_for(asyncio.wrap_future(changed), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(min(_POLL_SECONDS, remaining))
+
+    def events(self, user: Optional[str], job_id: str, offset: int = 0) -> Iterator[Dict[str, Any]]:
+        """
+        Follow a job as streaming events
+
+        Args:
+            user: Who asks
+            job_id: Id returned by ``submit``
+            offset: Length of the output the client already has
+
+        Yields:
+            ``{"type": "delta", "content": ...}`` events with the output past
+            ``offset``, then one ``{"type": "done", ...}`` event with the
+            job's result, or with ``error`` set if it failed, was cancelled or expired
+        """
+        while True:
+            snapshot = self.wait(user, job_id, offset)
+            if snapshot is None:
+                yield {"type": "done", "error": True, "message": "Unknown job"}
+                return
+            event = self._progress(snapshot)
+            if event is not None:
+                yield event
+            offset = snapshot["offset"]
+            if snapshot["status"] in _FINISHED:
+                yield self._done(snapshot)
+                return
+
+    async def aevents(self, user: Optional[str], job_id: str, offset: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of ``events``"""
+        while True:
+            snapshot = await self.await_progress(user, job_id, offset)
+            if snapshot is None:
+                yield {"type": "done", "error": True, "message": "Unknown job"}
+                return
+            event = self._progress(snapshot)
+            if event is not None:
+                yield event
+            offset = snapshot["offset"]
+            if snapshot["status"] in _FINISHED:
+                yield self._done(snapshot)
+                return
+
+    @staticmethod
+    def _progress(snapshot: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Delta event of the new output in a snapshot, if there is any"""
+        return {"type": "delta", "content": snapshot["content"]} if snapshot["content"] else None
+
+    @staticmethod
+    def _done(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+        """Final event of a finished job"""
+        if snapshot["result"] is not None:
+            return {"type": "done", **snapshot["result"]}
+        return {"type": "done", "error": True, "message": f"Job {snapshot['status']}"}
+
+    def cancel(self, user: Optional[str], job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Stop a job; its output so far is kept
+
+        A job running in another process stops at its next write to disk.
+
+        Args:
+            user: Who asks; only the job's owner can cancel it
+            job_id: Id returned by ``submit``
+
+        Returns:
+            Snapshot of the job, or None if it is unknown or expired
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.user != (user or ""):
+                return None
+        if job is not None:
+            job.cancelled = True
+            # A job still waiting for a worker never starts
+            if job.future is not None and job.future.cancel():
+                self._finish(job, CANCELLED, None)
+        elif self.path:
+            try:
+                self._connection().execute(
+                    "UPDATE jobs SET cancelled = 1 WHERE id = ? AND user = ? AND status NOT IN (?, ?, ?)",
+                    (job_id, user or "", *_FINISHED)
+                )
+            except Exception as e:
+                logger.warning(f"Job store write failed: {e}")
+        return self.get(user, job_id)
+
+
+_job_manager: Optional[JobManager] = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """
+    Get the process-wide job manager
+
+    Returns:
+        JobManager backed by ``jobs.sqlite3`` in ``CACHE_DIR``
+    """
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(os.path.join(CACHE_DIR, "jobs.sqlite3"))
+        return _job_manager
@@ -1,27 +1,136 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from ..circuit import circuit_breaker
 from .base import BaseLLM
-from .openai import OpenAILLM
-from .anthropic import AnthropicLLM
-from .gemini import GeminiLLM
-from .ollama import OllamaLLM
+from .registry import ENTRY_POINT_GROUP, ProviderRegistry, UnavailableLLM, provider_registry
+from .router import AUTO_LLM_TYPE, choose_model
+
+# Provider classes importable from this package, loaded with their SDK on first access
+_PROVIDER_CLASSES = {
+    'OpenAILLM': 'openai',
+    'AnthropicLLM': 'anthropic',
+    'GeminiLLM': 'gemini',
+    'OllamaLLM': 'ollama',
+}
+
+# Most LLM instances kept; requests name any model they like, so the least
+# recently used instances are dropped beyond this
+MAX_LLM_INSTANCES = int(os.environ.get("AI_ASSISTANT_MAX_LLM_INSTANCES", "32"))
+
+# Process-wide instances keyed by (llm_type, model), shared by all request
+# handlers, least recently used first
+_instances: "OrderedDict[Tuple[str, str], BaseLLM]" = OrderedDict()
+_instances_lock = threading.Lock()
+
+
+def resolve_llm(llm_type: str, model: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Resolve the provider and model a request for an explicit LLM type goes to
+
+    Does not import the provider unless it is a third-party one registered
+    without a default model.
+
+    Args:
+        llm_type: The type of LLM, unknown types map to OpenAI
+        model: The model to use, defaults to the provider's default model
+
+    Returns:
+        Tuple of LLM type and model, as used to key instances and statistics
+    """
+    if llm_type not in provider_registry:
+        # Default to OpenAI if type is not recognized
+        llm_type = 'openai'
+    return llm_type, model or provider_registry.default_model(llm_type)
+
+
+def is_provider_loaded(llm_type: str) -> bool:
+    """
+    Check whether creating an instance of an LLM type is cheap, because its provider is imported
 
-def get_llm_instance(llm_type: str) -> BaseLLM:
+    Args:
+        llm_type: The type of LLM; ``auto`` counts as not loaded
+
+    Returns:
+        True if ``get_llm_instance`` will not import a provider SDK
+    """
+    return llm_type != AUTO_LLM_TYPE and provider_registry.is_loaded(resolve_llm(llm_type)[0])
+
+
+def get_llm_instance(llm_type: str, model: Optional[str] = None,
+                     task: str = "chat", prompt_tokens: int = 0) -> BaseLLM:
     """
     Factory function to get LLM instance based on the type
-    
+
+    Instances are created once per provider and model and reused for later
+    requests, so SDK clients and their connection pools are shared. At most
+    ``MAX_LLM_INSTANCES`` are kept, dropping the least recently used. An
+    instance is rebuilt when its API key changes in the environment.
+    Providers are imported on first use, see ``provider_registry``; one that
+    fails to import yields an ``UnavailableLLM``, so requests get an error
+    response saying why.
+
+    The ``auto`` type picks the provider and model per request with
+    ``choose_model``, based on the task, the prompt size, the recent
+    latency and error rate of each model and whether it still has to be
+    loaded. Models whose circuit breaker is open are left out.
+
     Args:
-        llm_type: The type of LLM to initialize
-        
+        llm_type: The type of LLM to initialize, or ``auto``
+        model: The model to use, defaults to the provider's default model
+        task: ``"chat"`` or ``"fix"``, used by ``auto``
+        prompt_tokens: Estimated prompt size, used by ``auto``
+
     Returns:
         BaseLLM: An instance of the requested LLM
     """
-    if llm_type == 'openai':
-        return OpenAILLM()
-    elif llm_type == 'anthropic':
-        return AnthropicLLM()
-    elif llm_type == 'gemini':
-        return GeminiLLM()
-    elif llm_type == 'ollama':
-        return OllamaLLM()
-    else:
-        # Default to OpenAI if type is not recognized
-        return OpenAILLM()
+    if llm_type == AUTO_LLM_TYPE:
+        llm_type, model = choose_model(
+            task, prompt_tokens,
+            lambda candidate_type, candidate_model: (
+                get_llm_instance(candidate_type, candidate_model).unavailable_reason() is None
+                and not circuit_breaker.is_open(resolve_llm(candidate_type, candidate_model))
+            ),
+            startup_delay=lambda candidate_type, candidate_model: (
+                get_llm_instance(candidate_type, candidate_model).startup_delay()
+            )
+        )
+
+    key = resolve_llm(llm_type, model)
+    # Import the provider before taking the lock, which requests for other providers need meanwhile
+    provider_registry.get(key[0])
+    with _instances_lock:
+        llm = _instances.get(key)
+        if llm is not None and not llm.is_stale():
+            _instances.move_to_end(key)
+            return llm
+
+    # Built without holding the lock, so requests for other models do not
+    # wait for a constructor; of concurrent builds the first one stored wins
+    created = provider_registry.create(key[0], key[1])
+    with _instances_lock:
+        llm = _instances.get(key)
+        if llm is None or llm.is_stale():
+            llm = _instances[key] = created
+        _instances.move_to_end(key)
+        while len(_instances) > MAX_LLM_INSTANCES:
+            _instances.popitem(last=False)
+        return llm
+
+
+def clear_llm_instances() -> None:
+    """Drop all cached LLM instances so they are recreated on next use"""
+    with _instances_lock:
+        _instances.clear()
+
+
+def __getattr__(name: str) -> Any:
+    """Import provider classes such as ``OpenAILLM`` on first access"""
+    if name in _PROVIDER_CLASSES:
+        provider = provider_registry.get(_PROVIDER_CLASSES[name])
+        if provider is None:
+            raise ImportError(provider_registry.load_error(_PROVIDER_CLASSES[name]))
+        return provider
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,9 +1,9 @@
-import os
-import json
 import logging
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, AsyncIterator, Iterator, Optional
 import anthropic
 from .base import BaseLLM
+from .prompt import token_usage
+from .retry import error_status
 
 logger = logging.getLogger(__name__)
 
@@ -12,191 +12,235 @@ class AnthropicLLM(BaseLLM):
     """
     Anthropic Claude LLM implementation
     """
-    
-    def __init__(self):
+
+    # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
+    # do not change this unless explicitly requested by the user
+    default_model = "claude-3-5-sonnet-20241022"
+    llm_type = "anthropic"
+    provider_name = "Anthropic"
+    api_key_env = "ANTHROPIC_API_KEY"
+
+    def __init__(self, model: Optional[str] = None):
         """Initialize the Anthropic client"""
-        # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
-        # do not change this unless explicitly requested by the user
-        self.model = "claude-3-5-sonnet-20241022"
+        super().__init__(model)
         self.api_key_error = None
-        
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        if not api_key:
+        self._async_client = None
+
+        if not self.api_key:
             self.client = None
             self.api_key_error = "Anthropic API key is not set. Please provide a valid API key in the settings."
         else:
             try:
-                # Initialize the Anthropic client with the API key
-                self.client = anthropic.Anthropic(api_key=api_key)
-                
-                # We'll validate the API key by making a small test request
-                try:
-                    # Make a minimal request to test authentication
-                    # Use a try-except block as we're just testing if the API key works
-                    self.client.messages.create(
-                        model=self.model,
-                        max_tokens=10,
-                        messages=[{"role": "user", "content": "Hello"}],
-                    )
-                except Exception as validation_error:
-                    if "401" in str(validation_error) or "unauthorized" in str(validation_error).lower():
-                        self.client = None
-                        self.api_key_error = "Invalid Anthropic API key. Please check your API key and try again."
-                    else:
-                        # Other errors might be temporary or not related to authentication
-                        self.api_key_error = f"API connection error: {str(validation_error)}"
+                # The key is validated by the first real request rather than a
+                # separate test call, see _on_request_error(); failed
+                # requests are retried by BaseLLM
+                self.client = anthropic.Anthropic(api_key=self.api_key, max_retries=0)
             except Exception as init_error:
                 self.client = None
                 self.api_key_error = f"Failed to initialize Anthropic client: {str(init_error)}"
-    
-    def generate_response(self, prompt: str, messages: List[Dict[str, Any]], 
-                         notebook_content: Dict[str, Any]) -> Dict[str, Any]:
+
+    @property
+    def async_client(self) -> anthropic.AsyncAnthropic:
+        """Async client, created on first use since only the Jupyter server extension needs it"""
+        if self._async_client is None:
+            self._async_client = anthropic.AsyncAnthropic(api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    def unavailable_reason(self) -> Optional[str]:
         """
-        Generate a response from Anthropic Claude
-        
-        Args:
-            prompt: Current prompt/question from the user
-            messages: Chat history
-            notebook_content: Content of the notebook including code cells and outputs
-            
+        Explain why this LLM cannot serve requests
+
         Returns:
-            Dict with LLM response
+            Error message, or None if the client is configured
         """
         # Check if client is None (API key not set or invalid)
         if self.client is None:
-            error_message = self.api_key_error or "Error: Anthropic API key is not set or is invalid. Please provide a valid API key in the settings."
-            return {
-                "content": error_message,
-                "has_code": False,
-                "model": self.model,
-                "provider": "Anthropic",
-                "error": True
-            }
-            
-        # Format notebook content
-        notebook_context = self.format_notebook_context(notebook_content)
-        
-        # Prepare the system message with instructions
-        system_prompt = (
-            "You are an expert coding assistant in JupyterLab. You have access to the current notebook "
-            "content and chat history. Provide helpful, concise responses to code-related questions. "
-            "When providing code suggestions, ensure they are correct, well-documented, and follow best practices. "
-            "You can reference specific cells from the notebook in your responses. "
-            "For code suggestions, wrap the code in ```python and ``` tags."
-        )
-        
-        # Format Claude messages
+            return self.api_key_error or "Anthropic API key is not set or is invalid. Please provide a valid API key in the settings."
+        return None
+
+    def _on_request_error(self, error: Exception) -> None:
+        """
+        Disable the client if a request failed because the API key is invalid
+
+        The instance is shared between requests, so remembering the failure
+        avoids sending every later request with a key that is known to be bad.
+        A new instance is created once the key in the environment changes.
+
+        Args:
+            error: Exception raised by the Anthropic client
+        """
+        if isinstance(error, anthropic.AuthenticationError) or error_status(error) == 401:
+            self.client = None
+            self.api_key_error = "Invalid Anthropic API key. Please check your API key and try again."
+
+    def _claude_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Convert a conversation to Claude format, which only knows user and assistant roles
+
+        The turn before the new user request is marked as a prompt cache
+        breakpoint, so the next request in the conversation reads the whole
+        history from the cache.
+
+        Args:
+            messages: Conversation as ``{"role", "content"}`` dicts
+
+        Returns:
+            List of Claude messages
+        """
         claude_messages = []
-        
-        # Add previous messages
         for msg in messages:
             role = msg.get("role", "user")
-            if role == "assistant":
-                role = "assistant"
-            else:
+            if role != "assistant":
                 role = "user"
-            
+
             claude_messages.append({
                 "role": role,
                 "content": msg.get("content", "")
             })
-        
-        # Add current message with notebook context
-        claude_messages.append({
-            "role": "user",
-            "content": f"Current notebook:\n{notebook_context}\n\nUser request: {prompt}"
-        })
-        
-        # Generate response from Claude
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                system=system_prompt,
-                messages=claude_messages,
-                max_tokens=4000
-            )
-            
-            content = response.content[0].text
-            return {
-                "content": content,
-                "has_code": "```" in content,
-                "model": self.model,
-                "provider": "Anthropic"
-            }
-        except Exception as e:
-            return {
-                "content": f"Error generating response: {str(e)}",
-                "has_code": False,
-                "model": self.model,
-                "provider": "Anthropic",
-                "error": True
-            }
-    
-    def fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> str:
-        """
-        Fix errors in the code using Claude
-        
+
+        if len(claude_messages) > 1 and claude_messages[-2]["content"]:
+            claude_messages[-2]["content"] = [{
+                "type": "text",
+                "text": claude_messages[-2]["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+        return claude_messages
+
+    @staticmethod
+    def _claude_system(system: str) -> List[Dict[str, Any]]:
+        """
+        Mark the system prompt, which holds the notebook, as a prompt cache breakpoint
+
+        Prompts shorter than the model's minimum cacheable length are sent
+        uncached without error.
+
         Args:
-            code: The code with errors
-            errors: List of error messages and details
-            
+            system: System prompt
+
         Returns:
-            Fixed code as a string
+            System prompt as Claude content blocks
         """
-        # Check if client is None (API key not set or invalid)
-        if self.client is None:
-            error_message = self.api_key_error or "Anthropic API key is not set or is invalid. Please provide a valid API key in the settings."
-            return f"# Error: {error_message}\n{code}"
-            
-        error_text = "\n".join([f"Error {i+1}: {error.get('message', '')}" 
-                               for i, error in enumerate(errors)])
-        
-        user_message = f"""
-        Fix the following Python code that has errors:
-        
-        ```python
-        {code}
-        ```
-        
-        Errors:
-        {error_text}
-        
-        Provide only the fixed code without explanations.
-        """
-        
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                system="You are an expert Python code debugger. When provided code with errors, fix the errors and return only the corrected code without explanations or markdown formatting.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": user_message
-                    }
-                ],
-                max_tokens=2000
-            )
-            
-            fixed_code = response.content[0].text
-            
-            # Clean up any markdown code blocks
-            if fixed_code.startswith("```python"):
-                fixed_code = fixed_code.replace("```python", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-            elif fixed_code.startswith("```"):
-                fixed_code = fixed_code.replace("```", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-                    
-            return fixed_code.strip()
-        except Exception as e:
-            return f"# Error fixing code: {str(e)}\n{code}"
-    
+        return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+    @staticmethod
+    def _usage(usage: Any) -> Dict[str, int]:
+        """
+        Convert Claude token usage
+
+        Claude reports prompt tokens read from and written to the cache
+        separately from ``input_tokens``; they are added up here so that
+        ``input_tokens`` counts the whole prompt as for other providers.
+
+        Args:
+            usage: ``usage`` of a Claude message
+
+        Returns:
+            Token counts from ``token_usage``
+        """
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return token_usage(
+            usage.input_tokens + cache_read + cache_write,
+            usage.output_tokens,
+            cached_input_tokens=cache_read,
+            cache_write_tokens=cache_write
+        )
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]],
+                  max_tokens: int) -> Dict[str, Any]:
+        """
+        Generate a completion from Claude
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        response = self.client.messages.create(
+            model=self.model,
+            system=self._claude_system(system),
+            messages=self._claude_messages(messages),
+            max_tokens=max_tokens
+        )
+        return {"content": response.content[0].text, "usage": self._usage(response.usage)}
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]],
+                max_tokens: int) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a completion from Claude
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        with self.client.messages.stream(
+            model=self.model,
+            system=self._claude_system(system),
+            messages=self._claude_messages(messages),
+            max_tokens=max_tokens
+        ) as stream:
+            for text in stream.text_stream:
+                yield {"content": text}
+            yield {"usage": self._usage(stream.get_final_message().usage)}
+
+    async def _acomplete(self, system: str, messages: List[Dict[str, Any]],
+                         max_tokens: int) -> Dict[str, Any]:
+        """
+        Async version of ``_complete`` using the async Anthropic client
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        response = await self.async_client.messages.create(
+            model=self.model,
+            system=self._claude_system(system),
+            messages=self._claude_messages(messages),
+            max_tokens=max_tokens
+        )
+        return {"content": response.content[0].text, "usage": self._usage(response.usage)}
+
+    async def _astream(self, system: str, messages: List[Dict[str, Any]],
+                       max_tokens: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of ``_stream`` using the async Anthropic client
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        async with self.async_client.messages.stream(
+            model=self.model,
+            system=self._claude_system(system),
+            messages=self._claude_messages(messages),
+            max_tokens=max_tokens
+        ) as stream:
+            async for text in stream.text_stream:
+                yield {"content": text}
+            message = await stream.get_final_message()
+            yield {"usage": self._usage(message.usage)}
+
     def get_config(self) -> Dict[str, Any]:
         """
         Get configuration for this LLM
-        
+
         Returns:
             Dictionary with configuration details
         """
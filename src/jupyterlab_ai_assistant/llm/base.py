@@ -1,87 +1,809 @@
+import asyncio
+import logging
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Any, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Any, AsyncIterator, Iterator, Optional, Tuple
+
+from .. import metrics
+from ..circuit import circuit_breaker
+from .context import build_chat_context, estimate_tokens, render_cell
+from .prompt import CHAT_SYSTEM_PROMPT, chat_prompt, fix_prompt, summary_prompt
+from .retry import is_provider_failure, retry_delay
+
+logger = logging.getLogger(__name__)
+
+# Shared pool for running blocking provider calls off the event loop
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Get the bounded thread pool used for providers without async support
+
+    The pool size is read from ``AI_ASSISTANT_MAX_WORKERS`` (default 8), which
+    caps the number of blocking provider calls running at the same time.
+
+    Returns:
+        The process-wide executor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            max_workers = int(os.environ.get("AI_ASSISTANT_MAX_WORKERS", "8"))
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ai-assistant-llm")
+        return _executor
+
+
+# Pool for whole requests run off the calling thread, which may wait for admission
+_request_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_request_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread pool for whole provider requests run off the calling thread
+
+    Batch fixes, fallback stages, speculative fixes and conversation
+    compaction wait for a provider slot from ``admission`` while holding a
+    thread. They run here rather than in ``get_executor``, whose threads
+    the admitted calls of providers without async support need to make
+    progress and release their slots. The pool size is read from
+    ``AI_ASSISTANT_REQUEST_WORKERS`` (default 16).
+
+    Returns:
+        The process-wide executor
+    """
+    global _request_executor
+    with _executor_lock:
+        if _request_executor is None:
+            max_workers = int(os.environ.get("AI_ASSISTANT_REQUEST_WORKERS", "16"))
+            _request_executor = ThreadPoolExecutor(max_workers=max_workers,
+                                                   thread_name_prefix="ai-assistant-request")
+        return _request_executor
 
 
 class BaseLLM(ABC):
     """
     Base class for LLM implementations
+
+    Instances are long-lived and shared between requests (see
+    ``get_llm_instance``), so implementations must not keep per-request state.
+
+    Subclasses implement ``_complete`` (and ``_stream`` if the provider can
+    stream tokens); prompt construction, response formatting and error
+    handling, including retries and circuit breaking, are shared here. Providers with an async SDK also implement
+    ``_acomplete`` and ``_astream``, otherwise the blocking calls run in the
+    executor returned by ``get_executor``.
     """
-    
+
+    # Model used when no explicit model is requested
+    default_model: str = ""
+
+    # Type name under which ``get_llm_instance`` creates this LLM
+    llm_type: str = ""
+
+    # Provider name reported in responses
+    provider_name: str = ""
+
+    # Environment variable holding the provider API key, if any
+    api_key_env: Optional[str] = None
+
+    # Upper bound on generated tokens, for providers that require one
+    chat_max_tokens: int = 4000
+    fix_max_tokens: int = 2000
+    summary_max_tokens: int = 500
+
+    def __init__(self, model: Optional[str] = None):
+        """
+        Initialize the LLM
+
+        Args:
+            model: Model to use, defaults to ``default_model``
+        """
+        self.model = model or self.default_model
+        self.api_key = os.environ.get(self.api_key_env) if self.api_key_env else None
+
+    def is_stale(self) -> bool:
+        """
+        Check whether this instance was built with outdated settings
+
+        Returns:
+            True if the API key in the environment changed since initialization
+        """
+        if not self.api_key_env:
+            return False
+        return os.environ.get(self.api_key_env) != self.api_key
+
+    def unavailable_reason(self) -> Optional[str]:
+        """
+        Explain why this LLM cannot serve requests, e.g. a missing API key
+
+        Returns:
+            Error message, or None if the LLM is usable
+        """
+        return None
+
+    def startup_delay(self) -> float:
+        """
+        Estimate the extra latency before the model starts answering, e.g. to load it
+
+        Returns:
+            Seconds, 0 for hosted models
+        """
+        return 0.0
+
     @abstractmethod
-    def generate_response(self, prompt: str, messages: List[Dict[str, Any]], 
+    def _complete(self, system: str, messages: List[Dict[str, Any]],
+                  max_tokens: int) -> Dict[str, Any]:
+        """
+        Send a chat request to the provider and wait for the full completion
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts, ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Returns:
+            Dict with the generated text under ``content`` and, if the
+            provider reports it, token counts from ``token_usage`` under ``usage``
+
+        Raises:
+            Exception: Any provider error, handled by the caller
+        """
+        pass
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]],
+                max_tokens: int) -> Iterator[Dict[str, Any]]:
+        """
+        Send a chat request to the provider and yield the completion incrementally
+
+        Providers without streaming support return the full completion as a
+        single chunk. Token counts may be reported under ``usage`` in any
+        chunk, usually the last one.
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts, ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``
+        """
+        yield self._complete(system, messages, max_tokens)
+
+    async def _acomplete(self, system: str, messages: List[Dict[str, Any]],
+                         max_tokens: int) -> Dict[str, Any]:
+        """
+        Async version of ``_complete``
+
+        Runs ``_complete`` in the shared executor unless overridden.
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts, ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Returns:
+            Dict with the generated text under ``content``
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), self._complete, system, messages, max_tokens)
+
+    async def _astream(self, system: str, messages: List[Dict[str, Any]],
+                       max_tokens: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of ``_stream``
+
+        Advances ``_stream`` in the shared executor one chunk at a time unless
+        overridden.
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts, ending with the user turn
+            max_tokens: Upper bound on generated tokens
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``
+        """
+        executor = get_executor()
+        chunks = self._stream(system, messages, max_tokens)
+        finished = object()
+        pending: Optional[Future] = None
+        try:
+            while True:
+                pending = executor.submit(next, chunks, finished)
+                chunk = await asyncio.wrap_future(pending)
+                if chunk is finished:
+                    break
+                yield chunk
+        finally:
+            # Release the provider connection if the consumer stopped early,
+            # such as a cancelled request. A generator cannot be closed while
+            # it runs, so a read in progress is let finish first.
+            if pending is None or pending.done():
+                executor.submit(chunks.close)
+            else:
+                pending.add_done_callback(lambda _: executor.submit(chunks.close))
+
+    def _on_request_error(self, error: Exception) -> None:
+        """
+        Hook called when a provider request raised
+
+        Args:
+            error: Exception raised by the provider
+        """
+        pass
+
+    def _blocked_reason(self) -> Optional[str]:
+        """
+        Explain why a request cannot be sent now
+
+        Returns:
+            Error message if the LLM is unavailable or its circuit breaker is
+            open, otherwise None. A None answer for a half-open breaker
+            makes this request its probe, so it is asked right before the
+            provider call, once the request is built; the retry helpers
+            report the outcome however the call ends.
+        """
+        reason = self.unavailable_reason()
+        if reason:
+            return reason
+        if not circuit_breaker.allow((self.llm_type, self.model)):
+            return (f"{self.provider_name} ({self.model}) failed repeatedly, requests to it are paused "
+                    f"for up to {circuit_breaker.cooldown:g} seconds")
+        return None
+
+    def _record_outcome(self, error: Optional[BaseException]) -> None:
+        """
+        Report the outcome of a provider request, after retries, to the circuit breaker
+
+        Args:
+            error: Exception of the failed request, None if it succeeded. A
+                ``BaseException`` such as ``GeneratorExit`` or a cancellation
+                means the caller abandoned the request, which gives no verdict
+                on the provider and only gives back the probe slot.
+        """
+        key = (self.llm_type, self.model)
+        if error is not None and not isinstance(error, Exception):
+            circuit_breaker.release(key)
+        elif error is not None and is_provider_failure(error):
+            circuit_breaker.record_failure(key)
+        else:
+            # The provider answered, even if it refused an invalid request
+            circuit_breaker.record_success(key)
+
+    def _complete_with_retry(self, system: str, messages: List[Dict[str, Any]],
+                             max_tokens: int) -> Dict[str, Any]:
+        """
+        Call ``_complete``, retrying transient errors with backoff, see ``retry_delay``
+
+        The outcome is reported to the circuit breaker however the call ends.
+
+        Raises:
+            Exception: The error of the last attempt
+        """
+        attempt = 0
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                try:
+                    return self._complete(system, messages, max_tokens)
+                except Exception as e:
+                    delay = retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    logger.info(f"{self.provider_name} request failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    attempt += 1
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record_outcome(error)
+
+    def _stream_with_retry(self, system: str, messages: List[Dict[str, Any]],
+                           max_tokens: int) -> Iterator[Dict[str, Any]]:
+        """
+        Call ``_stream``, retrying transient errors with backoff until the first chunk arrives
+
+        Once a chunk was passed on, a failure ends the stream, since the
+        output cannot be taken back. The outcome is reported to the circuit
+        breaker however the stream ends, also when its consumer closes it.
+
+        Raises:
+            Exception: The error of the last attempt
+        """
+        attempt = 0
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                started = False
+                try:
+                    for chunk in self._stream(system, messages, max_tokens):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    delay = None if started else retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    logger.info(f"{self.provider_name} request failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    attempt += 1
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record_outcome(error)
+
+    async def _acomplete_with_retry(self, system: str, messages: List[Dict[str, Any]],
+                                    max_tokens: int) -> Dict[str, Any]:
+        """Async version of ``_complete_with_retry``"""
+        attempt = 0
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                try:
+                    return await self._acomplete(system, messages, max_tokens)
+                except Exception as e:
+                    delay = retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    logger.info(f"{self.provider_name} request failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record_outcome(error)
+
+    async def _astream_with_retry(self, system: str, messages: List[Dict[str, Any]],
+                                  max_tokens: int) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of ``_stream_with_retry``"""
+        attempt = 0
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                started = False
+                try:
+                    async for chunk in self._astream(system, messages, max_tokens):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    delay = None if started else retry_delay(e, attempt)
+                    if delay is None:
+                        raise
+                    logger.info(f"{self.provider_name} request failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._record_outcome(error)
+
+    def generate_response(self, prompt: str, messages: List[Dict[str, Any]],
                          notebook_content: Dict[str, Any]) -> Dict[str, Any]:
         """
         Generate a response from the LLM
-        
+
         Args:
             prompt: Current prompt/question from the user
             messages: Chat history
             notebook_content: Content of the notebook including code cells and outputs
-            
+
         Returns:
             Dict with LLM response
         """
-        pass
-    
-    @abstractmethod
+        system, chat_messages, context = self._chat_request(prompt, messages, notebook_content)
+        reason = self._blocked_reason()
+        if reason:
+            return self._error_response(f"Error: {reason}")
+
+        try:
+            result = self._complete_with_retry(system, chat_messages, self.chat_max_tokens)
+        except Exception as e:
+            self._on_request_error(e)
+            return self._error_response(f"Error generating response: {str(e)}")
+
+        return self._response(result.get("content") or "", context, result.get("usage"))
+
+    def stream_response(self, prompt: str, messages: List[Dict[str, Any]],
+                        notebook_content: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response from the LLM incrementally
+
+        Args:
+            prompt: Current prompt/question from the user
+            messages: Chat history
+            notebook_content: Content of the notebook including code cells and outputs
+
+        Yields:
+            ``{"type": "delta", "content": ...}`` events for each piece of text,
+            followed by one ``{"type": "done", ...}`` event carrying the same
+            fields as the result of ``generate_response``
+        """
+        system, chat_messages, context = self._chat_request(prompt, messages, notebook_content)
+        reason = self._blocked_reason()
+        if reason:
+            yield {"type": "done", **self._error_response(f"Error: {reason}")}
+            return
+
+        parts = []
+        usage = None
+        try:
+            for chunk in self._stream_with_retry(system, chat_messages, self.chat_max_tokens):
+                usage = chunk.get("usage") or usage
+                text = chunk.get("content")
+                if text:
+                    parts.append(text)
+                    yield {"type": "delta", "content": text}
+        except Exception as e:
+            self._on_request_error(e)
+            yield {"type": "done", **self._error_response(f"Error generating response: {str(e)}")}
+            return
+
+        yield {"type": "done", **self._response(''.join(parts), context, usage)}
+
+    def summarize_conversation(self, summary: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Fold chat turns into the running summary of a conversation
+
+        Args:
+            summary: Summary of the turns before ``messages``, empty if none
+            messages: Turns to fold in, oldest first
+
+        Returns:
+            Dict with the new summary under ``content``, in the format of
+            ``generate_response``; ``error`` is set on failure
+        """
+        system, summary_messages = summary_prompt(summary, messages)
+        reason = self._blocked_reason()
+        if reason:
+            return self._error_response(f"Error: {reason}")
+
+        try:
+            result = self._complete_with_retry(system, summary_messages, self.summary_max_tokens)
+        except Exception as e:
+            self._on_request_error(e)
+            return self._error_response(f"Error summarizing the conversation: {str(e)}")
+
+        return self._response((result.get("content") or "").strip(), usage=result.get("usage"))
+
     def fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> str:
         """
         Fix errors in the code
-        
+
         Args:
             code: The code with errors
             errors: List of error messages and details
-            
+
         Returns:
             Fixed code as a string
         """
-        pass
-    
+        return self.fix_errors_response(code, errors)["fixed_code"]
+
+    def fix_errors_response(self, code: str, errors: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Fix errors in the code, reporting whether the fix succeeded
+
+        Args:
+            code: The code with errors
+            errors: List of error messages and details
+
+        Returns:
+            Dict with the fixed code under ``fixed_code``. On failure
+            ``fixed_code`` holds the original code preceded by an error
+            comment and ``error`` is set.
+        """
+        system, fix_messages = self._fix_request(code, errors)
+        reason = self._blocked_reason()
+        if reason:
+            return self._fix_error_response(f"# Error: {reason}\n{code}")
+
+        try:
+            result = self._complete_with_retry(system, fix_messages, self.fix_max_tokens)
+        except Exception as e:
+            self._on_request_error(e)
+            return self._fix_error_response(f"# Error fixing code: {str(e)}\n{code}")
+
+        return self._fix_response(self.clean_code(result.get("content") or ""), result.get("usage"))
+
+    def stream_fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Fix errors in the code incrementally
+
+        Args:
+            code: The code with errors
+            errors: List of error messages and details
+
+        Yields:
+            ``{"type": "delta", "content": ...}`` events with the raw generated
+            text, followed by one ``{"type": "done", ...}`` event carrying the
+            same fields as the result of ``fix_errors_response``
+        """
+        system, fix_messages = self._fix_request(code, errors)
+        reason = self._blocked_reason()
+        if reason:
+            yield {"type": "done", **self._fix_error_response(f"# Error: {reason}\n{code}")}
+            return
+
+        parts = []
+        usage = None
+        try:
+            for chunk in self._stream_with_retry(system, fix_messages, self.fix_max_tokens):
+                usage = chunk.get("usage") or usage
+                text = chunk.get("content")
+                if text:
+                    parts.append(text)
+                    yield {"type": "delta", "content": text}
+        except Exception as e:
+            self._on_request_error(e)
+            yield {"type": "done", **self._fix_error_response(f"# Error fixing code: {str(e)}\n{code}")}
+            return
+
+        yield {"type": "done", **self._fix_response(self.clean_code(''.join(parts)), usage)}
+
+    async def agenerate_response(self, prompt: str, messages: List[Dict[str, Any]],
+                                 notebook_content: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Async version of ``generate_response``
+
+        Args:
+            prompt: Current prompt/question from the user
+            messages: Chat history
+            notebook_content: Content of the notebook including code cells and outputs
+
+        Returns:
+            Dict with LLM response
+        """
+        system, chat_messages, context = self._chat_request(prompt, messages, notebook_content)
+        reason = self._blocked_reason()
+        if reason:
+            return self._error_response(f"Error: {reason}")
+
+        try:
+            result = await self._acomplete_with_retry(system, chat_messages, self.chat_max_tokens)
+        except Exception as e:
+            self._on_request_error(e)
+            return self._error_response(f"Error generating response: {str(e)}")
+
+        return self._response(result.get("content") or "", context, result.get("usage"))
+
+    async def astream_response(self, prompt: str, messages: List[Dict[str, Any]],
+                               notebook_content: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of ``stream_response``
+
+        Args:
+            prompt: Current prompt/question from the user
+            messages: Chat history
+            notebook_content: Content of the notebook including code cells and outputs
+
+        Yields:
+            The same events as ``stream_response``
+        """
+        system, chat_messages, context = self._chat_request(prompt, messages, notebook_content)
+        reason = self._blocked_reason()
+        if reason:
+            yield {"type": "done", **self._error_response(f"Error: {reason}")}
+            return
+
+        parts = []
+        usage = None
+        try:
+            async for chunk in self._astream_with_retry(system, chat_messages, self.chat_max_tokens):
+                usage = chunk.get("usage") or usage
+                text = chunk.get("content")
+                if text:
+                    parts.append(text)
+                    yield {"type": "delta", "content": text}
+        except Exception as e:
+            self._on_request_error(e)
+            yield {"type": "done", **self._error_response(f"Error generating response: {str(e)}")}
+            return
+
+        yield {"type": "done", **self._response(''.join(parts), context, usage)}
+
+    async def afix_errors_response(self, code: str, errors: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Async version of ``fix_errors_response``
+
+        Args:
+            code: The code with errors
+            errors: List of error messages and details
+
+        Returns:
+            Dict with the fixed code under ``fixed_code``
+        """
+        system, fix_messages = self._fix_request(code, errors)
+        reason = self._blocked_reason()
+        if reason:
+            return self._fix_error_response(f"# Error: {reason}\n{code}")
+
+        try:
+            result = await self._acomplete_with_retry(system, fix_messages, self.fix_max_tokens)
+        except Exception as e:
+            self._on_request_error(e)
+            return self._fix_error_response(f"# Error fixing code: {str(e)}\n{code}")
+
+        return self._fix_response(self.clean_code(result.get("content") or ""), result.get("usage"))
+
+    async def astream_fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of ``stream_fix_errors``
+
+        Args:
+            code: The code with errors
+            errors: List of error messages and details
+
+        Yields:
+            The same events as ``stream_fix_errors``
+        """
+        system, fix_messages = self._fix_request(code, errors)
+        reason = self._blocked_reason()
+        if reason:
+            yield {"type": "done", **self._fix_error_response(f"# Error: {reason}\n{code}")}
+            return
+
+        parts = []
+        usage = None
+        try:
+            async for chunk in self._astream_with_retry(system, fix_messages, self.fix_max_tokens):
+                usage = chunk.get("usage") or usage
+                text = chunk.get("content")
+                if text:
+                    parts.append(text)
+                    yield {"type": "delta", "content": text}
+        except Exception as e:
+            self._on_request_error(e)
+            yield {"type": "done", **self._fix_error_response(f"# Error fixing code: {str(e)}\n{code}")}
+            return
+
+        yield {"type": "done", **self._fix_response(self.clean_code(''.join(parts)), usage)}
+
     @abstractmethod
     def get_config(self) -> Dict[str, Any]:
         """
         Get configuration for this LLM
-        
+
         Returns:
             Dictionary with configuration details
         """
         pass
-    
+
+    def _chat_request(self, prompt: str, messages: List[Dict[str, Any]],
+                      notebook_content: Dict[str, Any]
+                      ) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Build the system prompt and conversation for a chat request
+
+        Notebook cells and history are fitted into the model's context window
+        with ``build_chat_context`` and laid out by ``chat_prompt``, which
+        puts the notebook in the system prompt to form a cacheable prefix.
+
+        Args:
+            prompt: Current prompt/question from the user
+            messages: Chat history
+            notebook_content: Content of the notebook including code cells and outputs
+
+        Returns:
+            Tuple of system prompt, messages ending with the user turn, and a
+            report of the context that was dropped to fit the window
+        """
+        reserved_tokens = (
+            estimate_tokens(CHAT_SYSTEM_PROMPT) + estimate_tokens(prompt) + self.chat_max_tokens
+        )
+        started = time.monotonic()
+        notebook_context, kept_messages, context = build_chat_context(
+            notebook_content, messages, self.model, reserved_tokens
+        )
+        system, chat_messages = chat_prompt(notebook_context, kept_messages, prompt)
+        metrics.CONTEXT_BUILD_SECONDS.labels(self.llm_type, metrics.model_label(self.llm_type, self.model)).observe(
+            time.monotonic() - started
+        )
+        return system, chat_messages, context
+
+    def _fix_request(self, code: str, errors: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Build the system prompt and conversation for an error fixing request
+
+        Args:
+            code: The code with errors
+            errors: List of error messages and details
+
+        Returns:
+            Tuple of system prompt and messages
+        """
+        return fix_prompt(code, errors)
+
+    def _response(self, content: str, context: Optional[Dict[str, Any]] = None,
+                  usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """Build a successful chat response, with the context report and token usage if known"""
+        response = {
+            "content": content,
+            "has_code": "```" in content,
+            "model": self.model,
+            "provider": self.provider_name
+        }
+        if context is not None:
+            response["context"] = context
+        if usage:
+            response["usage"] = usage
+        return response
+
+    def _error_response(self, message: str) -> Dict[str, Any]:
+        """Build a failed chat response"""
+        return {
+            "content": message,
+            "has_code": False,
+            "model": self.model,
+            "provider": self.provider_name,
+            "error": True
+        }
+
+    def _fix_response(self, fixed_code: str, usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """Build a successful error fixing response, with token usage if known"""
+        response = {
+            "fixed_code": fixed_code,
+            "model": self.model,
+            "provider": self.provider_name
+        }
+        if usage:
+            response["usage"] = usage
+        return response
+
+    def _fix_error_response(self, fixed_code: str) -> Dict[str, Any]:
+        """Build a failed error fixing response"""
+        return {
+            "fixed_code": fixed_code,
+            "model": self.model,
+            "provider": self.provider_name,
+            "error": True
+        }
+
+    @staticmethod
+    def clean_code(text: str) -> str:
+        """
+        Strip a surrounding markdown code block from generated code
+
+        Args:
+            text: Generated code, possibly wrapped in ``` fences
+
+        Returns:
+            The bare code
+        """
+        if text.startswith("```python"):
+            text = text.replace("```python", "", 1)
+            if text.endswith("```"):
+                text = text[:-3]
+        elif text.startswith("```"):
+            text = text.replace("```", "", 1)
+            if text.endswith("```"):
+                text = text[:-3]
+
+        return text.strip()
+
     def format_notebook_context(self, notebook_content: Dict[str, Any]) -> str:
         """
         Format notebook content into a string representation
-        
+
         Args:
             notebook_content: Dictionary containing cells, outputs, and other notebook content
-            
+
         Returns:
             String representation of the notebook
         """
         formatted_content = []
-        
+
         for idx, cell in enumerate(notebook_content.get('cells', [])):
-            cell_type = cell.get('cell_type', '')
-            source = cell.get('source', '')
-            
-            if cell_type == 'code':
-                formatted_content.append(f"Cell [{idx}] (Code):\n```python\n{source}\n```")
-                
-                # Add outputs if available
-                outputs = cell.get('outputs', [])
-                if outputs:
-                    output_text = []
-                    for output in outputs:
-                        if 'text/plain' in output.get('data', {}):
-                            output_text.append(output['data']['text/plain'])
-                        elif 'text' in output:
-                            output_text.append(output['text'])
-                        elif 'traceback' in output:
-                            output_text.append('\n'.join(output['traceback']))
-                    
-                    if output_text:
-                        formatted_content.append(f"Output:\n```\n{''.join(output_text)}\n```")
-            
-            elif cell_type == 'markdown':
-                formatted_content.append(f"Cell [{idx}] (Markdown):\n{source}")
-        
+            body = render_cell(cell)
+            if body:
+                formatted_content.append(f"Cell [{idx}] {body}")
+
         return '\n\n'.join(formatted_content)
@@ -0,0 +1,286 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from ..notebook import HashedCell
+
+# Context window sizes in tokens; Ollama tags such as "llama3:8b" use the base name
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385,
+    "claude-3-5-sonnet-20241022": 200000,
+    "claude-3-opus-20240229": 200000,
+    "claude-3-sonnet-20240229": 200000,
+    "claude-3-haiku-20240307": 200000,
+    "gemini-pro": 32760,
+    "gemini-ultra": 32760,
+    "gemini-1.0-pro": 32760,
+    "gemini-1.5-pro": 1048576,
+    "llama3": 8192,
+    "llama2": 4096,
+    "mistral": 32768,
+    "codellama": 16384,
+}
+
+# Window assumed for models not listed above
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Average characters per token; deliberately low so estimates err on the large side
+CHARS_PER_TOKEN = 3.5
+
+# Tokens kept free for message framing and estimation error
+SAFETY_MARGIN = 256
+
+# Share of the budget that chat history may use before notebook cells
+HISTORY_SHARE = 0.25
+
+# Outputs longer than this many tokens keep only their head and tail
+MAX_OUTPUT_TOKENS = 1000
+
+# Number of rendered cells kept in memory
+RENDER_CACHE_SIZE = 16384
+
+
+def context_window(model: str) -> int:
+    """
+    Get the context window of a model
+
+    Args:
+        model: Model name, optionally with an Ollama tag
+
+    Returns:
+        Context window in tokens
+    """
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    return MODEL_CONTEXT_WINDOWS.get(model.split(":", 1)[0], DEFAULT_CONTEXT_WINDOW)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text without a tokenizer
+
+    Args:
+        text: Text to measure
+
+    Returns:
+        Estimated token count
+    """
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """
+    Shorten a text by cutting out its middle
+
+    Tracebacks and logs carry most information at the start and the end.
+
+    Args:
+        text: Text to shorten
+        max_chars: Maximum number of characters to keep
+
+    Returns:
+        The text itself if short enough, otherwise its head and tail around a marker
+    """
+    if len(text) <= max_chars:
+        return text
+    head = max_chars // 2
+    tail = max_chars - head
+    return f"{text[:head]}\n... [{len(text) - max_chars} characters truncated] ...\n{text[-tail:]}"
+
+
+def _cell_key(cell: Dict[str, Any], max_output_chars: Optional[int]) -> Tuple[Any, Optional[int]]:
+    """
+    Cache key covering everything ``render_cell`` reads from a cell
+
+    Cells resolved by ``notebook.resolve_notebook_cells`` already carry the
+    ``hash`` the server computed; other cells are hashed here, whatever
+    ``hash`` the client sent with them, since the cache is shared by all users.
+    """
+    if isinstance(cell, HashedCell):
+        return cell['hash'], max_output_chars
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{cell.get('cell_type', '')}\0".encode('utf-8'))
+    digest.update(cell.get('source', '').encode('utf-8', 'surrogatepass'))
+    for output in cell.get('outputs', []):
+        digest.update(b'\0')
+        if 'text/plain' in output.get('data', {}):
+            digest.update(output['data']['text/plain'].encode('utf-8', 'surrogatepass'))
+        elif 'text' in output:
+            digest.update(output['text'].encode('utf-8', 'surrogatepass'))
+        elif 'traceback' in output:
+            digest.update('\n'.join(output['traceback']).encode('utf-8', 'surrogatepass'))
+    return digest.digest(), max_output_chars
+
+
+class _RenderedCell(NamedTuple):
+    """Cached rendering of a cell body"""
+    body: str
+    tokens: int
+    truncated: bool
+    has_error: bool
+
+
+def _render_cell(cell: Dict[str, Any], max_output_chars: Optional[int]) -> _RenderedCell:
+    """Render a cell body along with what ``build_chat_context`` needs to know about it"""
+    cell_type = cell.get('cell_type', '')
+    source = cell.get('source', '')
+
+    if cell_type == 'markdown':
+        body = f"(Markdown):\n{source}"
+        return _RenderedCell(body, estimate_tokens(body), False, False)
+    if cell_type != 'code':
+        return _RenderedCell("", 0, False, False)
+
+    body = f"(Code):\n```python\n{source}\n```"
+
+    # Add outputs if available
+    output_text = []
+    has_error = False
+    for output in cell.get('outputs', []):
+        if output.get('output_type') == 'error' or 'traceback' in output:
+            has_error = True
+        if 'text/plain' in output.get('data', {}):
+            output_text.append(output['data']['text/plain'])
+        elif 'text' in output:
+            output_text.append(output['text'])
+        elif 'traceback' in output:
+            output_text.append('\n'.join(output['traceback']))
+
+    truncated = False
+    if output_text:
+        text = ''.join(output_text)
+        if max_output_chars is not None and len(text) > max_output_chars:
+            text = truncate_middle(text, max_output_chars)
+            truncated = True
+        body += f"\n\nOutput:\n```\n{text}\n```"
+    return _RenderedCell(body, estimate_tokens(body), truncated, has_error)
+
+
+# Rendered cells by content digest, least recently used first
+_rendered_cells: "OrderedDict[Tuple[Any, Optional[int]], _RenderedCell]" = OrderedDict()
+_rendered_cells_lock = threading.Lock()
+
+
+def _cached_render_cell(cell: Dict[str, Any], max_output_chars: Optional[int]) -> _RenderedCell:
+    """Memoized ``_render_cell``, so unchanged cells are not rendered again on every turn"""
+    key = _cell_key(cell, max_output_chars)
+    with _rendered_cells_lock:
+        entry = _rendered_cells.get(key)
+        if entry is not None:
+            _rendered_cells.move_to_end(key)
+            return entry
+
+    entry = _render_cell(cell, max_output_chars)
+    with _rendered_cells_lock:
+        _rendered_cells[key] = entry
+        while len(_rendered_cells) > RENDER_CACHE_SIZE:
+            _rendered_cells.popitem(last=False)
+    return entry
+
+
+def clear_render_cache() -> None:
+    """Forget all rendered cells"""
+    with _rendered_cells_lock:
+        _rendered_cells.clear()
+
+
+def render_cell(cell: Dict[str, Any], max_output_chars: Optional[int] = None) -> str:
+    """
+    Render the body of a notebook cell, without its index header
+
+    Results are cached by a digest of the cell's type, source and outputs,
+    so the header is left to the caller to keep entries valid when cells move.
+
+    Args:
+        cell: Notebook cell
+        max_output_chars: Truncate longer outputs with ``truncate_middle``, None for no limit
+
+    Returns:
+        Markdown text of the cell, empty for unsupported cell types
+    """
+    return _cached_render_cell(cell, max_output_chars).body
+
+
+def build_chat_context(notebook_content: Dict[str, Any], messages: List[Dict[str, Any]],
+                       model: str, reserved_tokens: int) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Fit notebook cells and chat history into a model's context window
+
+    The budget is the context window minus ``reserved_tokens`` (system
+    prompt, user prompt and expected output). Recent chat history may use
+    up to ``HISTORY_SHARE`` of it, newest messages first. Notebook cells fill
+    the rest in priority order: the active cell, cells with errors, then the
+    most recent cells. Long outputs keep only their head and tail.
+
+    Args:
+        notebook_content: Notebook content, optionally with ``active_cell_index``
+        messages: Chat history
+        model: Model the request is sent to
+        reserved_tokens: Tokens needed outside the notebook and history
+
+    Returns:
+        Tuple of the notebook text, the kept history and a report of what was
+        dropped, suitable for response metadata
+    """
+    window = context_window(model)
+    budget = max(0, window - reserved_tokens - SAFETY_MARGIN)
+
+    # Most recent history first, within its share of the budget
+    history_budget = int(budget * HISTORY_SHARE)
+    history_tokens = 0
+    kept_messages: List[Dict[str, Any]] = []
+    for msg in reversed(messages):
+        tokens = estimate_tokens(msg.get("content", "")) + 4
+        if history_tokens + tokens > history_budget:
+            break
+        history_tokens += tokens
+        kept_messages.insert(0, msg)
+
+    cells = notebook_content.get('cells', [])
+    max_output_chars = int(MAX_OUTPUT_TOKENS * CHARS_PER_TOKEN)
+    renders = [_cached_render_cell(cell, max_output_chars) for cell in cells]
+
+    # Active cell, cells with errors, then the most recent cells
+    active_index = notebook_content.get('active_cell_index')
+    priority = []
+    if isinstance(active_index, int) and 0 <= active_index < len(cells):
+        priority.append(active_index)
+    recent = range(len(cells) - 1, -1, -1)
+    priority.extend(i for i in recent if renders[i].has_error and i != active_index)
+    priority.extend(i for i in recent if not renders[i].has_error and i != active_index)
+
+    notebook_budget = budget - history_tokens
+    notebook_tokens = 0
+    kept = [False] * len(cells)
+    truncated_outputs = []
+    for index in priority:
+        entry = renders[index]
+        if not entry.body:
+            continue
+        # Index header and separator
+        tokens = entry.tokens + 6
+        if notebook_tokens + tokens > notebook_budget:
+            continue
+        notebook_tokens += tokens
+        kept[index] = True
+        if entry.truncated:
+            truncated_outputs.append(index)
+
+    sections = [f"Cell [{i}] {entry.body}" for i, entry in enumerate(renders) if kept[i]]
+    dropped_cells = [i for i, entry in enumerate(renders) if entry.body and not kept[i]]
+    if dropped_cells:
+        sections.append(f"[{len(dropped_cells)} cells omitted to fit the context window: "
+                        f"{', '.join(str(i) for i in dropped_cells)}]")
+
+    report = {
+        "context_window": window,
+        "estimated_tokens": reserved_tokens + history_tokens + notebook_tokens,
+        "dropped_cells": dropped_cells,
+        "truncated_outputs": sorted(truncated_outputs),
+        "dropped_messages": len(messages) - len(kept_messages)
+    }
+    return '\n\n'.join(sections), kept_messages, report
@@ -1,181 +1,210 @@
-import os
-import json
-from typing import Dict, List, Any, Optional
+import logging
+import threading
+from typing import Dict, List, Any, Iterator, Optional
 import google.generativeai as genai
 from .base import BaseLLM
+from .prompt import token_usage
+
+logger = logging.getLogger(__name__)
+
+# API key the process-wide Gemini client is configured with
+_configured_key: Optional[str] = None
+_configure_lock = threading.Lock()
+
+
+def _configure(api_key: str) -> None:
+    """Configure the process-wide Gemini client, unless it already uses the key"""
+    global _configured_key
+    with _configure_lock:
+        if _configured_key != api_key:
+            genai.configure(api_key=api_key)
+            _configured_key = api_key
+
+
+def _cancel_stream(response: Any) -> None:
+    """
+    Cancel the call behind a streamed response that was not read to the end
+
+    The SDK's response has no close method, but the gRPC and REST iterators
+    it wraps both support ``cancel``.
+    """
+    if getattr(response, "_done", True):
+        return
+    cancel = getattr(getattr(response, "_iterator", None), "cancel", None)
+    if cancel is not None:
+        cancel()
 
 
 class GeminiLLM(BaseLLM):
     """
     Google Gemini LLM implementation
     """
-    
-    def __init__(self):
+
+    default_model = "gemini-pro"
+    llm_type = "gemini"
+    provider_name = "Google Gemini"
+    api_key_env = "GOOGLE_API_KEY"
+
+    def __init__(self, model: Optional[str] = None):
         """Initialize the Gemini client"""
-        self.model = "gemini-pro"
-        api_key = os.environ.get("GOOGLE_API_KEY")
-        
-        if not api_key:
+        super().__init__(model)
+
+        if not self.api_key:
             self.gemini = None
-            self.models = []
         else:
             try:
-                # Configure the Gemini API
-                genai.configure(api_key=api_key)
-                
-                # Get available models
-                self.models = [m for m in genai.list_models() if 'generateContent' in m.supported_generation_methods]
-                
+                # The SDK keeps the key in global state shared by every model
+                _configure(self.api_key)
+
                 # Set up the model
                 self.gemini = genai.GenerativeModel(self.model)
             except Exception as e:
                 self.gemini = None
-                self.models = []
-    
-    def generate_response(self, prompt: str, messages: List[Dict[str, Any]], 
-                         notebook_content: Dict[str, Any]) -> Dict[str, Any]:
+
+    def available_models(self) -> Optional[List[Dict[str, str]]]:
         """
-        Generate a response from Google Gemini
-        
-        Args:
-            prompt: Current prompt/question from the user
-            messages: Chat history
-            notebook_content: Content of the notebook including code cells and outputs
-            
+        List the models supporting content generation
+
+        Calls the Gemini API, so it is only used by ``get_config``, which the
+        model catalog runs in the background.
+
         Returns:
-            Dict with LLM response
+            ``{"id", "name"}`` dicts, or None if the models cannot be listed
         """
-        # Check if client is None (API key not set or invalid)
         if self.gemini is None:
-            return {
-                "content": "Error: Google API key is not set or is invalid. Please provide a valid API key in the settings.",
-                "has_code": False,
-                "model": self.model,
-                "provider": "Google Gemini",
-                "error": True
-            }
-            
-        # Format notebook content
-        notebook_context = self.format_notebook_context(notebook_content)
-        
+            return None
         try:
-            # Prepare the chat session with history
-            chat = self.gemini.start_chat(history=[])
-            
-            # Add system message
-            chat.send_message(
-                "You are an expert coding assistant in JupyterLab. You have access to the current notebook "
-                "content and chat history. Provide helpful, concise responses to code-related questions. "
-                "When providing code suggestions, ensure they are correct, well-documented, and follow best practices. "
-                "You can reference specific cells from the notebook in your responses. "
-                "For code suggestions, wrap the code in ```python and ``` tags."
-            )
-            
-            # Add previous messages to chat
-            for msg in messages:
-                if msg.get("role") == "assistant":
-                    chat.history.append({
-                        "role": "model",
-                        "parts": [msg.get("content", "")]
-                    })
-                else:
-                    chat.history.append({
-                        "role": "user",
-                        "parts": [msg.get("content", "")]
-                    })
-            
-            # Send the prompt with notebook context
-            response = chat.send_message(
-                f"Current notebook:\n{notebook_context}\n\nUser request: {prompt}"
-            )
-            
-            content = response.text
-            return {
-                "content": content,
-                "has_code": "```" in content,
-                "model": self.model,
-                "provider": "Google Gemini"
-            }
+            return [
+                {"id": m.name.split("/", 1)[-1], "name": m.display_name or m.name}
+                for m in genai.list_models() if 'generateContent' in m.supported_generation_methods
+            ]
         except Exception as e:
-            return {
-                "content": f"Error generating response: {str(e)}",
-                "has_code": False,
-                "model": self.model,
-                "provider": "Google Gemini",
-                "error": True
-            }
-    
-    def fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> str:
+            logger.warning(f"Could not list the Gemini models: {e}")
+            return None
+
+    def unavailable_reason(self) -> Optional[str]:
         """
-        Fix errors in the code using Gemini
-        
-        Args:
-            code: The code with errors
-            errors: List of error messages and details
-            
+        Explain why this LLM cannot serve requests
+
         Returns:
-            Fixed code as a string
+            Error message, or None if the client is configured
         """
         # Check if client is None (API key not set or invalid)
         if self.gemini is None:
-            return f"# Error: Google API key is not set or is invalid. Please provide a valid API key in the settings.\n{code}"
-            
-        error_text = "\n".join([f"Error {i+1}: {error.get('message', '')}" 
-                               for i, error in enumerate(errors)])
-        
-        prompt = f"""
-        Fix the following Python code that has errors:
-        
-        ```python
-        {code}
-        ```
-        
-        Errors:
-        {error_text}
-        
-        Provide only the fixed code without explanations.
+            return "Google API key is not set or is invalid. Please provide a valid API key in the settings."
+        return None
+
+    def _gemini_contents(self, system: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Convert a conversation to Gemini contents
+
+        Not every Gemini model accepts system instructions, so the system
+        prompt is sent as the first part of the first user turn.
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts
+
+        Returns:
+            List of Gemini contents
+        """
+        contents = []
+        for msg in messages:
+            if msg.get("role") == "assistant":
+                contents.append({"role": "model", "parts": [msg.get("content", "")]})
+            else:
+                contents.append({"role": "user", "parts": [msg.get("content", "")]})
+
+        if contents and contents[0]["role"] == "user":
+            contents[0]["parts"].insert(0, system)
+        else:
+            contents.insert(0, {"role": "user", "parts": [system]})
+        return contents
+
+    @staticmethod
+    def _usage(response: Any) -> Optional[Dict[str, int]]:
+        """
+        Convert Gemini token usage
+
+        Gemini models with implicit caching reuse a repeated prompt prefix on
+        their own and report it as ``cached_content_token_count``.
+
+        Args:
+            response: Gemini response, or the last chunk of a streamed one
+
+        Returns:
+            Token counts from ``token_usage``, or None if not reported
+        """
+        metadata = getattr(response, "usage_metadata", None)
+        if not metadata:
+            return None
+        return token_usage(
+            metadata.prompt_token_count,
+            metadata.candidates_token_count,
+            cached_input_tokens=getattr(metadata, "cached_content_token_count", None)
+        )
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]],
+                  max_tokens: int) -> Dict[str, Any]:
+        """
+        Generate a completion from Gemini
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, Gemini applies the model's own limit
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        response = self.gemini.generate_content(self._gemini_contents(system, messages))
+        return {"content": response.text, "usage": self._usage(response)}
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]],
+                max_tokens: int) -> Iterator[Dict[str, Any]]:
         """
-        
+        Stream a completion from Gemini
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, Gemini applies the model's own limit
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        response = self.gemini.generate_content(self._gemini_contents(system, messages), stream=True)
         try:
-            # Initialize a new generative model for this request
-            model = genai.GenerativeModel(self.model)
-            
-            # Add system prompt
-            response = model.generate_content([
-                "You are an expert Python code debugger. When provided code with errors, fix the errors and return only the corrected code without explanations or markdown formatting.",
-                prompt
-            ])
-            
-            fixed_code = response.text
-            
-            # Clean up any markdown code blocks
-            if fixed_code.startswith("```python"):
-                fixed_code = fixed_code.replace("```python", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-            elif fixed_code.startswith("```"):
-                fixed_code = fixed_code.replace("```", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-                    
-            return fixed_code.strip()
-        except Exception as e:
-            return f"# Error fixing code: {str(e)}\n{code}"
-    
+            for chunk in response:
+                # The final chunk may carry only the finish reason
+                if chunk.parts:
+                    yield {"content": chunk.text}
+        finally:
+            # Stop the call if the consumer stopped reading
+            _cancel_stream(response)
+        # Each chunk reports the usage so far, the last one the total
+        yield {"usage": self._usage(response)}
+
     def get_config(self) -> Dict[str, Any]:
         """
         Get configuration for this LLM
-        
+
         Returns:
             Dictionary with configuration details
         """
-        return {
-            "name": "Google Gemini",
-            "id": "gemini",
-            "default_model": self.model,
-            "models": [
+        models = self.available_models()
+        if not models:
+            # Use default models if the API key is missing or the API cannot be reached
+            models = [
                 {"id": "gemini-pro", "name": "Gemini Pro"},
                 {"id": "gemini-1.5-pro", "name": "Gemini 1.5 Pro"},
                 {"id": "gemini-1.0-pro", "name": "Gemini 1.0 Pro"}
             ]
+
+        return {
+            "name": "Google Gemini",
+            "id": "gemini",
+            "default_model": self.model,
+            "models": models
         }
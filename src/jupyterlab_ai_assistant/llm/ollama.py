@@ -1,183 +1,304 @@
 import os
 import json
+import logging
+import threading
+import time
 import requests
-from typing import Dict, List, Any, Optional
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Any, Iterator, Optional, Set, Tuple
 from .base import BaseLLM
+from .prompt import token_usage
+
+logger = logging.getLogger(__name__)
+
+# How long Ollama keeps a model loaded after a request, e.g. "30m", "-1" for
+# forever or "0" to unload at once; unset leaves the server default
+OLLAMA_KEEP_ALIVE = os.environ.get("AI_ASSISTANT_OLLAMA_KEEP_ALIVE", "30m")
+
+# Seconds without data before a request gives up; a cold model load happens
+# before the first chunk arrives
+OLLAMA_TIMEOUT = float(os.environ.get("AI_ASSISTANT_OLLAMA_TIMEOUT", "60"))
+
+# Seconds the installed model list (/api/tags) and loaded model list (/api/ps) are cached
+OLLAMA_TAGS_TTL = float(os.environ.get("AI_ASSISTANT_OLLAMA_TAGS_TTL", "60"))
+OLLAMA_PS_TTL = float(os.environ.get("AI_ASSISTANT_OLLAMA_PS_TTL", "10"))
+
+# Expected extra latency of a request to a model that is not loaded yet
+OLLAMA_COLD_START = float(os.environ.get("AI_ASSISTANT_OLLAMA_COLD_START", "15"))
+
+# Pooled sessions and cached server state, by server URL
+_sessions: Dict[str, requests.Session] = {}
+_tags: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+_loaded: Dict[str, Tuple[float, Set[str]]] = {}
+_lock = threading.Lock()
+
+
+def _session(base_url: str) -> requests.Session:
+    """
+    Get the pooled session for an Ollama server
+
+    All instances talking to the same server share one session, so requests
+    reuse keep-alive connections instead of opening one per call.
+
+    Args:
+        base_url: Ollama server URL
+
+    Returns:
+        Session with a connection pool as large as the executor
+    """
+    with _lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            pool_size = int(os.environ.get("AI_ASSISTANT_MAX_WORKERS", "8"))
+            session = requests.Session()
+            session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            _sessions[base_url] = session
+        return session
+
+
+def _iter_ndjson(response: requests.Response) -> Iterator[Dict[str, Any]]:
+    """
+    Parse newline-delimited JSON from a streamed response as it arrives
+
+    ``iter_content(chunk_size=None)`` hands over each chunk as soon as it is
+    received, rather than waiting for a fixed number of bytes, so every
+    object is parsed as soon as its line is complete.
+
+    Args:
+        response: Response opened with ``stream=True``
+
+    Yields:
+        Decoded JSON objects
+    """
+    buffer = b""
+    for data in response.iter_content(chunk_size=None):
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
 
 
 class OllamaLLM(BaseLLM):
     """
     Ollama LLM implementation for local models
     """
-    
-    def __init__(self):
+
+    default_model = "llama3"
+    llm_type = "ollama"
+    provider_name = "Ollama"
+
+    def __init__(self, model: Optional[str] = None):
         """Initialize the Ollama client"""
-        self.model = "llama3"
+        super().__init__(model)
         self.base_url = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
         self.api_url = f"{self.base_url}/api"
-    
-    def generate_response(self, prompt: str, messages: List[Dict[str, Any]], 
-                         notebook_content: Dict[str, Any]) -> Dict[str, Any]:
+        self.session = _session(self.base_url)
+
+    def _ollama_messages(self, system: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
-        Generate a response from Ollama
-        
+        Convert a conversation to Ollama format
+
         Args:
-            prompt: Current prompt/question from the user
-            messages: Chat history
-            notebook_content: Content of the notebook including code cells and outputs
-            
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts
+
         Returns:
-            Dict with LLM response
-        """
-        # Format notebook content
-        notebook_context = self.format_notebook_context(notebook_content)
-        
-        # Prepare the messages for Ollama
-        ollama_messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are an expert coding assistant in JupyterLab. You have access to the current notebook "
-                    "content and chat history. Provide helpful, concise responses to code-related questions. "
-                    "When providing code suggestions, ensure they are correct, well-documented, and follow best practices. "
-                    "You can reference specific cells from the notebook in your responses. "
-                    "For code suggestions, wrap the code in ```python and ``` tags."
-                )
-            }
-        ]
-        
-        # Add previous messages
+            List of Ollama chat messages
+        """
+        ollama_messages = [{"role": "system", "content": system}]
         for msg in messages:
             role = msg.get("role", "user")
             if role not in ["system", "user", "assistant"]:
                 role = "user"
-            
+
             ollama_messages.append({
                 "role": role,
                 "content": msg.get("content", "")
             })
-        
-        # Add current message with notebook context
-        ollama_messages.append({
-            "role": "user",
-            "content": f"Current notebook:\n{notebook_context}\n\nUser request: {prompt}"
-        })
-        
-        # Prepare the request to Ollama
+        return ollama_messages
+
+    @staticmethod
+    def _usage(response_data: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Convert Ollama token counts
+
+        Ollama keeps the KV cache of the previous request and only evaluates
+        the prompt after the common prefix, which shows up as a lower
+        ``prompt_eval_count`` rather than as a separate cached count.
+
+        Args:
+            response_data: Final response object of a chat request
+
+        Returns:
+            Token counts from ``token_usage``
+        """
+        return token_usage(response_data.get("prompt_eval_count"), response_data.get("eval_count"))
+
+    def _chat_body(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build the body of a streamed /api/chat request"""
         data = {
             "model": self.model,
-            "messages": ollama_messages,
-            "stream": False
+            "messages": messages,
+            "stream": True
         }
-        
-        # Generate response from Ollama
+        if OLLAMA_KEEP_ALIVE:
+            # Ollama reads bare numbers as seconds but needs a unit in strings
+            try:
+                data["keep_alive"] = int(OLLAMA_KEEP_ALIVE)
+            except ValueError:
+                data["keep_alive"] = OLLAMA_KEEP_ALIVE
+        return data
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]],
+                  max_tokens: int) -> Dict[str, Any]:
+        """
+        Generate a completion from Ollama
+
+        The completion is streamed and joined here, so the read timeout
+        applies between chunks rather than to the whole generation.
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, Ollama applies the model's own limit
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        parts = []
+        usage = None
+        for chunk in self._stream(system, messages, max_tokens):
+            parts.append(chunk.get("content", ""))
+            usage = chunk.get("usage") or usage
+        return {"content": "".join(parts), "usage": usage}
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]],
+                max_tokens: int) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a completion from Ollama
+
+        Ollama streams newline-delimited JSON objects, one per generated chunk.
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, Ollama applies the model's own limit
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        data = self._chat_body(self._ollama_messages(system, messages))
+
+        with self.session.post(f"{self.api_url}/chat", json=data,
+                               timeout=(5, OLLAMA_TIMEOUT), stream=True) as response:
+            response.raise_for_status()
+            for chunk in _iter_ndjson(response):
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                content = chunk.get("message", {}).get("content", "")
+                if content:
+                    yield {"content": content}
+                if chunk.get("done"):
+                    self._mark_loaded()
+                    yield {"usage": self._usage(chunk)}
+                    break
+
+    def loaded_models(self) -> Set[str]:
+        """
+        Get the models the server currently holds in memory
+
+        The list from ``/api/ps`` is cached for ``OLLAMA_PS_TTL`` seconds.
+
+        Returns:
+            Names of the loaded models, empty if the server is unreachable
+        """
+        now = time.monotonic()
+        with _lock:
+            entry = _loaded.get(self.base_url)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
         try:
-            response = requests.post(f"{self.api_url}/chat", json=data, timeout=60)
+            response = self.session.get(f"{self.api_url}/ps", timeout=2)
             response.raise_for_status()
-            
-            response_data = response.json()
-            content = response_data.get("message", {}).get("content", "")
-            
-            return {
-                "content": content,
-                "has_code": "```" in content,
-                "model": self.model,
-                "provider": "Ollama"
-            }
+            loaded = {model["name"] for model in response.json().get("models", [])}
         except Exception as e:
-            return {
-                "content": f"Error generating response: {str(e)}",
-                "has_code": False,
-                "model": self.model,
-                "provider": "Ollama",
-                "error": True
-            }
-    
-    def fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> str:
-        """
-        Fix errors in the code using Ollama
-        
-        Args:
-            code: The code with errors
-            errors: List of error messages and details
-            
+            logger.debug(f"Could not list loaded Ollama models: {e}")
+            loaded = set()
+
+        with _lock:
+            _loaded[self.base_url] = (now + OLLAMA_PS_TTL, loaded)
+        return loaded
+
+    def _mark_loaded(self) -> None:
+        """Remember that the model is loaded after a request it answered"""
+        with _lock:
+            entry = _loaded.get(self.base_url)
+            if entry is not None:
+                entry[1].add(self._tagged_model())
+
+    def _tagged_model(self) -> str:
+        """Model name as listed by Ollama, which adds ``:latest`` to untagged names"""
+        return self.model if ":" in self.model else f"{self.model}:latest"
+
+    def startup_delay(self) -> float:
+        """
+        Estimate the extra latency before the model starts answering
+
         Returns:
-            Fixed code as a string
+            ``OLLAMA_COLD_START`` if the model is not loaded, otherwise 0
         """
-        error_text = "\n".join([f"Error {i+1}: {error.get('message', '')}" 
-                               for i, error in enumerate(errors)])
-        
-        data = {
-            "model": self.model,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are an expert Python code debugger. When provided code with errors, fix the errors and return only the corrected code without explanations or markdown formatting."
-                },
-                {
-                    "role": "user",
-                    "content": f"""
-                    Fix the following Python code that has errors:
-                    
-                    ```python
-                    {code}
-                    ```
-                    
-                    Errors:
-                    {error_text}
-                    
-                    Provide only the fixed code without explanations.
-                    """
-                }
-            ],
-            "stream": False
-        }
-        
+        return 0.0 if self._tagged_model() in self.loaded_models() else OLLAMA_COLD_START
+
+    def installed_models(self) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the models installed on the server
+
+        The list from ``/api/tags`` is cached for ``OLLAMA_TAGS_TTL`` seconds.
+
+        Returns:
+            List of ``{"id", "name"}`` dicts, or None if the server is unreachable
+        """
+        now = time.monotonic()
+        with _lock:
+            entry = _tags.get(self.base_url)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
         try:
-            response = requests.post(f"{self.api_url}/chat", json=data, timeout=60)
+            response = self.session.get(f"{self.api_url}/tags", timeout=5)
             response.raise_for_status()
-            
-            response_data = response.json()
-            fixed_code = response_data.get("message", {}).get("content", "")
-            
-            # Clean up any markdown code blocks
-            if fixed_code.startswith("```python"):
-                fixed_code = fixed_code.replace("```python", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-            elif fixed_code.startswith("```"):
-                fixed_code = fixed_code.replace("```", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-                    
-            return fixed_code.strip()
+            models = [{"id": model["name"], "name": model["name"]} for model in response.json().get("models", [])]
         except Exception as e:
-            return f"# Error fixing code: {str(e)}\n{code}"
-    
+            logger.debug(f"Could not list installed Ollama models: {e}")
+            return None
+
+        with _lock:
+            _tags[self.base_url] = (now + OLLAMA_TAGS_TTL, models)
+        return models
+
     def get_config(self) -> Dict[str, Any]:
         """
         Get configuration for this LLM
-        
+
         Returns:
             Dictionary with configuration details
         """
         # Try to get available models from Ollama
-        models = [
-            {"id": "llama3", "name": "Llama 3"},
-            {"id": "mistral", "name": "Mistral"},
-            {"id": "codellama", "name": "Code Llama"},
-            {"id": "llama2", "name": "Llama 2"}
-        ]
-        
-        try:
-            response = requests.get(f"{self.api_url}/tags", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                models = [{"id": model["name"], "name": model["name"]} for model in data.get("models", [])]
-        except:
+        models = self.installed_models()
+        if models is None:
             # Use default models if Ollama isn't available
-            pass
-        
+            models = [
+                {"id": "llama3", "name": "Llama 3"},
+                {"id": "mistral", "name": "Mistral"},
+                {"id": "codellama", "name": "Code Llama"},
+                {"id": "llama2", "name": "Llama 2"}
+            ]
+
         return {
             "name": "Ollama",
             "id": "ollama",
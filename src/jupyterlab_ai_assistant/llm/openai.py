@@ -1,174 +1,193 @@
-import os
-import json
-from typing import Dict, List, Any, Optional
-import openai
-from openai import OpenAI
+from typing import Dict, List, Any, AsyncIterator, Iterator, Optional
+from openai import AsyncOpenAI, OpenAI
 from .base import BaseLLM
+from .prompt import token_usage
 
 
 class OpenAILLM(BaseLLM):
     """
     OpenAI LLM implementation
     """
-    
-    def __init__(self):
+
+    # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
+    # do not change this unless explicitly requested by the user
+    default_model = "gpt-4o"
+    llm_type = "openai"
+    provider_name = "OpenAI"
+    api_key_env = "OPENAI_API_KEY"
+
+    def __init__(self, model: Optional[str] = None):
         """Initialize the OpenAI client"""
-        # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
-        # do not change this unless explicitly requested by the user
-        self.model = "gpt-4o"
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
+        super().__init__(model)
+        self._async_client = None
+        if not self.api_key:
             self.client = None
         else:
             try:
-                self.client = OpenAI(api_key=api_key)
-            except Exception as e:
+                # Retries are left to BaseLLM, which shares one policy across providers
+                self.client = OpenAI(api_key=self.api_key, max_retries=0)
+            except Exception:
                 self.client = None
-    
-    def generate_response(self, prompt: str, messages: List[Dict[str, Any]], 
-                         notebook_content: Dict[str, Any]) -> Dict[str, Any]:
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Async client, created on first use since only the Jupyter server extension needs it"""
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        return self._async_client
+
+    def unavailable_reason(self) -> Optional[str]:
         """
-        Generate a response from OpenAI
-        
-        Args:
-            prompt: Current prompt/question from the user
-            messages: Chat history
-            notebook_content: Content of the notebook including code cells and outputs
-            
+        Explain why this LLM cannot serve requests
+
         Returns:
-            Dict with LLM response
+            Error message, or None if the client is configured
         """
         # Check if client is None (API key not set or invalid)
         if self.client is None:
-            return {
-                "content": "Error: OpenAI API key is not set or is invalid. Please provide a valid API key in the settings.",
-                "has_code": False,
-                "model": self.model,
-                "provider": "OpenAI",
-                "error": True
-            }
-            
-        # Format notebook content
-        notebook_context = self.format_notebook_context(notebook_content)
-        
-        # Prepare the system message with instructions
-        system_message = {
-            "role": "system",
-            "content": (
-                "You are an expert coding assistant in JupyterLab. You have access to the current notebook "
-                "content and chat history. Provide helpful, concise responses to code-related questions. "
-                "When providing code suggestions, ensure they are correct, well-documented, and follow best practices. "
-                "You can reference specific cells from the notebook in your responses. "
-                "For code suggestions, wrap the code in ```python and ``` tags."
-            )
-        }
-        
-        # Format the user message with notebook context and prompt
-        user_message = {
-            "role": "user",
-            "content": f"Current notebook:\n{notebook_context}\n\nUser request: {prompt}"
-        }
-        
-        # Convert previous messages to OpenAI format
-        formatted_messages = [system_message]
+            return "OpenAI API key is not set or is invalid. Please provide a valid API key in the settings."
+        return None
+
+    def _openai_messages(self, system: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Convert a conversation to OpenAI format
+
+        Args:
+            system: System prompt
+            messages: Conversation as ``{"role", "content"}`` dicts
+
+        Returns:
+            List of OpenAI chat messages
+        """
+        formatted_messages = [{"role": "system", "content": system}]
         for msg in messages:
             formatted_messages.append({
                 "role": msg.get("role", "user"),
                 "content": msg.get("content", "")
             })
-        
-        # Add the current message
-        formatted_messages.append(user_message)
-        
-        # Generate response from OpenAI
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=formatted_messages
-            )
-            
-            content = response.choices[0].message.content
-            return {
-                "content": content,
-                "has_code": "```" in content,
-                "model": self.model,
-                "provider": "OpenAI"
-            }
-        except Exception as e:
-            return {
-                "content": f"Error generating response: {str(e)}",
-                "has_code": False,
-                "model": self.model,
-                "provider": "OpenAI",
-                "error": True
-            }
-    
-    def fix_errors(self, code: str, errors: List[Dict[str, Any]]) -> str:
-        """
-        Fix errors in the code using OpenAI
-        
+        return formatted_messages
+
+    @staticmethod
+    def _usage(usage: Any) -> Optional[Dict[str, int]]:
+        """
+        Convert OpenAI token usage, including prompt tokens served from the prefix cache
+
+        OpenAI caches prompt prefixes of 1024 tokens and more automatically,
+        which the stable layout of ``chat_prompt`` makes use of.
+
         Args:
-            code: The code with errors
-            errors: List of error messages and details
-            
+            usage: ``usage`` of a completion or of the last stream chunk
+
         Returns:
-            Fixed code as a string
+            Token counts from ``token_usage``, or None if not reported
         """
-        # Check if client is None (API key not set or invalid)
-        if self.client is None:
-            return f"# Error: OpenAI API key is not set or is invalid. Please provide a valid API key in the settings.\n{code}"
-            
-        error_text = "\n".join([f"Error {i+1}: {error.get('message', '')}" 
-                               for i, error in enumerate(errors)])
-        
-        prompt = f"""
-        Fix the following Python code that has errors:
-        
-        ```python
-        {code}
-        ```
-        
-        Errors:
-        {error_text}
-        
-        Provide only the fixed code without explanations.
-        """
-        
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are an expert Python code debugger. When provided code with errors, fix the errors and return only the corrected code without explanations or markdown formatting."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
-            
-            fixed_code = response.choices[0].message.content
-            
-            # Clean up any markdown code blocks
-            if fixed_code.startswith("```python"):
-                fixed_code = fixed_code.replace("```python", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-            elif fixed_code.startswith("```"):
-                fixed_code = fixed_code.replace("```", "", 1)
-                if fixed_code.endswith("```"):
-                    fixed_code = fixed_code[:-3]
-                    
-            return fixed_code.strip()
-        except Exception as e:
-            return f"# Error fixing code: {str(e)}\n{code}"
-    
+        if usage is None:
+            return None
+        details = getattr(usage, "prompt_tokens_details", None)
+        return token_usage(
+            usage.prompt_tokens,
+            usage.completion_tokens,
+            cached_input_tokens=getattr(details, "cached_tokens", None)
+        )
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]],
+                  max_tokens: int) -> Dict[str, Any]:
+        """
+        Generate a completion from OpenAI
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, OpenAI applies the model's own limit
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(system, messages)
+        )
+        return {"content": response.choices[0].message.content, "usage": self._usage(response.usage)}
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]],
+                max_tokens: int) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a completion from OpenAI
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, OpenAI applies the model's own limit
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(system, messages),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        # Closing the stream releases the connection if the consumer stops early
+        with stream:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"content": chunk.choices[0].delta.content}
+                # Usage arrives in a final chunk without choices
+                if chunk.usage:
+                    yield {"usage": self._usage(chunk.usage)}
+
+    async def _acomplete(self, system: str, messages: List[Dict[str, Any]],
+                         max_tokens: int) -> Dict[str, Any]:
+        """
+        Async version of ``_complete`` using the async OpenAI client
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, OpenAI applies the model's own limit
+
+        Returns:
+            Dict with the generated text under ``content`` and token counts under ``usage``
+        """
+        response = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(system, messages)
+        )
+        return {"content": response.choices[0].message.content, "usage": self._usage(response.usage)}
+
+    async def _astream(self, system: str, messages: List[Dict[str, Any]],
+                       max_tokens: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Async version of ``_stream`` using the async OpenAI client
+
+        Args:
+            system: System prompt
+            messages: Conversation ending with the user turn
+            max_tokens: Unused, OpenAI applies the model's own limit
+
+        Yields:
+            Dicts with the next piece of generated text under ``content``,
+            then one with token counts under ``usage``
+        """
+        stream = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=self._openai_messages(system, messages),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"content": chunk.choices[0].delta.content}
+                if chunk.usage:
+                    yield {"usage": self._usage(chunk.usage)}
+
     def get_config(self) -> Dict[str, Any]:
         """
         Get configuration for this LLM
-        
+
         Returns:
             Dictionary with configuration details
         """
@@ -0,0 +1,121 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+CHAT_SYSTEM_PROMPT = (
+    "You are an expert coding assistant in JupyterLab. You have access to the current notebook "
+    "content and chat history. Provide helpful, concise responses to code-related questions. "
+    "When providing code suggestions, ensure they are correct, well-documented, and follow best practices. "
+    "You can reference specific cells from the notebook in your responses. "
+    "For code suggestions, wrap the code in ```python and ``` tags."
+)
+
+FIX_SYSTEM_PROMPT = (
+    "You are an expert Python code debugger. When provided code with errors, fix the errors and return "
+    "only the corrected code without explanations or markdown formatting."
+)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You keep the running summary of a conversation between a user and a coding assistant in JupyterLab. "
+    "Merge the new turns into the summary. Keep the user's goals, the decisions taken, the names of "
+    "variables, functions, files and libraries involved, and code the user accepted; leave out greetings "
+    "and repetition. Reply with the updated summary only."
+)
+
+
+def chat_prompt(notebook_context: str, history: List[Dict[str, Any]],
+                prompt: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Lay out a chat request so that it starts with a stable prefix
+
+    Providers cache the longest previously seen prefix of a prompt, so the
+    parts that change least come first: the instructions, then the notebook,
+    then the chat history, which only grows at the end. Only the new user
+    request follows the cached part.
+
+    Args:
+        notebook_context: Rendered notebook, see ``build_chat_context``
+        history: Chat history as ``{"role", "content"}`` dicts
+        prompt: Current prompt/question from the user
+
+    Returns:
+        Tuple of system prompt and messages, ending with the user turn
+    """
+    system = CHAT_SYSTEM_PROMPT
+    if notebook_context:
+        system = f"{system}\n\nCurrent notebook:\n{notebook_context}"
+
+    messages = [
+        {"role": msg.get("role", "user"), "content": msg.get("content", "")}
+        for msg in history
+    ]
+    messages.append({"role": "user", "content": prompt})
+    return system, messages
+
+
+def fix_prompt(code: str, errors: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Lay out an error fixing request
+
+    Args:
+        code: The code with errors
+        errors: List of error messages and details
+
+    Returns:
+        Tuple of system prompt and messages
+    """
+    error_text = "\n".join([f"Error {i+1}: {error.get('message', '')}"
+                           for i, error in enumerate(errors)])
+
+    prompt = f"""
+        Fix the following Python code that has errors:
+
+        ```python
+        {code}
+        ```
+
+        Errors:
+        {error_text}
+
+        Provide only the fixed code without explanations.
+        """
+    return FIX_SYSTEM_PROMPT, [{"role": "user", "content": prompt}]
+
+
+def summary_prompt(summary: str, messages: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Lay out a request folding chat turns into the summary of a conversation
+
+    Args:
+        summary: Summary of the turns before ``messages``, empty if none
+        messages: Turns to fold in, as ``{"role", "content"}`` dicts
+
+    Returns:
+        Tuple of system prompt and messages
+    """
+    turns = "\n\n".join(f"{msg.get('role', 'user').capitalize()}: {msg.get('content', '')}" for msg in messages)
+    prompt = f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{turns}"
+    return SUMMARY_SYSTEM_PROMPT, [{"role": "user", "content": prompt}]
+
+
+def token_usage(input_tokens: Optional[int], output_tokens: Optional[int],
+                cached_input_tokens: Optional[int] = None,
+                cache_write_tokens: Optional[int] = None) -> Dict[str, int]:
+    """
+    Normalize the token counts reported by a provider
+
+    Args:
+        input_tokens: Prompt tokens, including cached ones
+        output_tokens: Generated tokens
+        cached_input_tokens: Prompt tokens read from the provider's prefix cache
+        cache_write_tokens: Prompt tokens written to the provider's prefix cache
+
+    Returns:
+        Dict of the counts the provider reported, as included in responses
+        under ``usage``
+    """
+    usage = {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "cache_write_tokens": cache_write_tokens
+    }
+    return {name: count for name, count in usage.items() if count is not None}
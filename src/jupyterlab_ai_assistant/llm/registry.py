@@ -0,0 +1,239 @@
+import importlib
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Type, Union
+
+from .. import metrics
+from .base import BaseLLM
+
+logger = logging.getLogger(__name__)
+
+# Entry point group through which other packages add providers, e.g. in pyproject.toml:
+#   [project.entry-points."jupyterlab_ai_assistant.providers"]
+#   mistral = "my_package.mistral:MistralLLM"
+ENTRY_POINT_GROUP = "jupyterlab_ai_assistant.providers"
+
+# Built-in providers as (import path relative to this package, default model);
+# the default model is repeated here so resolving a request does not import
+# the provider's SDK
+_BUILTIN_PROVIDERS = {
+    "openai": (".openai:OpenAILLM", "gpt-4o"),
+    "anthropic": (".anthropic:AnthropicLLM", "claude-3-5-sonnet-20241022"),
+    "gemini": (".gemini:GeminiLLM", "gemini-pro"),
+    "ollama": (".ollama:OllamaLLM", "llama3"),
+}
+
+
+class UnavailableLLM(BaseLLM):
+    """Stand-in for a provider that failed to import, e.g. because its SDK is not installed"""
+
+    def __init__(self, model: Optional[str] = None, llm_type: str = "", error: str = ""):
+        """
+        Args:
+            model: Model that was requested
+            llm_type: Type of the provider that failed to import
+            error: Why it failed
+        """
+        self.llm_type = llm_type
+        self.provider_name = llm_type
+        super().__init__(model)
+        self.error = error
+
+    def unavailable_reason(self) -> Optional[str]:
+        """Report the import error, which turns every request into an error response"""
+        return f"The {self.llm_type} provider could not be loaded: {self.error}"
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]], max_tokens: int) -> Dict[str, Any]:
+        """Never called, requests are refused by ``unavailable_reason``"""
+        raise RuntimeError(self.unavailable_reason())
+
+    def get_config(self) -> Dict[str, Any]:
+        """Get the configuration of the missing provider"""
+        return {"llm_type": self.llm_type, "model": self.model, "available": False}
+
+
+class ProviderRegistry:
+    """
+    LLM providers by type, imported on first use
+
+    Providers are registered as ``module:Class`` import paths, so starting
+    the server does not import every provider SDK; a provider's module is
+    imported when a request first needs it. Besides the built-in providers,
+    packages can register their own through the ``ENTRY_POINT_GROUP`` entry
+    points, which are read on the first lookup of a type that is not
+    registered. Thread-safe.
+    """
+
+    def __init__(self):
+        """Initialize the registry with the built-in providers"""
+        self._paths: Dict[str, str] = {}
+        self._default_models: Dict[str, str] = {}
+        self._classes: Dict[str, Type[BaseLLM]] = {}
+        self._errors: Dict[str, str] = {}
+        self._entry_points_loaded = False
+        self._lock = threading.RLock()
+        for llm_type, (path, default_model) in _BUILTIN_PROVIDERS.items():
+            self.register(llm_type, path, default_model)
+
+    def register(self, llm_type: str, provider: Union[str, Type[BaseLLM]],
+                 default_model: Optional[str] = None) -> None:
+        """
+        Register a provider, replacing any registered under the same type
+
+        Args:
+            llm_type: Type name requests use to select the provider
+            provider: ``BaseLLM`` subclass, or its ``module:Class`` import
+                path, where a module starting with a dot is relative to this package
+            default_model: Model used when a request names none; read from
+                the class when it is first needed if not given
+        """
+        with self._lock:
+            self._classes.pop(llm_type, None)
+            self._errors.pop(llm_type, None)
+            if isinstance(provider, str):
+                self._paths[llm_type] = provider
+            else:
+                self._paths.pop(llm_type, None)
+                self._classes[llm_type] = provider
+            if default_model:
+                self._default_models[llm_type] = default_model
+                metrics.list_models(llm_type, [default_model])
+            else:
+                self._default_models.pop(llm_type, None)
+
+    def _load_entry_points(self) -> None:
+        """Register the providers of installed packages; the lock must be held"""
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        try:
+            from importlib.metadata import entry_points
+            selected = entry_points()
+            # The group keyword only exists from Python 3.10
+            found = (selected.select(group=ENTRY_POINT_GROUP) if hasattr(selected, "select")
+                     else selected.get(ENTRY_POINT_GROUP, []))
+        except Exception as e:
+            logger.warning(f"Could not read {ENTRY_POINT_GROUP} entry points: {e}")
+            return
+        for entry_point in found:
+            if entry_point.name in self._paths or entry_point.name in self._classes:
+                logger.warning(f"Ignoring provider entry point {entry_point.value}, "
+                               f"{entry_point.name} is already registered")
+                continue
+            self._paths[entry_point.name] = entry_point.value
+
+    def __contains__(self, llm_type: str) -> bool:
+        """Whether a provider is registered under a type"""
+        with self._lock:
+            if llm_type not in self._paths and llm_type not in self._classes:
+                self._load_entry_points()
+            return llm_type in self._paths or llm_type in self._classes
+
+    def types(self) -> List[str]:
+        """
+        List the registered provider types
+
+        Returns:
+            Types in registration order, built-in providers first
+        """
+        with self._lock:
+            self._load_entry_points()
+            return list(dict.fromkeys([*self._paths, *self._classes]))
+
+    def is_loaded(self, llm_type: str) -> bool:
+        """Whether a provider's class has been imported"""
+        with self._lock:
+            return llm_type in self._classes
+
+    def get(self, llm_type: str) -> Optional[Type[BaseLLM]]:
+        """
+        Get a provider's class, importing it on first use
+
+        Args:
+            llm_type: Registered provider type
+
+        Returns:
+            The class, or None if importing it failed; ``load_error`` says why
+
+        Raises:
+            KeyError: If no provider is registered under the type
+        """
+        with self._lock:
+            provider = self._classes.get(llm_type)
+            if provider is not None:
+                return provider
+            if llm_type in self._errors:
+                return None
+            if llm_type not in self:
+                raise KeyError(llm_type)
+            path = self._paths[llm_type]
+
+        # Imported without holding the lock, so loaded providers stay available
+        # meanwhile; Python's import lock keeps concurrent imports safe
+        module_name, _, class_name = path.partition(":")
+        started = time.perf_counter()
+        try:
+            provider = getattr(importlib.import_module(module_name, __package__), class_name)
+        except Exception as e:
+            logger.error(f"Could not load the {llm_type} provider from {path}: {e}")
+            with self._lock:
+                if self._paths.get(llm_type) == path:
+                    self._errors[llm_type] = str(e)
+            return None
+
+        with self._lock:
+            if self._paths.get(llm_type) != path:
+                # Registered again while importing
+                return self._classes.get(llm_type) or provider
+            if llm_type not in self._classes:
+                logger.info(f"Loaded the {llm_type} provider in {time.perf_counter() - started:.2f}s")
+                self._classes[llm_type] = provider
+                metrics.list_models(llm_type, [provider.default_model])
+            return self._classes[llm_type]
+
+    def load_error(self, llm_type: str) -> Optional[str]:
+        """Why importing a provider failed, None if it did not"""
+        with self._lock:
+            return self._errors.get(llm_type)
+
+    def default_model(self, llm_type: str, load: bool = True) -> str:
+        """
+        Get the model a provider uses when a request names none
+
+        Args:
+            llm_type: Registered provider type
+            load: Whether to import the provider if its default model was not registered
+
+        Returns:
+            Model name, empty if the provider could not be loaded or ``load`` is False
+        """
+        with self._lock:
+            default_model = self._default_models.get(llm_type)
+            provider = self._classes.get(llm_type)
+        if default_model is not None:
+            return default_model
+        if provider is None and not load:
+            return ""
+        provider = provider or self.get(llm_type)
+        return provider.default_model if provider is not None else ""
+
+    def create(self, llm_type: str, model: Optional[str] = None) -> BaseLLM:
+        """
+        Create an instance of a provider
+
+        Args:
+            llm_type: Registered provider type
+            model: Model to use, defaults to the provider's default model
+
+        Returns:
+            The instance, or an ``UnavailableLLM`` explaining why the provider could not be loaded
+        """
+        provider = self.get(llm_type)
+        if provider is None:
+            return UnavailableLLM(model, llm_type, self.load_error(llm_type) or "")
+        return provider(model=model)
+
+
+# Process-wide registry used by ``get_llm_instance``
+provider_registry = ProviderRegistry()
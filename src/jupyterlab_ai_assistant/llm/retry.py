@@ -0,0 +1,129 @@
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Attempts per provider call, including the first one
+RETRY_ATTEMPTS = int(os.environ.get("AI_ASSISTANT_RETRY_ATTEMPTS", "3"))
+
+# Backoff before the first retry, doubled for each further one
+RETRY_BASE_DELAY = float(os.environ.get("AI_ASSISTANT_RETRY_BASE_DELAY", "0.5"))
+
+# Longest wait before a retry; a provider asking for more is given up on,
+# leaving the request to the fallback chain
+RETRY_MAX_DELAY = float(os.environ.get("AI_ASSISTANT_RETRY_MAX_DELAY", "10"))
+
+# HTTP statuses of transient failures: timeouts, conflicts, rate limits and
+# server errors, including Anthropic's 529 overloaded
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# HTTP statuses meaning the provider will not serve any request, e.g. a bad API key
+UNAVAILABLE_STATUSES = {401, 403}
+
+# Exception class names of network failures in the provider SDKs and requests
+_NETWORK_ERRORS = {"APIConnectionError", "APITimeoutError", "ConnectionError", "Timeout"}
+
+
+def error_status(error: Exception) -> Optional[int]:
+    """
+    Get the HTTP status of a provider error
+
+    Args:
+        error: Exception raised by a provider SDK or ``requests``
+
+    Returns:
+        Status code, or None if the error has none, e.g. a network failure
+    """
+    # OpenAI and Anthropic errors carry it directly, requests errors on the response
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    # google.api_core errors use ``code``
+    if status is None:
+        status = getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Check whether a provider error is transient, so that the call may succeed when repeated
+
+    Args:
+        error: Exception raised by a provider
+
+    Returns:
+        True for rate limits, server errors, timeouts and network failures
+    """
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _NETWORK_ERRORS for cls in type(error).__mro__)
+
+
+def is_provider_failure(error: Exception) -> bool:
+    """
+    Check whether a provider error says the provider is failing, rather than the request being invalid
+
+    Args:
+        error: Exception raised by a provider
+
+    Returns:
+        True for transient errors and rejected credentials
+    """
+    return is_retryable(error) or error_status(error) in UNAVAILABLE_STATUSES
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Read how long the provider asked to wait before retrying
+
+    Args:
+        error: Exception raised by a provider
+
+    Returns:
+        Seconds from the ``retry-after-ms`` or ``retry-after`` response
+        header, or None if the provider did not say
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # An HTTP date
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Decide whether and when to retry a failed provider call
+
+    Waits for as long as the provider asked, otherwise for a random time up
+    to an exponentially growing bound, so that clients failing together do
+    not retry together.
+
+    Args:
+        error: Exception raised by the failed attempt
+        attempt: Number of the failed attempt, starting at 0
+
+    Returns:
+        Seconds to wait before the next attempt, or None to give up
+    """
+    if attempt + 1 >= RETRY_ATTEMPTS or not is_retryable(error):
+        return None
+    delay = retry_after(error)
+    if delay is None:
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return delay if delay <= RETRY_MAX_DELAY else None
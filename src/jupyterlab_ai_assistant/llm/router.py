@@ -0,0 +1,149 @@
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .. import metrics
+from ..stats import LatencyTracker, latency_tracker
+from .context import CHARS_PER_TOKEN, context_window
+
+logger = logging.getLogger(__name__)
+
+# LLM type that lets the router pick the provider and model per request
+AUTO_LLM_TYPE = "auto"
+
+Candidate = Tuple[str, str]
+
+
+def _parse_candidates(value: str) -> List[Candidate]:
+    """Parse a comma-separated list of ``llm_type:model`` entries"""
+    candidates = []
+    for entry in value.split(","):
+        llm_type, _, model = entry.strip().partition(":")
+        if llm_type and model:
+            candidates.append((llm_type, model))
+    return candidates
+
+
+# Models the router chooses from, most preferred first
+AUTO_MODELS = _parse_candidates(os.environ.get(
+    "AI_ASSISTANT_AUTO_MODELS",
+    "openai:gpt-4o,anthropic:claude-3-5-sonnet-20241022,gemini:gemini-pro,"
+    "openai:gpt-3.5-turbo,anthropic:claude-3-haiku-20240307,ollama:llama3"
+))
+
+# Models the router may pick keep their name in the metrics labels
+for _llm_type, _model in AUTO_MODELS:
+    metrics.list_models(_llm_type, [_model])
+
+# p95 latency in seconds above which a model counts as too slow for a task
+AUTO_LATENCY_TARGETS = {
+    "chat": float(os.environ.get("AI_ASSISTANT_AUTO_CHAT_TARGET", "30")),
+    "fix": float(os.environ.get("AI_ASSISTANT_AUTO_FIX_TARGET", "8")),
+}
+
+# Error rate above which a model counts as unhealthy
+AUTO_MAX_ERROR_RATE = float(os.environ.get("AI_ASSISTANT_AUTO_MAX_ERROR_RATE", "0.25"))
+
+# Tokens the answer needs on top of the prompt, as in BaseLLM
+_OUTPUT_TOKENS = {"chat": 4000, "fix": 2000}
+
+
+def estimate_chat_tokens(prompt: str, messages: List[Dict[str, Any]],
+                         notebook_content: Dict[str, Any]) -> int:
+    """
+    Roughly estimate the prompt size of a chat request without rendering it
+
+    Args:
+        prompt: Current prompt/question from the user
+        messages: Chat history
+        notebook_content: Content of the notebook including code cells and outputs
+
+    Returns:
+        Estimated prompt tokens
+    """
+    chars = len(prompt) + sum(len(msg.get("content") or "") for msg in messages)
+    for cell in notebook_content.get("cells", []):
+        chars += len(cell.get("source", ""))
+        for output in cell.get("outputs", []):
+            chars += len(output.get("text", "")) + len(output.get("data", {}).get("text/plain", ""))
+            chars += sum(len(line) for line in output.get("traceback", []))
+    return int(chars / CHARS_PER_TOKEN)
+
+
+def estimate_fix_tokens(code: str, errors: List[Dict[str, Any]]) -> int:
+    """
+    Roughly estimate the prompt size of an error fixing request
+
+    Args:
+        code: The code with errors
+        errors: List of error messages and details
+
+    Returns:
+        Estimated prompt tokens
+    """
+    chars = len(code) + sum(len(error.get("message", "")) for error in errors)
+    return int(chars / CHARS_PER_TOKEN)
+
+
+def choose_model(task: str, prompt_tokens: int, is_available: Callable[[str, str], bool],
+                 candidates: Optional[List[Candidate]] = None,
+                 tracker: LatencyTracker = latency_tracker,
+                 startup_delay: Optional[Callable[[str, str], float]] = None) -> Candidate:
+    """
+    Pick the model for a request routed with the ``auto`` LLM type
+
+    Only available models are considered, preferring those whose context
+    window holds the prompt and answer. A model is healthy when its recent
+    p95 latency is within the task's target and its error rate is below
+    ``AUTO_MAX_ERROR_RATE``; models without enough samples count as healthy.
+    Chat requests get the most preferred healthy model, error fixes the
+    healthy model with the lowest p50 latency. When no model is healthy,
+    for example under load, the one with the lowest expected latency is
+    chosen, which downgrades requests to faster models. The startup delay of
+    a model, such as loading a local model, adds to its latency.
+
+    Args:
+        task: ``"chat"`` or ``"fix"``
+        prompt_tokens: Estimated prompt size
+        is_available: Function telling whether (llm_type, model) can serve requests
+        candidates: Models to choose from, most preferred first, defaults to ``AUTO_MODELS``
+        tracker: Source of latency and error statistics
+        startup_delay: Function estimating the extra latency of (llm_type, model)
+            before it answers, e.g. to load it
+
+    Returns:
+        The chosen (llm_type, model)
+    """
+    candidates = candidates or AUTO_MODELS
+    target = AUTO_LATENCY_TARGETS.get(task, AUTO_LATENCY_TARGETS["chat"])
+
+    usable = [c for c in candidates if is_available(*c)]
+    if not usable:
+        # Let the most preferred model report why it is unavailable
+        return candidates[0]
+
+    needed = prompt_tokens + _OUTPUT_TOKENS.get(task, _OUTPUT_TOKENS["chat"])
+    usable = [c for c in usable if context_window(c[1]) >= needed] or usable
+
+    delays = {c: startup_delay(*c) if startup_delay else 0.0 for c in usable}
+
+    def healthy(candidate: Candidate) -> bool:
+        p95 = tracker.percentile(candidate, 95)
+        error_rate = tracker.error_rate(candidate)
+        return ((p95 or 0.0) + delays[candidate] <= target
+                and (error_rate is None or error_rate <= AUTO_MAX_ERROR_RATE))
+
+    def expected_latency(candidate: Candidate) -> float:
+        # Retries after failures make an unreliable model slower in effect
+        p50 = tracker.percentile(candidate, 50)
+        error_rate = tracker.error_rate(candidate) or 0.0
+        return ((target if p50 is None else p50) + delays[candidate]) / max(1.0 - error_rate, 0.05)
+
+    healthy_models = [c for c in usable if healthy(c)]
+    if healthy_models and task != "fix":
+        choice = healthy_models[0]
+    else:
+        choice = min(healthy_models or usable, key=expected_latency)
+
+    logger.debug(f"Routing {task} request of ~{prompt_tokens} tokens to {choice[0]}:{choice[1]}")
+    return choice
@@ -0,0 +1,204 @@
+import threading
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST
+
+# Registry of the assistant's own metrics, served at /ai-assistant/metrics;
+# kept apart from the default registry so Jupyter's /metrics is unaffected
+REGISTRY = CollectorRegistry()
+
+# Content type of ``render`` output
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+_LABELS = ("provider", "model", "endpoint")
+
+# ``model`` label of models no provider lists, so that model names sent by
+# clients cannot add time series without bound
+OTHER_MODEL = "other"
+
+# Models reported under their own name, by provider
+_listed_models: Dict[str, Set[str]] = {}
+_listed_lock = threading.Lock()
+
+REQUEST_SECONDS = Histogram(
+    "ai_assistant_request_duration_seconds",
+    "Time to answer a request, including cache hits",
+    _LABELS,
+    buckets=(0.01, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+    registry=REGISTRY
+)
+
+FIRST_TOKEN_SECONDS = Histogram(
+    "ai_assistant_time_to_first_token_seconds",
+    "Time from sending a streamed request to the provider until its first text arrives",
+    _LABELS,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+    registry=REGISTRY
+)
+
+CONTEXT_BUILD_SECONDS = Histogram(
+    "ai_assistant_context_build_seconds",
+    "Time to fit the notebook and chat history into the prompt",
+    ("provider", "model"),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    registry=REGISTRY
+)
+
+PAYLOAD_BYTES = Histogram(
+    "ai_assistant_payload_bytes",
+    "Size of HTTP request and response bodies",
+    ("endpoint", "direction"),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+    registry=REGISTRY
+)
+
+TOKENS = Counter(
+    "ai_assistant_tokens",
+    "Tokens reported by providers; kind is input, output, cached_input or cache_write",
+    _LABELS + ("kind",),
+    registry=REGISTRY
+)
+
+CACHE_HITS = Counter(
+    "ai_assistant_cache_hits",
+    "Requests answered from the response cache",
+    _LABELS,
+    registry=REGISTRY
+)
+
+SIMILAR_FIXES = Counter(
+    "ai_assistant_similar_fixes",
+    "Error fixing requests answered with the re-mapped fix of a similar cell, also counted as cache hits",
+    _LABELS,
+    registry=REGISTRY
+)
+
+COALESCED = Counter(
+    "ai_assistant_coalesced_requests",
+    "Requests that shared the provider call of an identical request in flight",
+    _LABELS,
+    registry=REGISTRY
+)
+
+ERRORS = Counter(
+    "ai_assistant_errors",
+    "Requests that failed",
+    _LABELS,
+    registry=REGISTRY
+)
+
+REJECTIONS = Counter(
+    "ai_assistant_rejected_requests",
+    "Requests rejected by admission control because the provider was saturated",
+    _LABELS,
+    registry=REGISTRY
+)
+
+FALLBACKS = Counter(
+    "ai_assistant_fallbacks",
+    "Requests answered by a fallback provider instead of the requested one",
+    ("provider", "fallback", "endpoint"),
+    registry=REGISTRY
+)
+
+SPECULATIVE_FIXES = Counter(
+    "ai_assistant_speculative_fixes",
+    "Error fixes requested before the user asked; outcome is started, cached, busy or over_budget, "
+    "and started fixes that then found no free slot are also counted as busy",
+    ("provider", "outcome"),
+    registry=REGISTRY
+)
+
+CANCELLED = Counter(
+    "ai_assistant_cancelled_requests",
+    "Requests cancelled by the client before they finished, including by closing the connection",
+    ("endpoint",),
+    registry=REGISTRY
+)
+
+JOBS = Counter(
+    "ai_assistant_jobs",
+    "Finished background jobs; status is done, failed or cancelled",
+    ("endpoint", "status"),
+    registry=REGISTRY
+)
+
+# Usage fields of responses, see ``prompt.token_usage``, and their ``kind`` label
+_TOKEN_KINDS: Tuple[Tuple[str, str], ...] = (
+    ("input_tokens", "input"),
+    ("output_tokens", "output"),
+    ("cached_input_tokens", "cached_input"),
+    ("cache_write_tokens", "cache_write"),
+)
+
+
+def list_models(provider: str, models: Iterable[str]) -> None:
+    """
+    Report models under their own name in the ``model`` label from now on
+
+    Called with each provider's default model, the models of the router and
+    the models each provider lists in the model catalog.
+
+    Args:
+        provider: LLM type the models belong to
+        models: Model names
+    """
+    with _listed_lock:
+        _listed_models.setdefault(provider, set()).update(model for model in models if model)
+
+
+def model_label(provider: str, model: str) -> str:
+    """
+    Get the ``model`` label of a model
+
+    Args:
+        provider: LLM type the model belongs to
+        model: Model name, as sent by the client
+
+    Returns:
+        The model name if the provider lists it, otherwise ``OTHER_MODEL``
+    """
+    with _listed_lock:
+        return model if model in _listed_models.get(provider, ()) else OTHER_MODEL
+
+
+def observe_result(provider: str, model: str, endpoint: str, result: Dict[str, Any],
+                   seconds: float) -> None:
+    """
+    Record a finished request
+
+    Args:
+        provider: LLM type that answered
+        model: Model that answered, reported as ``model_label`` gives it
+        endpoint: Kind of request, e.g. ``chat`` or ``fix``
+        result: Response dict, or the fields of the final stream event
+        seconds: Time taken to answer
+    """
+    labels = (provider, model_label(provider, model), endpoint)
+    REQUEST_SECONDS.labels(*labels).observe(seconds)
+    if result.get("cached"):
+        CACHE_HITS.labels(*labels).inc()
+        if result.get("similar"):
+            SIMILAR_FIXES.labels(*labels).inc()
+        return
+    if result.get("coalesced"):
+        COALESCED.labels(*labels).inc()
+        return
+    if result.get("error", False):
+        ERRORS.labels(*labels).inc()
+    usage: Optional[Dict[str, int]] = result.get("usage")
+    if usage:
+        for field, kind in _TOKEN_KINDS:
+            if usage.get(field):
+                TOKENS.labels(*labels, kind).inc(usage[field])
+
+
+def render() -> bytes:
+    """
+    Render all metrics in the Prometheus text format
+
+    Returns:
+        Body of a /ai-assistant/metrics response, of type ``CONTENT_TYPE``
+    """
+    return generate_latest(REGISTRY)
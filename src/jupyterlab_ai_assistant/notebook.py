@@ -0,0 +1,200 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _text(value: Any) -> str:
+    """Join multi-line notebook strings, which nbformat may store as lists"""
+    if isinstance(value, list):
+        return ''.join(value)
+    return value or ''
+
+
+def compact_output(output: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reduce a cell output to the fields used in the prompt
+
+    Rich outputs such as images and HTML never reach the LLM, so dropping
+    them keeps requests and cached notebooks small.
+
+    Args:
+        output: nbformat output
+
+    Returns:
+        Output with only its text representations
+    """
+    compact = {'output_type': output.get('output_type', '')}
+    if 'text' in output:
+        compact['text'] = _text(output['text'])
+    if 'text/plain' in output.get('data', {}):
+        compact['data'] = {'text/plain': _text(output['data']['text/plain'])}
+    if 'traceback' in output:
+        compact['traceback'] = list(output['traceback'])
+        compact['ename'] = output.get('ename', '')
+        compact['evalue'] = output.get('evalue', '')
+    return compact
+
+
+def compact_cell(cell: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reduce a notebook cell to the fields used in the prompt
+
+    Args:
+        cell: nbformat cell, or a cell as sent by the frontend
+
+    Returns:
+        Cell with its type, source and compacted outputs
+    """
+    compact = {
+        'cell_type': cell.get('cell_type', ''),
+        'source': _text(cell.get('source', ''))
+    }
+    if 'outputs' in cell:
+        compact['outputs'] = [compact_output(output) for output in cell['outputs']]
+    return compact
+
+
+def cell_hash(cell: Dict[str, Any]) -> str:
+    """
+    Hash the prompt-relevant content of a cell
+
+    Must stay in sync with ``cellHash`` in ``NotebookService.ts``: SHA-256 of
+    the compact JSON array ``[cell_type, source, [[output_type, text,
+    text/plain, traceback], ...]]``, truncated to 32 hex digits.
+
+    Args:
+        cell: nbformat cell, or a cell as sent by the frontend
+
+    Returns:
+        Hex digest of the cell
+    """
+    outputs = [
+        [
+            output.get('output_type', ''),
+            _text(output.get('text', '')),
+            _text(output.get('data', {}).get('text/plain', '')),
+            list(output.get('traceback', []))
+        ]
+        for output in cell.get('outputs', [])
+    ]
+    payload = [cell.get('cell_type', ''), _text(cell.get('source', '')), outputs]
+    encoded = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:32]
+
+
+class HashedCell(dict):
+    """
+    Compacted cell carrying under ``hash`` the ``cell_hash`` computed on the server
+
+    Request bodies decode to plain dicts, so a ``hash`` sent by a client is
+    never taken for one computed here.
+    """
+
+
+def hashed_cell(cell: Dict[str, Any]) -> HashedCell:
+    """
+    Compact a cell and hash its content
+
+    Args:
+        cell: nbformat cell, or a cell as sent by the frontend
+
+    Returns:
+        The compacted cell with its ``hash``
+    """
+    compact = HashedCell(compact_cell(cell))
+    compact['hash'] = cell_hash(compact)
+    return compact
+
+
+class SavedNotebookIndex:
+    """
+    Compacted cells of saved notebooks, indexed by cell hash
+
+    Entries are keyed by notebook path and invalidated when the file's
+    ``last_modified`` time changes, so a notebook is only parsed and hashed
+    again after it was saved.
+    """
+
+    def __init__(self, max_notebooks: int = 16):
+        """
+        Initialize the index
+
+        Args:
+            max_notebooks: Number of notebooks kept, least recently used first out
+        """
+        self.max_notebooks = max_notebooks
+        self._notebooks: "OrderedDict[str, Tuple[Any, Dict[str, Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str, last_modified: Any) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Get the indexed cells of a notebook if the saved copy has not changed
+
+        Args:
+            path: Notebook path relative to the server root
+            last_modified: Modification time reported by the ContentsManager
+
+        Returns:
+            Mapping of cell hash to compacted cell, or None
+        """
+        with self._lock:
+            entry = self._notebooks.get(path)
+            if entry is None or entry[0] != last_modified:
+                return None
+            self._notebooks.move_to_end(path)
+            return entry[1]
+
+    def put(self, path: str, last_modified: Any, notebook: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Index the cells of a saved notebook
+
+        Args:
+            path: Notebook path relative to the server root
+            last_modified: Modification time reported by the ContentsManager
+            notebook: nbformat notebook content
+
+        Returns:
+            Mapping of cell hash to compacted cell
+        """
+        cells = {}
+        for cell in notebook.get('cells', []):
+            compact = hashed_cell(cell)
+            cells[compact['hash']] = compact
+
+        with self._lock:
+            self._notebooks[path] = (last_modified, cells)
+            self._notebooks.move_to_end(path)
+            while len(self._notebooks) > self.max_notebooks:
+                self._notebooks.popitem(last=False)
+        return cells
+
+
+def resolve_notebook_cells(saved_cells: Dict[str, Dict[str, Any]],
+                           cells: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Rebuild notebook content from cell references and changed cell bodies
+
+    Args:
+        saved_cells: Mapping of cell hash to compacted cell of the saved notebook
+        cells: Cells in notebook order, each either a full cell or only
+            ``{"hash": ...}`` referring to an unchanged saved cell
+
+    Returns:
+        Tuple of notebook content with all cells and the hashes that were
+        referenced but not found in the saved notebook. Resolved cells carry
+        their ``hash``, computed on the server, which keys the render cache.
+    """
+    resolved = []
+    missing = []
+    for cell in cells:
+        if 'source' in cell:
+            resolved.append(hashed_cell(cell))
+            continue
+        saved = saved_cells.get(cell.get('hash', ''))
+        if saved is None:
+            missing.append(cell.get('hash', ''))
+        else:
+            resolved.append(saved)
+    return {'cells': resolved}, missing
@@ -0,0 +1,831 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from . import metrics
+from .admission import (PRIORITY_BATCH, PRIORITY_CHAT, PRIORITY_FIX, PRIORITY_SPECULATIVE, AdmissionRejected,
+                        admission)
+from .budget import speculative_budget
+from .cache import chat_cache_key, fix_cache_key, get_response_cache
+from .conversations import (UnknownConversation, append_turn, fold_count, get_conversation_store,
+                            new_conversation, prompt_history)
+from .llm import get_llm_instance, is_provider_loaded
+from .llm.base import BaseLLM, get_executor, get_request_executor
+from .llm.router import AUTO_LLM_TYPE, estimate_chat_tokens, estimate_fix_tokens
+from .similar import similar_fixes
+from .singleflight import inflight_calls
+from .stats import latency_tracker
+
+logger = logging.getLogger(__name__)
+
+# Maximum concurrent fixes per provider within one batch request
+BATCH_CONCURRENCY = int(os.environ.get("AI_ASSISTANT_BATCH_CONCURRENCY", "4"))
+
+# Admission priority of each kind of request, which is also its ``endpoint`` metrics label
+_PRIORITIES = {"chat": PRIORITY_CHAT, "fix": PRIORITY_FIX, "fix_batch": PRIORITY_BATCH,
+               "speculative": PRIORITY_SPECULATIVE}
+
+
+def _record(llm: BaseLLM, result: Dict[str, Any], started: float) -> None:
+    """Record the latency or failure of a provider call for routing and hedging"""
+    key = (llm.llm_type, llm.model)
+    if result.get("error", False):
+        latency_tracker.record_error(key)
+    else:
+        latency_tracker.record(key, time.monotonic() - started)
+
+
+def _chat_llm(llm_type: str, model: Optional[str], prompt: str,
+              messages: List[Dict[str, Any]], notebook_content: Dict[str, Any]) -> BaseLLM:
+    """Get the LLM for a chat request, estimating its size only if it is routed"""
+    if llm_type != AUTO_LLM_TYPE:
+        return get_llm_instance(llm_type, model)
+    return get_llm_instance(llm_type, model, "chat", estimate_chat_tokens(prompt, messages, notebook_content))
+
+
+def _fix_llm(llm_type: str, model: Optional[str], code: str, errors: List[Dict[str, Any]]) -> BaseLLM:
+    """Get the LLM for an error fixing request, estimating its size only if it is routed"""
+    if llm_type != AUTO_LLM_TYPE:
+        return get_llm_instance(llm_type, model)
+    return get_llm_instance(llm_type, model, "fix", estimate_fix_tokens(code, errors))
+
+
+async def _aget_llm(llm_type: str, get_llm: Callable[[], BaseLLM]) -> BaseLLM:
+    """Get an LLM from the event loop, in the executor if its provider SDK may have to be imported"""
+    if is_provider_loaded(llm_type):
+        return get_llm()
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), get_llm)
+
+
+def _shared(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Mark a result another request obtained from the provider"""
+    return {**result, "coalesced": True}
+
+
+def _observe(llm: BaseLLM, endpoint: str, result: Dict[str, Any], requested: float) -> Dict[str, Any]:
+    """Record the metrics of a finished request and pass its result on"""
+    metrics.observe_result(llm.llm_type, llm.model, endpoint, result, time.monotonic() - requested)
+    return result
+
+
+def _rejected(llm: BaseLLM, endpoint: str) -> None:
+    """Count a request rejected by admission control"""
+    metrics.REJECTIONS.labels(llm.llm_type, metrics.model_label(llm.llm_type, llm.model), endpoint).inc()
+
+
+def _similar_fix(llm: BaseLLM, similar: Tuple[str, List[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Reuse the fix of a cell similar to the one in an error fixing request, see ``similar_fixes``"""
+    reused = similar_fixes.lookup(llm.llm_type, llm.model, *similar)
+    return {**reused, "cached": True, "similar": True} if reused is not None else None
+
+
+def _unmarked(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the flags saying how this request got its result, before it is cached for later ones"""
+    return {key: value for key, value in result.items() if key not in ("cached", "similar")}
+
+
+def _remember_fix(llm: BaseLLM, similar: Tuple[str, List[Dict[str, Any]]], result: Dict[str, Any]) -> None:
+    """Remember the fix of an error fixing request for similar cells"""
+    similar_fixes.remember(llm.llm_type, llm.model, *similar, result)
+
+
+def _cached_call(llm: BaseLLM, key: str, use_cache: bool, call: Callable[[], Dict[str, Any]],
+                 user: Optional[str], endpoint: str,
+                 similar: Optional[Tuple[str, List[Dict[str, Any]]]] = None) -> Dict[str, Any]:
+    """
+    Answer from the cache, or call the provider and cache a successful result
+
+    An identical request already in flight is waited for instead of calling
+    the provider again. Provider calls wait for a slot from ``admission``,
+    which raises ``AdmissionRejected`` if the provider is saturated. Error
+    fixing requests pass their code and errors as ``similar``, so a cache
+    miss can still be answered with the fix of a similar cell.
+    """
+    requested = time.monotonic()
+    cache = get_response_cache()
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            return _observe(llm, endpoint, {**cached, "cached": True}, requested)
+        reused = _similar_fix(llm, similar) if similar is not None else None
+        if reused is not None:
+            cache.set(key, _unmarked(reused))
+            return _observe(llm, endpoint, reused, requested)
+
+    flight, leader = inflight_calls.begin(key)
+    if not leader:
+        result = flight.result()
+        if result is not None:
+            return _observe(llm, endpoint, _shared(result), requested)
+
+    result = None
+    try:
+        with admission.admit(llm.llm_type, user, _PRIORITIES[endpoint]):
+            started = time.monotonic()
+            result = call()
+        _record(llm, result, started)
+        if not result.get("error", False):
+            cache.set(key, result)
+            if similar is not None:
+                _remember_fix(llm, similar, result)
+        return _observe(llm, endpoint, result, requested)
+    except AdmissionRejected:
+        _rejected(llm, endpoint)
+        raise
+    finally:
+        if leader:
+            inflight_calls.end(key, flight, result)
+
+
+def _cached_stream(llm: BaseLLM, key: str, use_cache: bool, field: str,
+                   start_stream: Callable[[], Iterator[Dict[str, Any]]],
+                   user: Optional[str], endpoint: str,
+                   similar: Optional[Tuple[str, List[Dict[str, Any]]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Replay a cached result as stream events, or stream from the provider and cache the result
+
+    An identical request already in flight is waited for and its result
+    replayed, instead of streaming from the provider again. The provider
+    slot from ``admission`` is held until the stream ends.
+    """
+    requested = time.monotonic()
+    cache = get_response_cache()
+    if use_cache:
+        cached = cache.get(key)
+        if cached is not None:
+            yield {"type": "delta", "content": cached.get(field, "")}
+            yield {"type": "done", **_observe(llm, endpoint, {**cached, "cached": True}, requested)}
+            return
+        reused = _similar_fix(llm, similar) if similar is not None else None
+        if reused is not None:
+            cache.set(key, _unmarked(reused))
+            yield {"type": "delta", "content": reused.get(field, "")}
+            yield {"type": "done", **_observe(llm, endpoint, reused, requested)}
+            return
+
+    flight, leader = inflight_calls.begin(key)
+    if not leader:
+        shared = flight.result()
+        if shared is not None:
+            yield {"type": "delta", "content": shared.get(field, "")}
+            yield {"type": "done", **_observe(llm, endpoint, _shared(shared), requested)}
+            return
+
+    result = None
+    try:
+        with admission.admit(llm.llm_type, user, _PRIORITIES[endpoint]):
+            started = time.monotonic()
+            first_token = True
+            for event in start_stream():
+                if event["type"] == "delta" and event.get("content") and first_token:
+                    first_token = False
+                    metrics.FIRST_TOKEN_SECONDS.labels(
+                        llm.llm_type, metrics.model_label(llm.llm_type, llm.model), endpoint
+                    ).observe(time.monotonic() - started)
+                if event["type"] == "done":
+                    _record(llm, event, started)
+                    result = _observe(llm, endpoint, {k: v for k, v in event.items() if k != "type"}, requested)
+                    if not event.get("error", False):
+                        cache.set(key, result)
+                        if similar is not None:
+                            _remember_fix(llm, similar, result)
+                    if leader:
+                        inflight_calls.end(key, flight, result)
+                yield event
+    except AdmissionRejected:
+        _rejected(llm, endpoint)
+        raise
+    finally:
+        if leader:
+            inflight_calls.end(key, flight, result)
+
+
+async def _acached_call(llm: BaseLLM, make_key: Callable[[], str], use_cache: bool,
+                        call: Callable[[], Any], user: Optional[str], endpoint: str,
+                        similar: Optional[Tuple[str, List[Dict[str, Any]]]] = None) -> Dict[str, Any]:
+    """Async version of ``_cached_call``; key hashing and disk access run in the executor"""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    cache = get_response_cache()
+    requested = time.monotonic()
+    key = await loop.run_in_executor(executor, make_key)
+    if use_cache:
+        cached = cache.get(key, memory_only=True) or await loop.run_in_executor(executor, cache.get, key)
+        if cached is not None:
+            return _observe(llm, endpoint, {**cached, "cached": True}, requested)
+        if similar is not None:
+            reused = await loop.run_in_executor(executor, _similar_fix, llm, similar)
+            if reused is not None:
+                await loop.run_in_executor(executor, cache.set, key, _unmarked(reused))
+                return _observe(llm, endpoint, reused, requested)
+
+    flight, leader = inflight_calls.begin(key)
+    if not leader:
+        # Shielded, so a cancelled request does not cancel the others' wait
+        result = await asyncio.shield(asyncio.wrap_future(flight))
+        if result is not None:
+            return _observe(llm, endpoint, _shared(result), requested)
+
+    result = None
+    try:
+        async with admission.aadmit(llm.llm_type, user, _PRIORITIES[endpoint]):
+            started = time.monotonic()
+            result = await call()
+        _record(llm, result, started)
+        if not result.get("error", False):
+            await loop.run_in_executor(executor, cache.set, key, result)
+            if similar is not None:
+                await loop.run_in_executor(executor, _remember_fix, llm, similar, result)
+        return _observe(llm, endpoint, result, requested)
+    except AdmissionRejected:
+        _rejected(llm, endpoint)
+        raise
+    finally:
+        if leader:
+            inflight_calls.end(key, flight, result)
+
+
+async def _acached_stream(llm: BaseLLM, make_key: Callable[[], str], use_cache: bool, field: str,
+                          start_stream: Callable[[], AsyncIterator[Dict[str, Any]]],
+                          user: Optional[str], endpoint: str,
+                          similar: Optional[Tuple[str, List[Dict[str, Any]]]] = None
+                          ) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of ``_cached_stream``"""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    cache = get_response_cache()
+    requested = time.monotonic()
+    key = await loop.run_in_executor(executor, make_key)
+    if use_cache:
+        cached = cache.get(key, memory_only=True) or await loop.run_in_executor(executor, cache.get, key)
+        if cached is not None:
+            yield {"type": "delta", "content": cached.get(field, "")}
+            yield {"type": "done", **_observe(llm, endpoint, {**cached, "cached": True}, requested)}
+            return
+        if similar is not None:
+            reused = await loop.run_in_executor(executor, _similar_fix, llm, similar)
+            if reused is not None:
+                await loop.run_in_executor(executor, cache.set, key, _unmarked(reused))
+                yield {"type": "delta", "content": reused.get(field, "")}
+                yield {"type": "done", **_observe(llm, endpoint, reused, requested)}
+                return
+
+    flight, leader = inflight_calls.begin(key)
+    if not leader:
+        shared = await asyncio.shield(asyncio.wrap_future(flight))
+        if shared is not None:
+            yield {"type": "delta", "content": shared.get(field, "")}
+            yield {"type": "done", **_observe(llm, endpoint, _shared(shared), requested)}
+            return
+
+    result = None
+    try:
+        async with admission.aadmit(llm.llm_type, user, _PRIORITIES[endpoint]):
+            started = time.monotonic()
+            first_token = True
+            events = start_stream()
+            try:
+                async for event in events:
+                    if event["type"] == "delta" and event.get("content") and first_token:
+                        first_token = False
+                        metrics.FIRST_TOKEN_SECONDS.labels(
+                            llm.llm_type, metrics.model_label(llm.llm_type, llm.model), endpoint
+                        ).observe(time.monotonic() - started)
+                    if event["type"] == "done":
+                        _record(llm, event, started)
+                        result = _observe(llm, endpoint, {k: v for k, v in event.items() if k != "type"},
+                                          requested)
+                        if not event.get("error", False):
+                            await loop.run_in_executor(executor, cache.set, key, result)
+                            if similar is not None:
+                                await loop.run_in_executor(executor, _remember_fix, llm, similar, result)
+                        if leader:
+                            inflight_calls.end(key, flight, result)
+                    yield event
+            finally:
+                await events.aclose()
+    except AdmissionRejected:
+        _rejected(llm, endpoint)
+        raise
+    finally:
+        if leader:
+            inflight_calls.end(key, flight, result)
+
+
+def generate_response(llm_type: str, model: Optional[str], prompt: str,
+                      messages: List[Dict[str, Any]], notebook_content: Dict[str, Any],
+                      use_cache: bool = True, user: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Generate a chat response with one provider
+
+    Args:
+        llm_type: The type of LLM to use, or ``auto`` to route the request
+        model: The model to use, or None for the provider default
+        prompt: Current prompt/question from the user
+        messages: Chat history
+        notebook_content: Content of the notebook including code cells and outputs
+        use_cache: Whether a cached response may be returned; successful
+            responses are cached either way
+        user: Who makes the request, for fair sharing of provider capacity
+
+    Returns:
+        Dict with LLM response, with ``cached`` set when it came from the cache
+        and ``coalesced`` when it was shared with an identical request in flight
+    """
+    llm = _chat_llm(llm_type, model, prompt, messages, notebook_content)
+    key = chat_cache_key(llm.llm_type, llm.model, prompt, messages, notebook_content)
+    return _cached_call(llm, key, use_cache, lambda: llm.generate_response(prompt, messages, notebook_content),
+                        user, "chat")
+
+
+def stream_response(llm_type: str, model: Optional[str], prompt: str,
+                    messages: List[Dict[str, Any]], notebook_content: Dict[str, Any],
+                    use_cache: bool = True, user: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming version of ``generate_response``
+
+    Yields:
+        Events as produced by ``BaseLLM.stream_response``
+    """
+    llm = _chat_llm(llm_type, model, prompt, messages, notebook_content)
+    key = chat_cache_key(llm.llm_type, llm.model, prompt, messages, notebook_content)
+    return _cached_stream(llm, key, use_cache, "content",
+                          lambda: llm.stream_response(prompt, messages, notebook_content),
+                          user, "chat")
+
+
+def fix_errors_response(llm_type: str, model: Optional[str], code: str,
+                        errors: List[Dict[str, Any]], use_cache: bool = True,
+                        user: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Fix errors in the code with one provider
+
+    Args:
+        llm_type: The type of LLM to use, or ``auto`` to route the request
+        model: The model to use, or None for the provider default
+        code: The code with errors
+        errors: List of error messages and details
+        use_cache: Whether a cached fix may be returned; successful fixes are
+            cached either way
+        user: Who makes the request, for fair sharing of provider capacity
+
+    Returns:
+        Dict with the fixed code, with ``cached`` set when it came from the cache,
+        also ``similar`` when it is the re-mapped fix of a similar cell, and
+        ``coalesced`` when it was shared with an identical request in flight
+    """
+    llm = _fix_llm(llm_type, model, code, errors)
+    key = fix_cache_key(llm.llm_type, llm.model, code, errors)
+    return _cached_call(llm, key, use_cache, lambda: llm.fix_errors_response(code, errors),
+                        user, "fix", similar=(code, errors))
+
+
+def stream_fix_errors(llm_type: str, model: Optional[str], code: str,
+                      errors: List[Dict[str, Any]], use_cache: bool = True,
+                      user: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming version of ``fix_errors_response``
+
+    Yields:
+        Events as produced by ``BaseLLM.stream_fix_errors``
+    """
+    llm = _fix_llm(llm_type, model, code, errors)
+    key = fix_cache_key(llm.llm_type, llm.model, code, errors)
+    return _cached_stream(llm, key, use_cache, "fixed_code", lambda: llm.stream_fix_errors(code, errors),
+                          user, "fix", similar=(code, errors))
+
+
+async def agenerate_response(llm_type: str, model: Optional[str], prompt: str,
+                             messages: List[Dict[str, Any]], notebook_content: Dict[str, Any],
+                             use_cache: bool = True, user: Optional[str] = None) -> Dict[str, Any]:
+    """Async version of ``generate_response``"""
+    llm = await _aget_llm(llm_type, lambda: _chat_llm(llm_type, model, prompt, messages, notebook_content))
+    return await _acached_call(
+        llm,
+        lambda: chat_cache_key(llm.llm_type, llm.model, prompt, messages, notebook_content),
+        use_cache,
+        lambda: llm.agenerate_response(prompt, messages, notebook_content),
+        user,
+        "chat"
+    )
+
+
+async def astream_response(llm_type: str, model: Optional[str], prompt: str,
+                           messages: List[Dict[str, Any]], notebook_content: Dict[str, Any],
+                           use_cache: bool = True, user: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of ``stream_response``"""
+    llm = await _aget_llm(llm_type, lambda: _chat_llm(llm_type, model, prompt, messages, notebook_content))
+    events = _acached_stream(
+        llm,
+        lambda: chat_cache_key(llm.llm_type, llm.model, prompt, messages, notebook_content),
+        use_cache,
+        "content",
+        lambda: llm.astream_response(prompt, messages, notebook_content),
+        user,
+        "chat"
+    )
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+
+
+async def afix_errors_response(llm_type: str, model: Optional[str], code: str,
+                               errors: List[Dict[str, Any]], use_cache: bool = True,
+                               user: Optional[str] = None) -> Dict[str, Any]:
+    """Async version of ``fix_errors_response``"""
+    llm = await _aget_llm(llm_type, lambda: _fix_llm(llm_type, model, code, errors))
+    return await _acached_call(
+        llm,
+        lambda: fix_cache_key(llm.llm_type, llm.model, code, errors),
+        use_cache,
+        lambda: llm.afix_errors_response(code, errors),
+        user,
+        "fix",
+        similar=(code, errors)
+    )
+
+
+async def astream_fix_errors(llm_type: str, model: Optional[str], code: str,
+                             errors: List[Dict[str, Any]], use_cache: bool = True,
+                             user: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of ``stream_fix_errors``"""
+    llm = await _aget_llm(llm_type, lambda: _fix_llm(llm_type, model, code, errors))
+    events = _acached_stream(
+        llm,
+        lambda: fix_cache_key(llm.llm_type, llm.model, code, errors),
+        use_cache,
+        "fixed_code",
+        lambda: llm.astream_fix_errors(code, errors),
+        user,
+        "fix",
+        similar=(code, errors)
+    )
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+
+
+def _batch_groups(llm_type: str, model: Optional[str],
+                  items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Group the items of a batch fix request by identical code and errors
+
+    Returns:
+        Groups in request order, each with the ``llm`` to ask, its cache
+        ``key``, the ``code`` and ``errors`` to fix and the ``cells`` sharing them
+    """
+    groups: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        code = item.get("code", "")
+        errors = item.get("errors", [])
+        key = fix_cache_key(llm_type, model or "", code, errors)
+        group = groups.get(key)
+        if group is None:
+            llm = _fix_llm(llm_type, model, code, errors)
+            group = groups[key] = {
+                "llm": llm,
+                "key": fix_cache_key(llm.llm_type, llm.model, code, errors),
+                "code": code,
+                "errors": errors,
+                "cells": []
+            }
+        group["cells"].append(item.get("cell_index"))
+    return list(groups.values())
+
+
+def _batch_results(group: Dict[str, Any], result: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Fan the result of a group out to one event per cell"""
+    for cell_index in group["cells"]:
+        yield {"type": "result", "cell_index": cell_index, **result}
+
+
+def fix_errors_batch(llm_type: str, model: Optional[str], items: List[Dict[str, Any]],
+                     use_cache: bool = True, concurrency: int = BATCH_CONCURRENCY,
+                     user: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Fix the errors of many cells concurrently
+
+    Items with identical code and errors are fixed once. At most
+    ``concurrency`` fixes per provider run at the same time, in the
+    executor of ``get_request_executor``; the generator itself only waits,
+    so it must not run in that executor.
+
+    Args:
+        llm_type: The type of LLM to use, or ``auto`` to route each item
+        model: The model to use, or None for the provider default
+        items: ``{"cell_index", "code", "errors"}`` dicts
+        use_cache: Whether cached fixes may be returned
+        concurrency: Maximum concurrent fixes per provider
+        user: Who makes the request, for fair sharing of provider capacity
+
+    Yields:
+        ``{"type": "result", "cell_index": ..., ...}`` events in order of
+        completion, carrying the fields of ``fix_errors_response``, then one
+        ``{"type": "done", "count": ...}`` event
+    """
+    executor = get_request_executor()
+    queued = _batch_groups(llm_type, model, items)
+    running: Dict[Future, Dict[str, Any]] = {}
+    in_flight: Dict[str, int] = {}
+    count = 0
+
+    def fix(group: Dict[str, Any]) -> Dict[str, Any]:
+        llm, code, errors = group["llm"], group["code"], group["errors"]
+        return _cached_call(llm, group["key"], use_cache, lambda: llm.fix_errors_response(code, errors),
+                            user, "fix_batch", similar=(code, errors))
+
+    try:
+        while queued or running:
+            for group in list(queued):
+                provider = group["llm"].llm_type
+                if in_flight.get(provider, 0) < concurrency:
+                    queued.remove(group)
+                    in_flight[provider] = in_flight.get(provider, 0) + 1
+                    running[executor.submit(fix, group)] = group
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                group = running.pop(future)
+                in_flight[group["llm"].llm_type] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = group["llm"]._fix_error_response(f"# Error fixing code: {str(e)}\n{group['code']}")
+                for event in _batch_results(group, result):
+                    count += 1
+                    yield event
+    finally:
+        # The client went away, skip fixes that have not started
+        for future in running:
+            future.cancel()
+
+    yield {"type": "done", "count": count}
+
+
+async def afix_errors_batch(llm_type: str, model: Optional[str], items: List[Dict[str, Any]],
+                            use_cache: bool = True,
+                            concurrency: int = BATCH_CONCURRENCY,
+                            user: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of ``fix_errors_batch``"""
+    # Hashing and routing may block, keep them off the event loop
+    queued = await asyncio.get_running_loop().run_in_executor(
+        get_executor(), _batch_groups, llm_type, model, items
+    )
+    running: Dict[asyncio.Task, Dict[str, Any]] = {}
+    in_flight: Dict[str, int] = {}
+    count = 0
+
+    async def fix(group: Dict[str, Any]) -> Dict[str, Any]:
+        llm, code, errors = group["llm"], group["code"], group["errors"]
+        return await _acached_call(llm, lambda: group["key"], use_cache,
+                                   lambda: llm.afix_errors_response(code, errors), user, "fix_batch",
+                                   similar=(code, errors))
+
+    try:
+        while queued or running:
+            for group in list(queued):
+                provider = group["llm"].llm_type
+                if in_flight.get(provider, 0) < concurrency:
+                    queued.remove(group)
+                    in_flight[provider] = in_flight.get(provider, 0) + 1
+                    running[asyncio.ensure_future(fix(group))] = group
+
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                group = running.pop(task)
+                in_flight[group["llm"].llm_type] -= 1
+                try:
+                    result = task.result()
+                except Exception as e:
+                    result = group["llm"]._fix_error_response(f"# Error fixing code: {str(e)}\n{group['code']}")
+                for event in _batch_results(group, result):
+                    count += 1
+                    yield event
+    finally:
+        for task in running:
+            task.cancel()
+
+    yield {"type": "done", "count": count}
+
+
+def speculate_fix(llm_type: str, model: Optional[str], code: str, errors: List[Dict[str, Any]],
+                  user: Optional[str] = None) -> str:
+    """
+    Start fixing the errors of a cell in the background, before the user asks for it
+
+    The fix is made as ``fix_errors_response`` would make it and cached
+    under the same key, so asking for it later is answered from the cache,
+    or joins the call if it is still running. It is only started if the
+    provider has a free slot and the user's ``speculative_budget`` allows it.
+
+    Args:
+        llm_type: The type of LLM to use, or ``auto`` to route the request
+        model: The model to use, or None for the provider default
+        code: The code with errors
+        errors: List of error messages and details
+        user: Who the fix is for, whose budget pays for it
+
+    Returns:
+        ``started``, ``cached`` if the fix is cached or being made already,
+        ``busy`` if the provider has no free slot, or ``over_budget``
+    """
+    llm = _fix_llm(llm_type, model, code, errors)
+    key = fix_cache_key(llm.llm_type, llm.model, code, errors)
+    if key in inflight_calls or get_response_cache().get(key) is not None:
+        outcome = "cached"
+    elif not admission.has_free_slot(llm.llm_type):
+        # Checked before reserving budget or a thread; the call itself still never waits
+        outcome = "busy"
+    else:
+        # The prompt, and a rewritten cell of about the same size
+        estimate = 2 * estimate_fix_tokens(code, errors)
+        reservation = speculative_budget.reserve(user, estimate)
+        if reservation is None:
+            outcome = "over_budget"
+        else:
+            outcome = "started"
+            get_request_executor().submit(_speculative_fix, llm, key, code, errors, user, reservation, estimate)
+    metrics.SPECULATIVE_FIXES.labels(llm.llm_type, outcome).inc()
+    return outcome
+
+
+def _speculative_fix(llm: BaseLLM, key: str, code: str, errors: List[Dict[str, Any]], user: Optional[str],
+                     reservation: List[float], estimate: int) -> None:
+    """Make a speculative fix and charge its tokens to the user; runs in the request executor"""
+    spent = 0
+    try:
+        result = _cached_call(llm, key, True, lambda: llm.fix_errors_response(code, errors),
+                              user, "speculative", similar=(code, errors))
+        if not result.get("cached") and not result.get("coalesced"):
+            usage = result.get("usage") or {}
+            spent = usage.get("input_tokens", 0) + usage.get("output_tokens", 0) if usage else estimate
+    except AdmissionRejected:
+        metrics.SPECULATIVE_FIXES.labels(llm.llm_type, "busy").inc()
+    except Exception as e:
+        logger.warning(f"Speculative fix with {llm.llm_type} failed: {e}")
+    finally:
+        speculative_budget.settle(user, reservation, spent)
+
+
+async def aspeculate_fix(llm_type: str, model: Optional[str], code: str, errors: List[Dict[str, Any]],
+                         user: Optional[str] = None) -> str:
+    """Async version of ``speculate_fix``; the cache is checked in the executor"""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), speculate_fix, llm_type, model, code, errors, user
+    )
+
+
+# Conversations being compacted, so that each is summarized by one task at a time
+_compacting: Set[Tuple[Optional[str], str]] = set()
+_compacting_lock = threading.Lock()
+
+
+def conversation_history(user: Optional[str], conversation_id: str,
+                         messages: Optional[List[Dict[str, Any]]],
+                         max_history: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Get the history to send with a chat turn of a conversation kept on the server
+
+    Args:
+        user: Who the conversation belongs to
+        conversation_id: Id chosen by the client
+        messages: History held by the client, only needed if the server does
+            not have the conversation; it then starts the conversation
+        max_history: Number of recent messages to send verbatim
+
+    Returns:
+        Messages for ``generate_response``, see ``prompt_history``
+
+    Raises:
+        UnknownConversation: If the server does not have the conversation and no messages were sent
+    """
+    store = get_conversation_store()
+    conversation = store.get(user, conversation_id)
+    if conversation is None:
+        if messages is None:
+            raise UnknownConversation(conversation_id)
+        conversation = store.update(user, conversation_id,
+                                    lambda current: None if current else new_conversation(messages))
+    return prompt_history(conversation, max_history)
+
+
+def record_turn(llm_type: str, model: Optional[str], user: Optional[str], conversation_id: str,
+                prompt: str, result: Dict[str, Any], max_history: Optional[int] = None) -> None:
+    """
+    Add a successful chat turn to a conversation, and compact it in the background once it grows too long
+
+    Args:
+        llm_type: The LLM type of the request, which also summarizes the conversation
+        model: The model of the request
+        user: Who the conversation belongs to
+        conversation_id: Id chosen by the client
+        prompt: What the user asked
+        result: Response of ``generate_response``, or the fields of the final stream event
+        max_history: Number of recent messages to keep verbatim
+    """
+    if result.get("error", False):
+        return
+    conversation = get_conversation_store().update(
+        user, conversation_id, lambda current: append_turn(current, prompt, result.get("content", ""))
+    )
+    if not fold_count(conversation, max_history):
+        return
+    with _compacting_lock:
+        if (user, conversation_id) in _compacting:
+            return
+        _compacting.add((user, conversation_id))
+    get_request_executor().submit(_compact_conversation, llm_type, model, user, conversation_id, max_history)
+
+
+def _compact_conversation(llm_type: str, model: Optional[str], user: Optional[str],
+                          conversation_id: str, max_history: Optional[int]) -> None:
+    """Fold the oldest turns of a conversation into its summary; runs in the request executor"""
+    try:
+        store = get_conversation_store()
+        conversation = store.get(user, conversation_id)
+        count = fold_count(conversation, max_history) if conversation is not None else 0
+        if not count:
+            return
+        folded = conversation["messages"][:count]
+        llm = _chat_llm(llm_type, model, "", folded, {})
+        requested = time.monotonic()
+        # Background work, so it yields the provider to interactive requests
+        with admission.admit(llm.llm_type, user, PRIORITY_BATCH):
+            result = llm.summarize_conversation(conversation["summary"], folded)
+        metrics.observe_result(llm.llm_type, llm.model, "compact", result, time.monotonic() - requested)
+        if result.get("error", False):
+            logger.warning(f"Could not summarize conversation {conversation_id}: {result.get('content')}")
+            return
+
+        def fold(current: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+            # Skip if the folded messages were dropped meanwhile
+            if current is None or current["start"] != conversation["start"]:
+                return None
+            return {**current, "summary": result["content"], "start": current["start"] + count,
+                    "messages": current["messages"][count:]}
+
+        store.update(user, conversation_id, fold)
+    except AdmissionRejected:
+        logger.info(f"Postponed summarizing conversation {conversation_id}, {llm_type} is saturated")
+    except Exception as e:
+        logger.warning(f"Could not compact conversation {conversation_id}: {e}")
+    finally:
+        with _compacting_lock:
+            _compacting.discard((user, conversation_id))
+
+
+def record_stream(events: Iterator[Dict[str, Any]], llm_type: str, model: Optional[str],
+                  user: Optional[str], conversation_id: str, prompt: str,
+                  max_history: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Pass on the events of a streamed chat turn, adding the turn to a conversation once it is done
+
+    Args:
+        events: Events of ``stream_response``
+        llm_type, model, user, conversation_id, prompt, max_history: As for ``record_turn``
+
+    Yields:
+        The events
+    """
+    for event in events:
+        if event["type"] == "done":
+            record_turn(llm_type, model, user, conversation_id, prompt, event, max_history)
+        yield event
+
+
+async def aconversation_history(user: Optional[str], conversation_id: str,
+                                messages: Optional[List[Dict[str, Any]]],
+                                max_history: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Async version of ``conversation_history``; the store is read in the executor"""
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor(), conversation_history, user, conversation_id, messages, max_history
+    )
+
+
+async def arecord_turn(llm_type: str, model: Optional[str], user: Optional[str], conversation_id: str,
+                       prompt: str, result: Dict[str, Any], max_history: Optional[int] = None) -> None:
+    """Async version of ``record_turn``; the store is written in the executor"""
+    await asyncio.get_running_loop().run_in_executor(
+        get_executor(), record_turn, llm_type, model, user, conversation_id, prompt, result, max_history
+    )
+
+
+async def arecord_stream(events: AsyncIterator[Dict[str, Any]], llm_type: str, model: Optional[str],
+                         user: Optional[str], conversation_id: str, prompt: str,
+                         max_history: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Async version of ``record_stream``"""
+    try:
+        async for event in events:
+            if event["type"] == "done":
+                await arecord_turn(llm_type, model, user, conversation_id, prompt, event, max_history)
+            yield event
+    finally:
+        await events.aclose()
@@ -0,0 +1,424 @@
+import ast
+import builtins
+import hashlib
+import io
+import keyword
+import logging
+import os
+import re
+import threading
+import tokenize
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Minimum similarity of a cell to one fixed before for that fix to be reused,
+# as the share of equal bits of their 64-bit SimHash fingerprints
+SIMILAR_FIX_THRESHOLD = float(os.environ.get("AI_ASSISTANT_SIMILAR_FIX_THRESHOLD", "0.9"))
+
+# Fixes remembered for reuse in this process; 0 disables reuse
+SIMILAR_FIX_ENTRIES = int(os.environ.get("AI_ASSISTANT_SIMILAR_FIX_ENTRIES", "2048"))
+
+# Fixes compared with a cell, the most recent with the same errors
+_CANDIDATES = 64
+
+# Longer cells are not worth aligning line by line
+_MAX_LINES = 500
+
+_BUILTINS = frozenset(dir(builtins))
+
+_QUOTED = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+_NUMBER = re.compile(r"\d+")
+
+_SKIPPED_TOKENS = (tokenize.ENCODING, tokenize.ENDMARKER, tokenize.NEWLINE, tokenize.NL,
+                   tokenize.INDENT, tokenize.DEDENT)
+
+
+class _Line(NamedTuple):
+    """One line of a cell, tokenized for alignment"""
+
+    # Line as written
+    raw: str
+    # Line without its comment
+    text: str
+    # Indentation level and tokens, with renameable tokens replaced by "_"
+    key: str
+    # (start column, end column, text) of each renameable token
+    slots: Tuple[Tuple[int, int, str], ...]
+
+
+class _Fix(NamedTuple):
+    """A fixed cell remembered for reuse"""
+
+    fingerprint: int
+    lines: List[_Line]
+    fixed: List[_Line]
+    # Quoted names in the error messages, in order
+    quoted: List[str]
+    # Response without ``fixed_code`` and ``usage``
+    result: Dict[str, Any]
+
+
+def _tokenize(code: str) -> Optional[List[_Line]]:
+    """
+    Split a cell into lines of tokens
+
+    Identifiers and string literals are renameable, except keywords,
+    builtins, attribute names and keyword arguments, which keep the meaning
+    they have in any cell.
+
+    Returns:
+        The lines, or None if the cell cannot be tokenized, is too long or
+        has tokens spanning lines, such as triple-quoted strings
+    """
+    raws = code.split("\n")
+    if len(raws) > _MAX_LINES:
+        return None
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+    keys: List[List[str]] = [[] for _ in raws]
+    slots: List[List[Tuple[int, int, str]]] = [[] for _ in raws]
+    comments: Dict[int, int] = {}
+    depth = 0
+    level = 0
+    previous = ""
+    for index, token in enumerate(tokens):
+        if token.type == tokenize.INDENT:
+            level += 1
+        elif token.type == tokenize.DEDENT:
+            level -= 1
+        if token.type in _SKIPPED_TOKENS:
+            continue
+        (row, column), (end_row, end_column) = token.start, token.end
+        if row != end_row or row > len(raws):
+            return None
+        line = row - 1
+        if token.type == tokenize.COMMENT:
+            comments[line] = column
+            continue
+        if not keys[line]:
+            keys[line].append(str(level))
+
+        following = tokens[index + 1].string if index + 1 < len(tokens) else ""
+        if token.type == tokenize.STRING:
+            renameable = True
+        elif token.type == tokenize.NAME:
+            renameable = not (keyword.iskeyword(token.string) or token.string in _BUILTINS
+                              or previous == "." or (depth > 0 and following == "="))
+        else:
+            renameable = False
+            if token.string in "([{":
+                depth += 1
+            elif token.string in ")]}":
+                depth -= 1
+        keys[line].append("_" if renameable else token.string)
+        if renameable:
+            slots[line].append((column, end_column, token.string))
+        previous = token.string
+
+    return [
+        _Line(raw, raw[:comments[line]].rstrip() if line in comments else raw.rstrip(),
+              " ".join(keys[line]), tuple(slots[line]))
+        for line, raw in enumerate(raws)
+    ]
+
+
+def _label(node: ast.AST) -> str:
+    """Describe a syntax tree node independently of the names chosen in the cell"""
+    if isinstance(node, ast.Name):
+        return f"Name:{node.id}" if node.id in _BUILTINS else "Name"
+    if isinstance(node, ast.Attribute):
+        return f"Attribute:{node.attr}"
+    if isinstance(node, ast.Constant):
+        return f"Constant:{type(node.value).__name__}"
+    return type(node).__name__
+
+
+def _fingerprint(code: str) -> Optional[int]:
+    """
+    SimHash of a cell's syntax tree
+
+    The features are the parent-child pairs of the tree, with identifiers
+    and literal values left out, so comments, formatting and the names
+    chosen do not change the fingerprint, and similar cells differ in few bits.
+
+    Returns:
+        64-bit fingerprint, or None if the cell does not parse or is empty
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    weights = [0] * 64
+    empty = True
+    for node in ast.walk(tree):
+        label = _label(node)
+        for child in ast.iter_child_nodes(node):
+            empty = False
+            digest = hashlib.blake2b(f"{label}>{_label(child)}".encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "big")
+            for bit in range(64):
+                weights[bit] += 1 if value >> bit & 1 else -1
+    if empty:
+        return None
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _similarity(a: int, b: int) -> float:
+    """Share of equal bits of two fingerprints"""
+    return 1 - bin(a ^ b).count("1") / 64
+
+
+def _error_signature(errors: List[Dict[str, Any]]) -> Tuple[Tuple[str, ...], List[str]]:
+    """
+    Normalize error messages, so that errors naming different variables or lines compare equal
+
+    Returns:
+        Tuple of the messages with quoted names and numbers blanked, and the quoted names
+    """
+    messages = []
+    quoted = []
+    for error in errors:
+        message = error.get("message", "")
+        quoted.extend(a or b for a, b in _QUOTED.findall(message))
+        messages.append(_NUMBER.sub("0", _QUOTED.sub("'_'", message)))
+    return tuple(messages), quoted
+
+
+def _substitute(line: _Line, names: Dict[str, str], known: set) -> Optional[str]:
+    """Rename the tokens of a fixed line for another cell, None if one has no counterpart there"""
+    parts = []
+    last = 0
+    for start, end, text in line.slots:
+        if text in names:
+            replacement = names[text]
+        elif text in known:
+            # Part of the remembered cell the other cell lacks
+            return None
+        else:
+            # Introduced by the fix
+            replacement = text
+        parts += [line.text[last:start], replacement]
+        last = end
+    parts.append(line.text[last:])
+    return "".join(parts)
+
+
+def _tokens(line: _Line) -> Tuple[str, Tuple[str, ...]]:
+    """Compare lines by their tokens, renameable ones included"""
+    return line.key, tuple(text for _, _, text in line.slots)
+
+
+def _transfer(fix: _Fix, lines: List[_Line], quoted: List[str]) -> Optional[str]:
+    """
+    Apply a remembered fix to a similar cell
+
+    The lines of the two cells are aligned; aligned lines must rename their
+    tokens consistently, one to one. The lines the fix changed must be in
+    the cell, unmodified apart from renaming, and are replaced by the fixed
+    lines with the cell's names; the cell's other lines are kept as they are.
+
+    Returns:
+        The fixed cell, or None if the fix does not apply
+    """
+    old = [line.key for line in fix.lines]
+    aligned: Dict[int, int] = {}
+    names: Dict[str, str] = {}
+    reverse: Dict[str, str] = {}
+    matcher = SequenceMatcher(None, old, [line.key for line in lines], autojunk=False)
+    for a, b, size in matcher.get_matching_blocks():
+        for offset in range(size):
+            aligned[a + offset] = b + offset
+            for (_, _, was), (_, _, now) in zip(fix.lines[a + offset].slots, lines[b + offset].slots):
+                if names.setdefault(was, now) != now or reverse.setdefault(now, was) != was:
+                    return None
+
+    # The errors must be about corresponding names
+    if len(quoted) != len(fix.quoted):
+        return None
+    if any(names.get(was, was) != now for was, now in zip(fix.quoted, quoted)):
+        return None
+
+    known = {text for line in fix.lines for _, _, text in line.slots}
+    output: List[str] = []
+    position = 0
+    changed = False
+    # Compared with their tokens, since a fix may just rename
+    opcodes = SequenceMatcher(None, [_tokens(line) for line in fix.lines], [_tokens(line) for line in fix.fixed],
+                              autojunk=False).get_opcodes()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            continue
+        changed = True
+        if i1 < i2:
+            start = aligned.get(i1)
+            if start is None or any(aligned.get(i) != start + i - i1 for i in range(i1, i2)):
+                return None
+            end = start + i2 - i1
+        elif i1 == 0:
+            start = end = 0
+        elif i1 - 1 in aligned:
+            start = end = aligned[i1 - 1] + 1
+        else:
+            return None
+        if start < position:
+            return None
+
+        output.extend(line.raw for line in lines[position:start])
+        for line in fix.fixed[j1:j2]:
+            if not line.text and line.raw.strip():
+                # Comment of the remembered fix
+                continue
+            text = _substitute(line, names, known)
+            if text is None:
+                return None
+            output.append(text)
+        position = end
+    output.extend(line.raw for line in lines[position:])
+    if not changed:
+        return None
+
+    fixed_code = "\n".join(output)
+    try:
+        ast.parse(fixed_code)
+    except (SyntaxError, ValueError):
+        return None
+    return fixed_code
+
+
+class SimilarFixIndex:
+    """
+    Fixes of recently fixed cells, reused for near-duplicate cells
+
+    Many users hitting the same error with nearly the same code, as in a
+    class working through one notebook, differ mostly in names, comments and
+    formatting. A cell is matched to the remembered fixes of the same
+    provider and model for the same errors, compared as normalized by
+    ``_error_signature``, whose ``_fingerprint`` is at least ``threshold``
+    similar. The closest fix that ``_transfer`` can apply to the cell, and
+    whose result parses, is served instead of asking the provider.
+
+    Entries live in memory, the least recently used beyond ``max_entries``
+    are dropped. Thread-safe.
+    """
+
+    def __init__(self, threshold: float = SIMILAR_FIX_THRESHOLD, max_entries: int = SIMILAR_FIX_ENTRIES):
+        """
+        Initialize an empty index
+
+        Args:
+            threshold: Minimum fingerprint similarity, from 0 to 1
+            max_entries: Number of fixes remembered
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._fixes: "OrderedDict[Tuple[Any, ...], OrderedDict[int, _Fix]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether fixes are reused at all"""
+        return self.max_entries > 0 and self.threshold <= 1
+
+    def lookup(self, llm_type: str, model: str, code: str,
+               errors: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Fix a cell with the fix of a similar one
+
+        Args:
+            llm_type: The LLM type answering the request
+            model: The model answering the request
+            code: The code with errors
+            errors: List of error messages and details
+
+        Returns:
+            The remembered response with ``fixed_code`` for this cell, or None
+        """
+        if not self.enabled or not errors:
+            return None
+        signature, quoted = _error_signature(errors)
+        bucket = (llm_type, model, signature)
+        with self._lock:
+            candidates = list(self._fixes.get(bucket, {}).values())
+        if not candidates:
+            return None
+
+        fingerprint = _fingerprint(code)
+        lines = _tokenize(code) if fingerprint is not None else None
+        if lines is None:
+            return None
+        scored = sorted(((_similarity(fingerprint, fix.fingerprint), fix) for fix in candidates),
+                        key=lambda pair: pair[0], reverse=True)
+        for similarity, fix in scored:
+            if similarity < self.threshold:
+                break
+            fixed_code = _transfer(fix, lines, quoted)
+            if fixed_code is not None:
+                logger.debug(f"Reusing the fix of a cell {similarity:.0%} similar")
+                with self._lock:
+                    if bucket in self._fixes:
+                        self._fixes.move_to_end(bucket)
+                return {**fix.result, "fixed_code": fixed_code}
+        return None
+
+    def remember(self, llm_type: str, model: str, code: str, errors: List[Dict[str, Any]],
+                 result: Dict[str, Any]) -> None:
+        """
+        Remember a successful fix for reuse
+
+        Args:
+            llm_type: The LLM type that answered
+            model: The model that answered
+            code: The code with errors
+            errors: List of error messages and details
+            result: The response, with the fixed code under ``fixed_code``
+        """
+        if not self.enabled or not errors or result.get("error", False):
+            return
+        fixed_code = result.get("fixed_code") or ""
+        fingerprint = _fingerprint(code)
+        if fingerprint is None or _fingerprint(fixed_code) is None:
+            return
+        lines = _tokenize(code)
+        fixed = _tokenize(fixed_code)
+        if lines is None or fixed is None:
+            return
+        signature, quoted = _error_signature(errors)
+        bucket = (llm_type, model, signature)
+        fix = _Fix(fingerprint, lines, fixed, quoted,
+                   {k: v for k, v in result.items() if k not in ("fixed_code", "usage")})
+
+        with self._lock:
+            fixes = self._fixes.setdefault(bucket, OrderedDict())
+            self._fixes.move_to_end(bucket)
+            key = hash((code, fixed_code))
+            if key in fixes:
+                fixes.move_to_end(key)
+                return
+            fixes[key] = fix
+            self._size += 1
+            if len(fixes) > _CANDIDATES:
+                fixes.popitem(last=False)
+                self._size -= 1
+            while self._size > self.max_entries:
+                oldest = next(iter(self._fixes.values()))
+                oldest.popitem(last=False)
+                self._size -= 1
+                if not oldest:
+                    self._fixes.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget every fix"""
+        with self._lock:
+            self._fixes.clear()
+            self._size = 0
+
+
+# Process-wide index used by the error fixing requests of ``service``
+similar_fixes = SimilarFixIndex()
@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Tuple
+
+
+class SingleFlight:
+    """
+    Table of in-flight provider calls, so identical concurrent requests share one call
+
+    The first request for a key leads: it makes the call and publishes the
+    result with ``end``. Requests for the same key arriving meanwhile get the
+    leader's future from ``begin`` and wait for it instead of calling the
+    provider again. Thread-safe; async callers wait on the future through
+    ``asyncio.wrap_future``.
+    """
+
+    def __init__(self):
+        """Initialize an empty table"""
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key: str) -> Tuple[Future, bool]:
+        """
+        Join the call for a key, or lead it if none is in flight
+
+        Args:
+            key: Identity of the request, e.g. its response cache key
+
+        Returns:
+            Tuple of the future of the call's result and whether the caller
+            leads, in which case it must pass the future to ``end``
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def end(self, key: str, future: Future, result: Optional[Dict[str, Any]]) -> None:
+        """
+        Publish the leader's result to the waiting requests
+
+        Calling it again for the same future does nothing, so a leader may
+        publish as soon as it has its result and again on cleanup.
+
+        Args:
+            key: Key passed to ``begin``
+            future: Future returned by ``begin``
+            result: Result of the call, or None if the leader gave up without
+                one, in which case waiting requests make their own call
+        """
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if not future.done():
+            future.set_result(result)
+
+    def __contains__(self, key: str) -> bool:
+        """Whether a call for a key is in flight"""
+        with self._lock:
+            return key in self._calls
+
+    def __len__(self) -> int:
+        """Number of calls in flight"""
+        with self._lock:
+            return len(self._calls)
+
+
+# Process-wide table of provider calls made by ``service``, keyed by response cache key
+inflight_calls = SingleFlight()
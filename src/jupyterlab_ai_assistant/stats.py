@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Hashable, Optional
+
+
+class LatencyTracker:
+    """
+    Rolling window of recent request latencies and outcomes per key, e.g. (llm_type, model)
+
+    Latencies are kept for successful requests only; failures count towards
+    the error rate. Keys are model names chosen by clients, so only the
+    ``max_keys`` most recently used are kept. Thread-safe, since Flask/gunicorn threads and the Jupyter
+    server's executor record into the same process-wide tracker.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20, min_outcomes: int = 5,
+                 max_keys: int = 256):
+        """
+        Initialize the tracker
+
+        Args:
+            window: Number of most recent samples kept per key
+            min_samples: Samples needed before percentiles are reported
+            min_outcomes: Requests needed before the error rate is reported
+            max_keys: Keys kept, dropping the least recently recorded
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self.min_outcomes = min_outcomes
+        self.max_keys = max_keys
+        self._samples: "OrderedDict[Hashable, Deque[float]]" = OrderedDict()
+        self._outcomes: "OrderedDict[Hashable, Deque[bool]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _append(self, table: "OrderedDict[Hashable, Deque]", key: Hashable, value: Any) -> None:
+        """Add a value to the window of a key, creating it on first use and dropping the stalest key"""
+        window = table.get(key)
+        if window is None:
+            window = table[key] = deque(maxlen=self.window)
+            while len(table) > self.max_keys:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        window.append(value)
+
+    def record(self, key: Hashable, seconds: float) -> None:
+        """
+        Record the latency of one successful request
+
+        Args:
+            key: What the latency belongs to, e.g. (llm_type, model)
+            seconds: Observed latency
+        """
+        with self._lock:
+            self._append(self._samples, key, seconds)
+            self._append(self._outcomes, key, True)
+
+    def record_error(self, key: Hashable) -> None:
+        """
+        Record one failed request
+
+        Args:
+            key: What the request belongs to, e.g. (llm_type, model)
+        """
+        with self._lock:
+            self._append(self._outcomes, key, False)
+
+    def error_rate(self, key: Hashable) -> Optional[float]:
+        """
+        Get the share of failed requests over the recent window
+
+        Args:
+            key: What the requests belong to
+
+        Returns:
+            Error rate between 0 and 1, or None if there are too few requests
+        """
+        with self._lock:
+            outcomes = list(self._outcomes.get(key, ()))
+        if len(outcomes) < self.min_outcomes:
+            return None
+        return outcomes.count(False) / len(outcomes)
+
+    def percentile(self, key: Hashable, pct: float) -> Optional[float]:
+        """
+        Get a latency percentile over the recent window
+
+        Args:
+            key: What the latency belongs to
+            pct: Percentile between 0 and 100
+
+        Returns:
+            Latency in seconds, or None if there are too few samples
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+# Process-wide tracker of provider calls made by ``service``, keyed by (llm_type, model)
+latency_tracker = LatencyTracker()
@@ -0,0 +1,24 @@
+from typing import Any, Dict
+
+from .codec import dumps
+
+# Headers for Server-Sent Events responses; X-Accel-Buffering stops proxies
+# such as nginx from holding back chunks
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def sse_event(event: Dict[str, Any]) -> bytes:
+    """
+    Encode a streaming event as a Server-Sent Events message
+
+    Args:
+        event: Event produced by ``BaseLLM.stream_response`` or ``BaseLLM.stream_fix_errors``
+
+    Returns:
+        The ``data:`` line terminated by a blank line, in UTF-8
+    """
+    return b"data: " + dumps(event) + b"\n\n"
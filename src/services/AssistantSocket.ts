@@ -0,0 +1,124 @@
+import { APIError, StreamEvent, streamAPI } from './LLMService';
+
+/**
+ * Endpoint answering each kind of request when the WebSocket is unavailable
+ */
+const ENDPOINTS = {
+  chat: 'llm',
+  fix: 'fix-error'
+};
+
+interface PendingRequest {
+  onEvent: (event: StreamEvent) => void;
+  resolve: (event: StreamEvent) => void;
+  reject: (error: Error) => void;
+}
+
+/**
+ * Chat and error fixing requests multiplexed over one WebSocket
+ *
+ * Aborting a request cancels it on the server, which aborts the provider
+ * call, and disposing of the socket cancels every request still running.
+ * If the WebSocket cannot be opened, requests are streamed over HTTP.
+ */
+export class AssistantSocket {
+  private socket: Promise<WebSocket | null> | null = null;
+  private pending = new Map<string, PendingRequest>();
+  private nextId = 0;
+  private disposed = false;
+
+  /**
+   * Send a request and stream its events
+   *
+   * `onEvent` is called for every event as soon as it arrives, and the
+   * returned promise resolves with the final `done` event. It rejects with
+   * an `APIError` carrying the status the equivalent POST would have, or
+   * with an `AbortError` once `signal` aborts the request.
+   */
+  async request(
+    type: 'chat' | 'fix',
+    body: any,
+    onEvent: (event: StreamEvent) => void,
+    signal?: AbortSignal
+  ): Promise<StreamEvent> {
+    const socket = await this.connect();
+    if (!socket) {
+      return streamAPI(ENDPOINTS[type], body, onEvent, { signal });
+    }
+
+    const id = `${++this.nextId}`;
+    return new Promise<StreamEvent>((resolve, reject) => {
+      if (signal?.aborted) {
+        reject(new DOMException('The request was aborted', 'AbortError'));
+        return;
+      }
+      this.pending.set(id, { onEvent, resolve, reject });
+      signal?.addEventListener('abort', () => {
+        if (this.pending.has(id) && socket.readyState === WebSocket.OPEN) {
+          socket.send(JSON.stringify({ id, type: 'cancel' }));
+        }
+      });
+      socket.send(JSON.stringify({ ...body, id, type }));
+    });
+  }
+
+  /**
+   * Close the connection, cancelling the requests still running
+   */
+  dispose(): void {
+    this.disposed = true;
+    this.socket?.then(socket => socket?.close());
+    this.failAll(new DOMException('The request was aborted', 'AbortError'));
+  }
+
+  private connect(): Promise<WebSocket | null> {
+    if (this.disposed) {
+      return Promise.resolve(null);
+    }
+    if (!this.socket) {
+      this.socket = new Promise(resolve => {
+        const baseUrl = (window as any).jupyterBaseUrl || '';
+        const url = new URL(`${baseUrl}ai-assistant/ws`, window.location.href);
+        url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+
+        const socket = new WebSocket(url.toString());
+        socket.onopen = () => resolve(socket);
+        socket.onmessage = message => this.dispatch(JSON.parse(message.data));
+        socket.onclose = () => {
+          // Fall back to HTTP if it never opened, reconnect on the next request otherwise
+          resolve(null);
+          this.socket = null;
+          this.failAll(new Error('The connection to the server was lost'));
+        };
+      });
+    }
+    return this.socket;
+  }
+
+  private dispatch(event: StreamEvent & { id: string }): void {
+    const request = this.pending.get(event.id);
+    if (!request) {
+      return;
+    }
+    const { id, ...fields } = event;
+
+    if (event.type === 'error') {
+      this.pending.delete(id);
+      request.reject(new APIError(event.message || 'Request failed', event.status, fields));
+    } else if (event.type === 'cancelled') {
+      this.pending.delete(id);
+      request.reject(new DOMException('The request was aborted', 'AbortError'));
+    } else {
+      request.onEvent(fields as StreamEvent);
+      if (event.type === 'done') {
+        this.pending.delete(id);
+        request.resolve(fields as StreamEvent);
+      }
+    }
+  }
+
+  private failAll(error: Error): void {
+    this.pending.forEach(request => request.reject(error));
+    this.pending.clear();
+  }
+}
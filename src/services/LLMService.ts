@@ -1,3 +1,39 @@
+/**
+ * Error response from the server extension API
+ */
+export class APIError extends Error {
+  constructor(
+    message: string,
+    public status: number,
+    public data: any = {}
+  ) {
+    super(message);
+  }
+}
+
+/**
+ * Request bodies at least this large are sent gzip-compressed
+ */
+const COMPRESS_MIN_BYTES = 64 * 1024;
+
+/**
+ * Compress a large JSON request body, which mostly holds notebook outputs
+ * and shrinks several times, if the browser supports CompressionStream
+ */
+async function encodeBody(
+  body: string
+): Promise<{ body: BodyInit; headers: Record<string, string> }> {
+  const CompressionStream = (window as any).CompressionStream;
+  if (body.length < COMPRESS_MIN_BYTES || !CompressionStream) {
+    return { body, headers: {} };
+  }
+  const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+  return {
+    body: await new Response(stream).blob(),
+    headers: { 'Content-Encoding': 'gzip' }
+  };
+}
+
 /**
  * Make a request to the server extension API
  */
@@ -15,18 +51,108 @@ export async function requestAPI<T>(
     'Content-Type': 'application/json',
     ...headers
   };
+  if (typeof init.body === 'string') {
+    const encoded = await encodeBody(init.body);
+    init.body = encoded.body;
+    init.headers = { ...init.headers, ...encoded.headers };
+  }
   
   // Make the request
   const response = await fetch(url, init);
   
   if (!response.ok) {
     const data = await response.json();
-    throw new Error(data.message || `Failed to fetch ${url}: ${response.statusText}`);
+    throw new APIError(data.message || `Failed to fetch ${url}: ${response.statusText}`, response.status, data);
   }
   
   return await response.json() as T;
 }
 
+/**
+ * Event sent by the streaming endpoints
+ */
+export interface StreamEvent {
+  type: 'delta' | 'result' | 'done' | 'error' | 'cancelled';
+  content?: string;
+  [key: string]: any;
+}
+
+/**
+ * Make a streaming request to the server extension API
+ *
+ * The server answers with Server-Sent Events; `onEvent` is called for every
+ * event as soon as it arrives, and the returned promise resolves with the
+ * final `done` event.
+ */
+export async function streamAPI(
+  endpoint: string,
+  body: any,
+  onEvent: (event: StreamEvent) => void,
+  init: RequestInit = {}
+): Promise<StreamEvent> {
+  const baseUrl = (window as any).jupyterBaseUrl || '';
+  const url = `${baseUrl}ai-assistant/${endpoint}`;
+  
+  const encoded = await encodeBody(JSON.stringify({ ...body, stream: true }));
+  const response = await fetch(url, {
+    ...init,
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      ...(init.headers || {}),
+      ...encoded.headers
+    },
+    body: encoded.body
+  });
+  
+  if (!response.ok) {
+    const data = await response.json().catch(() => ({}));
+    throw new APIError(data.message || `Failed to fetch ${url}: ${response.statusText}`, response.status, data);
+  }
+  if (!response.body) {
+    throw new Error(`Failed to fetch ${url}: ${response.statusText}`);
+  }
+  
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let doneEvent: StreamEvent | null = null;
+  
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    
+    // Events are separated by a blank line
+    let separator = buffer.indexOf('\n\n');
+    while (separator !== -1) {
+      const data = buffer
+        .slice(0, separator)
+        .split('\n')
+        .filter(line => line.startsWith('data:'))
+        .map(line => line.slice(5).trimStart())
+        .join('\n');
+      buffer = buffer.slice(separator + 2);
+      separator = buffer.indexOf('\n\n');
+      
+      if (data) {
+        const event = JSON.parse(data) as StreamEvent;
+        if (event.type === 'done') {
+          doneEvent = event;
+        }
+        onEvent(event);
+      }
+    }
+  }
+  
+  if (!doneEvent) {
+    throw new Error(`Stream from ${url} ended unexpectedly`);
+  }
+  return doneEvent;
+}
+
 /**
  * Get available LLM configurations
  */
@@ -54,6 +180,24 @@ export async function generateResponse(
   });
 }
 
+/**
+ * Generate a response from the selected LLM, reporting text as it is generated
+ */
+export async function streamResponse(
+  llmType: string,
+  prompt: string,
+  messages: any[],
+  notebookContent: any,
+  onEvent: (event: StreamEvent) => void
+) {
+  return streamAPI('llm', {
+    llm_type: llmType,
+    prompt,
+    messages,
+    notebook_content: notebookContent
+  }, onEvent);
+}
+
 /**
  * Fix code errors using the selected LLM
  */
@@ -71,3 +215,34 @@ export async function fixErrors(
     })
   });
 }
+
+/**
+ * Fix the errors of many cells using the selected LLM, reporting each fix
+ * as a `result` event as soon as it is ready
+ */
+export async function streamFixErrorsBatch(
+  llmType: string,
+  items: { cell_index: number, code: string, errors: any[] }[],
+  onEvent: (event: StreamEvent) => void
+) {
+  return streamAPI('fix-errors', {
+    llm_type: llmType,
+    items
+  }, onEvent);
+}
+
+/**
+ * Fix code errors using the selected LLM, reporting text as it is generated
+ */
+export async function streamFixErrors(
+  llmType: string,
+  code: string,
+  errors: any[],
+  onEvent: (event: StreamEvent) => void
+) {
+  return streamAPI('fix-error', {
+    llm_type: llmType,
+    code,
+    errors
+  }, onEvent);
+}
@@ -1,5 +1,6 @@
 import { NotebookPanel, Notebook } from '@jupyterlab/notebook';
 import { ICellModel } from '@jupyterlab/cells';
+import { APIError } from './LLMService';
 
 interface NotebookContent {
   cells: {
@@ -8,6 +9,26 @@ interface NotebookContent {
     outputs?: Array<any>;
   }[];
   metadata: any;
+  active_cell_index: number;
+}
+
+interface CompactCell {
+  cell_type: string;
+  source: string;
+  outputs?: Array<any>;
+}
+
+interface CellReference extends Partial<CompactCell> {
+  hash: string;
+}
+
+/**
+ * Request fields referring to a notebook saved on the server
+ */
+export interface NotebookReference {
+  notebook_path: string;
+  notebook_cells: CellReference[];
+  active_cell_index: number;
 }
 
 interface ErrorInfo {
@@ -44,10 +65,147 @@ export function extractNotebookContent(notebook: Notebook): NotebookContent {
   
   return {
     cells,
-    metadata
+    metadata,
+    active_cell_index: notebook.activeCellIndex
+  };
+}
+
+/**
+ * Hashes of the cells in the saved copy of each notebook, by path
+ */
+const savedCellHashes = new Map<string, Set<string>>();
+
+function joinText(value: any): string {
+  return Array.isArray(value) ? value.join('') : (value || '');
+}
+
+/**
+ * Reduce a cell to the fields used in the prompt, dropping rich outputs
+ * such as images that never reach the LLM
+ */
+function compactCell(cell: ICellModel): CompactCell {
+  const compact: CompactCell = {
+    cell_type: cell.type,
+    source: cell.value.text
+  };
+  
+  if (cell.type === 'code') {
+    const outputs: any[] = (cell as any).outputs?.toJSON() || [];
+    compact.outputs = outputs.map(output => {
+      const result: any = { output_type: output.output_type || '' };
+      if ('text' in output) {
+        result.text = joinText(output.text);
+      }
+      if (output.data && 'text/plain' in output.data) {
+        result.data = { 'text/plain': joinText(output.data['text/plain']) };
+      }
+      if ('traceback' in output) {
+        result.traceback = output.traceback;
+        result.ename = output.ename || '';
+        result.evalue = output.evalue || '';
+      }
+      return result;
+    });
+  }
+  
+  return compact;
+}
+
+/**
+ * Hash the prompt-relevant content of a cell
+ *
+ * Must stay in sync with `cell_hash` in the server extension's notebook.py.
+ */
+async function cellHash(cell: CompactCell): Promise<string> {
+  const payload = JSON.stringify([
+    cell.cell_type,
+    cell.source,
+    (cell.outputs || []).map(output => [
+      output.output_type || '',
+      joinText(output.text),
+      joinText(output.data?.['text/plain']),
+      output.traceback || []
+    ])
+  ]);
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(payload));
+  return Array.from(new Uint8Array(digest))
+    .map(byte => byte.toString(16).padStart(2, '0'))
+    .join('')
+    .slice(0, 32);
+}
+
+/**
+ * Reference a notebook by path, sending content only for cells that differ
+ * from the saved copy
+ *
+ * Returns null when hashing is unavailable (insecure contexts), in which case
+ * the full content has to be sent.
+ */
+export async function extractNotebookReference(
+  panel: NotebookPanel,
+  forceContent: Set<string> = new Set()
+): Promise<NotebookReference | null> {
+  if (!window.crypto?.subtle) {
+    return null;
+  }
+  
+  const path = panel.context.path;
+  const model = panel.content.model!;
+  const cells: CompactCell[] = [];
+  for (let i = 0; i < model.cells.length; i++) {
+    cells.push(compactCell(model.cells.get(i)));
+  }
+  const hashes = await Promise.all(cells.map(cellHash));
+  
+  // A clean notebook matches the saved copy
+  if (!panel.context.model.dirty) {
+    savedCellHashes.set(path, new Set(hashes));
+  }
+  const saved = savedCellHashes.get(path) || new Set<string>();
+  
+  return {
+    notebook_path: path,
+    notebook_cells: cells.map((cell, i) =>
+      saved.has(hashes[i]) && !forceContent.has(hashes[i])
+        ? { hash: hashes[i] }
+        : { hash: hashes[i], ...cell }
+    ),
+    active_cell_index: panel.content.activeCellIndex
   };
 }
 
+/**
+ * Send a request with the notebook as context, by reference when possible
+ *
+ * If the server reports cells missing from the saved copy, the request is
+ * repeated once with their content.
+ */
+export async function withNotebookContext<T>(
+  panel: NotebookPanel | null,
+  send: (notebookFields: any) => Promise<T>
+): Promise<T> {
+  if (!panel) {
+    return send({ notebook_content: {} });
+  }
+  
+  const reference = await extractNotebookReference(panel);
+  if (!reference) {
+    return send({ notebook_content: extractNotebookContent(panel.content) });
+  }
+  
+  try {
+    return await send(reference);
+  } catch (error) {
+    if (error instanceof APIError && error.status === 409) {
+      const missing = new Set<string>(error.data.missing_cells || []);
+      const saved = savedCellHashes.get(reference.notebook_path);
+      missing.forEach(hash => saved?.delete(hash));
+      return send(await extractNotebookReference(panel, missing));
+    }
+    throw error;
+  }
+}
+
 /**
  * Extract errors from notebook cell outputs
  */
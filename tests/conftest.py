@@ -0,0 +1,102 @@
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Keep the on-disk caches and stores of the tests apart from the user's
+os.environ.setdefault("AI_ASSISTANT_CACHE_DIR", tempfile.mkdtemp(prefix="ai-assistant-tests-"))
+
+import pytest
+
+from jupyterlab_ai_assistant import service
+from jupyterlab_ai_assistant.admission import AdmissionController
+from jupyterlab_ai_assistant.cache import get_response_cache
+from jupyterlab_ai_assistant.circuit import circuit_breaker
+from jupyterlab_ai_assistant.llm import clear_llm_instances, get_llm_instance, provider_registry
+from jupyterlab_ai_assistant.llm.base import BaseLLM
+from jupyterlab_ai_assistant.similar import similar_fixes
+
+
+class FakeLLM(BaseLLM):
+    """Provider answering from a script, without network access"""
+
+    llm_type = "fake"
+    provider_name = "Fake"
+    default_model = "fake-model"
+
+    def __init__(self, model: Optional[str] = None):
+        super().__init__(model)
+        # Text of each answer, streamed in ``chunks`` if set
+        self.reply = "fixed = 1"
+        self.chunks: Optional[List[str]] = None
+        # Seconds before each answer or chunk
+        self.delay = 0.0
+        # Errors raised by the next calls, one per call
+        self.failures: List[Exception] = []
+        # Set by the test to hold calls until it is set
+        self.release: Optional[threading.Event] = None
+        self.calls = 0
+        self.closed = threading.Event()
+        self._lock = threading.Lock()
+
+    def _begin(self) -> None:
+        """Count a call and raise its scripted failure, if any"""
+        with self._lock:
+            self.calls += 1
+            failure = self.failures.pop(0) if self.failures else None
+        if failure is not None:
+            raise failure
+        if self.release is not None:
+            self.release.wait(5)
+
+    def _complete(self, system: str, messages: List[Dict[str, Any]], max_tokens: int) -> Dict[str, Any]:
+        self._begin()
+        time.sleep(self.delay)
+        return {"content": self.reply}
+
+    def _stream(self, system: str, messages: List[Dict[str, Any]], max_tokens: int):
+        try:
+            self._begin()
+            for chunk in self.chunks or [self.reply]:
+                time.sleep(self.delay)
+                yield {"content": chunk}
+        finally:
+            self.closed.set()
+
+    def get_config(self) -> Dict[str, Any]:
+        return {"llm_type": self.llm_type, "name": self.provider_name, "model": self.model,
+                "default_model": self.default_model, "models": [{"id": "fake-model", "name": "Fake"}]}
+
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    """Poll a condition until it holds or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def fake_llm() -> FakeLLM:
+    """The shared instance of the fake provider, with empty caches and closed breakers"""
+    provider_registry.register("fake", FakeLLM, "fake-model")
+    clear_llm_instances()
+    get_response_cache().clear()
+    similar_fixes.clear()
+    circuit_breaker._breakers.clear()
+    llm = get_llm_instance("fake")
+    yield llm
+    if llm.release is not None:
+        llm.release.set()
+    clear_llm_instances()
+
+
+@pytest.fixture
+def admission(monkeypatch) -> AdmissionController:
+    """A fresh admission controller used by ``service``, one slot per provider"""
+    controller = AdmissionController(limits={}, default_limit=1, queue_size=8, user_queue_size=4, timeout=5)
+    monkeypatch.setattr(service, "admission", controller)
+    return controller
@@ -0,0 +1,194 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import wait_until
+from jupyterlab_ai_assistant import service
+from jupyterlab_ai_assistant.admission import (PRIORITY_BATCH, PRIORITY_CHAT, PRIORITY_FIX, PRIORITY_SPECULATIVE,
+                                               AdmissionController, AdmissionRejected)
+from jupyterlab_ai_assistant.llm import base
+
+
+def _controller(**kwargs) -> AdmissionController:
+    options = {"limits": {}, "default_limit": 1, "queue_size": 8, "user_queue_size": 8, "timeout": 5}
+    return AdmissionController(**{**options, **kwargs})
+
+
+async def _grant_order(controller: AdmissionController, requests):
+    """Queue ``(user, priority)`` requests behind a held slot in order, and return the order they are served in"""
+    served = []
+
+    async def request(name, user, priority):
+        async with controller.aadmit("p", user, priority):
+            served.append(name)
+
+    async with controller.aadmit("p", "holder", PRIORITY_CHAT):
+        tasks = []
+        for name, user, priority in requests:
+            tasks.append(asyncio.ensure_future(request(name, user, priority)))
+            # Let it join the queue before the next one
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return served
+
+
+def test_limit_holds_requests_until_a_slot_is_released():
+    controller = _controller(default_limit=2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def call():
+        with controller.admit("p", "user", PRIORITY_CHAT):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+
+    with ThreadPoolExecutor(6) as pool:
+        list(pool.map(lambda _: call(), range(6)))
+    assert max(peak) == 2
+
+
+def test_higher_priority_is_served_first():
+    served = asyncio.run(_grant_order(_controller(), [
+        ("batch", "a", PRIORITY_BATCH),
+        ("chat", "b", PRIORITY_CHAT),
+        ("fix", "c", PRIORITY_FIX),
+    ]))
+    assert served == ["fix", "chat", "batch"]
+
+
+def test_users_take_turns_within_a_priority():
+    # One user queues a burst, another user arriving later is served second
+    served = asyncio.run(_grant_order(_controller(), [
+        ("a1", "a", PRIORITY_CHAT),
+        ("a2", "a", PRIORITY_CHAT),
+        ("a3", "a", PRIORITY_CHAT),
+        ("b1", "b", PRIORITY_CHAT),
+    ]))
+    assert served.index("b1") < served.index("a2")
+
+
+def test_users_are_forgotten_once_idle():
+    controller = _controller(timeout=0.05)
+    asyncio.run(_grant_order(controller, [("a1", "a", PRIORITY_CHAT), ("b1", "b", PRIORITY_CHAT)]))
+    with controller.admit("p", "a", PRIORITY_CHAT):
+        with pytest.raises(AdmissionRejected):
+            with controller.admit("p", "c", PRIORITY_CHAT):
+                pass
+    assert not controller._user_active and not controller._user_granted
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    controller = _controller(queue_size=1)
+
+    async def scenario():
+        async with controller.aadmit("p", "a", PRIORITY_CHAT):
+            waiting = asyncio.ensure_future(controller.aadmit("p", "b", PRIORITY_CHAT).__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as rejected:
+                async with controller.aadmit("p", "c", PRIORITY_CHAT):
+                    pass
+            waiting.cancel()
+        return rejected.value
+
+    rejection = asyncio.run(scenario())
+    assert rejection.retry_after >= 1
+
+
+def test_user_queue_limit_leaves_room_for_others():
+    controller = _controller(user_queue_size=1)
+
+    async def scenario():
+        async with controller.aadmit("p", "a", PRIORITY_CHAT):
+            first = asyncio.ensure_future(controller.aadmit("p", "a", PRIORITY_CHAT).__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected):
+                async with controller.aadmit("p", "a", PRIORITY_CHAT):
+                    pass
+            other = asyncio.ensure_future(controller.aadmit("p", "b", PRIORITY_CHAT).__aenter__())
+            await asyncio.sleep(0)
+            assert not other.done()
+            first.cancel()
+            other.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_wait_times_out():
+    controller = _controller(timeout=0.05)
+    with controller.admit("p", "a", PRIORITY_CHAT):
+        with pytest.raises(AdmissionRejected, match="Timed out"):
+            with controller.admit("p", "b", PRIORITY_CHAT):
+                pass
+    # The timed out request left the queue, so the slot is free again
+    with controller.admit("p", "b", PRIORITY_CHAT):
+        pass
+
+
+def test_speculative_work_never_waits():
+    controller = _controller()
+    with controller.admit("p", "a", PRIORITY_CHAT):
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected):
+            with controller.admit("p", "a", PRIORITY_SPECULATIVE):
+                pass
+        assert time.monotonic() - started < 1
+
+
+def test_cancelled_wait_gives_its_slot_back():
+    controller = _controller()
+
+    async def scenario():
+        async with controller.aadmit("p", "a", PRIORITY_CHAT):
+            waiting = asyncio.ensure_future(controller.aadmit("p", "b", PRIORITY_CHAT).__aenter__())
+            await asyncio.sleep(0)
+            waiting.cancel()
+        async with controller.aadmit("p", "c", PRIORITY_CHAT):
+            pass
+
+    asyncio.run(asyncio.wait_for(scenario(), 2))
+
+
+def test_batch_fixes_do_not_starve_admitted_calls(fake_llm, admission, monkeypatch):
+    # A single executor thread: if queued batch fixes waited for admission in
+    # it, the admitted call below could not run until they timed out
+    monkeypatch.setattr(base, "_executor", ThreadPoolExecutor(1))
+    items = [{"cell_index": index, "code": f"x{index} = ", "errors": [{"message": "SyntaxError"}]}
+             for index in range(2)]
+
+    async def scenario():
+        async with admission.aadmit("fake", "a", PRIORITY_CHAT):
+            batch = threading.Thread(target=lambda: list(service.fix_errors_batch("fake", None, items, False)))
+            batch.start()
+            assert wait_until(lambda: len(admission._waiters.get("fake", ())) == 2)
+            started = time.monotonic()
+            await fake_llm._acomplete("", [{"role": "user", "content": "hi"}], 10)
+            elapsed = time.monotonic() - started
+        await asyncio.get_running_loop().run_in_executor(None, batch.join)
+        return elapsed
+
+    assert asyncio.run(scenario()) < 1
+
+
+def test_rejected_request_is_answered_with_429(fake_llm, monkeypatch):
+    import main
+    from src.jupyterlab_ai_assistant import service as flask_service
+    from src.jupyterlab_ai_assistant.admission import AdmissionController as FlaskAdmissionController
+    from src.jupyterlab_ai_assistant.llm import provider_registry as flask_registry
+
+    flask_registry.register("fake", type(fake_llm), "fake-model")
+    monkeypatch.setattr(flask_service, "admission",
+                        FlaskAdmissionController(limits={}, default_limit=0, queue_size=0))
+    response = main.app.test_client().post("/ai-assistant/llm", json={
+        "llm_type": "fake", "prompt": "rejected?", "fallback": [], "no_cache": True
+    })
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["retry_after"] >= 1
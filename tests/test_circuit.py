@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from jupyterlab_ai_assistant.circuit import CircuitBreaker, circuit_breaker
+
+KEY = ("fake", "fake-model")
+ERRORS = [{"message": "SyntaxError"}]
+
+
+class Unauthorized(Exception):
+    """Provider error that is not retried but counts as a provider failure"""
+
+    status_code = 401
+
+
+@pytest.fixture
+def breaker(fake_llm, monkeypatch):
+    """The process-wide breakers, opening after one failure for a short cooldown"""
+    monkeypatch.setattr(circuit_breaker, "failures", 1)
+    monkeypatch.setattr(circuit_breaker, "cooldown", 0.3)
+    return circuit_breaker
+
+
+def _open_until_half_open(fake_llm, breaker):
+    fake_llm.failures = [Unauthorized("bad key")]
+    assert fake_llm.fix_errors_response("x = ", ERRORS)["error"]
+    assert breaker.state(KEY) == "open"
+    time.sleep(breaker.cooldown + 0.05)
+    assert breaker.state(KEY) == "half-open"
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(failures=2, cooldown=0.05)
+    breaker.record_failure("p")
+    assert breaker.allow("p")
+    breaker.record_failure("p")
+    assert breaker.state("p") == "open" and not breaker.allow("p")
+
+    time.sleep(0.06)
+    assert breaker.state("p") == "half-open"
+    assert breaker.allow("p")
+    # Only one probe at a time
+    assert not breaker.allow("p")
+    breaker.record_success("p")
+    assert breaker.state("p") == "closed" and breaker.allow("p")
+
+
+def test_failed_probe_opens_the_breaker_again():
+    breaker = CircuitBreaker(failures=1, cooldown=0.05)
+    breaker.record_failure("p")
+    time.sleep(0.06)
+    assert breaker.allow("p")
+    breaker.record_failure("p")
+    assert breaker.state("p") == "open"
+
+
+def test_open_breaker_fails_requests_at_once_until_a_probe_succeeds(fake_llm, breaker):
+    _open_until_half_open(fake_llm, breaker)
+    fake_llm.fix_errors_response("x = ", ERRORS)
+    assert breaker.state(KEY) == "closed"
+
+    fake_llm.failures = [Unauthorized("bad key")]
+    fake_llm.fix_errors_response("x = ", ERRORS)
+    calls = fake_llm.calls
+    result = fake_llm.fix_errors_response("x = ", ERRORS)
+    assert result["error"] and "paused" in result["fixed_code"]
+    assert fake_llm.calls == calls
+
+
+def test_probe_closed_by_its_consumer_gives_the_slot_back(fake_llm, breaker):
+    _open_until_half_open(fake_llm, breaker)
+    fake_llm.chunks = ["a", "b"]
+    events = fake_llm.stream_fix_errors("x = ", ERRORS)
+    assert next(events)["type"] == "delta"
+    events.close()
+    # The next request probes at once instead of waiting for another cooldown
+    assert not breaker.is_open(KEY)
+    assert not fake_llm.fix_errors_response("x = ", ERRORS).get("error")
+    assert breaker.state(KEY) == "closed"
+
+
+def test_request_failing_to_build_does_not_take_the_probe(fake_llm, breaker, monkeypatch):
+    _open_until_half_open(fake_llm, breaker)
+
+    def broken_request(code, errors):
+        raise ValueError("cannot build the prompt")
+
+    monkeypatch.setattr(fake_llm, "_fix_request", broken_request)
+    with pytest.raises(ValueError):
+        fake_llm.fix_errors_response("x = ", ERRORS)
+    assert not breaker.is_open(KEY)
@@ -0,0 +1,23 @@
+from jupyterlab_ai_assistant.llm.context import build_chat_context, clear_render_cache
+from jupyterlab_ai_assistant.notebook import resolve_notebook_cells
+
+
+def _cell(source, **extra):
+    return {"cell_type": "code", "source": source, "outputs": [], **extra}
+
+
+def test_hash_sent_by_the_client_is_not_trusted():
+    clear_render_cache()
+    first = {"cells": [_cell("first = 1", hash="same")]}
+    second = {"cells": [_cell("second = 2", hash="same")]}
+    assert "first = 1" in build_chat_context(first, [], "gpt-4o", 0)[0]
+    text = build_chat_context(second, [], "gpt-4o", 0)[0]
+    assert "second = 2" in text and "first = 1" not in text
+
+
+def test_resolved_cells_keep_the_server_hash():
+    saved = {}
+    notebook, missing = resolve_notebook_cells(saved, [_cell("x = 1", hash="forged")])
+    assert not missing
+    assert notebook["cells"][0]["hash"] != "forged"
+    assert "x = 1" in build_chat_context(notebook, [], "gpt-4o", 0)[0]
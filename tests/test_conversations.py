@@ -0,0 +1,90 @@
+import uuid
+
+import pytest
+
+from conftest import wait_until
+from jupyterlab_ai_assistant import service
+from jupyterlab_ai_assistant.codec import BodyError
+from jupyterlab_ai_assistant.conversations import (ConversationStore, append_turn, fold_count,
+                                                   get_conversation_store, new_conversation, prompt_history,
+                                                   request_max_history)
+
+
+def _conversation(turns: int):
+    conversation = new_conversation([])
+    for index in range(turns):
+        conversation = append_turn(conversation, f"question {index}", f"answer {index}")
+    return conversation
+
+
+def test_short_conversation_is_not_folded():
+    assert fold_count(_conversation(2), max_history=4) == 0
+
+
+def test_long_conversation_folds_down_to_half_from_a_user_turn():
+    conversation = _conversation(5)
+    count = fold_count(conversation, max_history=4)
+    remaining = conversation["messages"][count:]
+    assert len(remaining) <= 2
+    assert remaining[0]["role"] == "user"
+
+
+def test_history_starts_with_the_summary():
+    conversation = {**_conversation(3), "summary": "We talked about pandas."}
+    history = prompt_history(conversation, max_history=2)
+    assert "We talked about pandas." in history[0]["content"]
+    assert [msg["content"] for msg in history[2:]] == ["question 2", "answer 2"]
+
+
+@pytest.mark.parametrize("value", ["5", -1, 2.5, True])
+def test_invalid_max_history_is_a_bad_request(value):
+    with pytest.raises(BodyError) as e:
+        request_max_history({"max_history": value})
+    assert e.value.status == 400
+
+
+def test_max_history_is_optional():
+    assert request_max_history({}) is None
+    assert request_max_history({"max_history": 0}) == 0
+
+
+def test_stores_sharing_a_database_apply_turns_in_turn(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    first, second = ConversationStore(path), ConversationStore(path)
+    first.update("user", "c", lambda current: append_turn(current, "q1", "a1"))
+    second.update("user", "c", lambda current: append_turn(current, "q2", "a2"))
+    # The first store's cached copy is out of date, and must not overwrite the second turn
+    first.update("user", "c", lambda current: append_turn(current, "q3", "a3"))
+    contents = [msg["content"] for msg in second.get("user", "c")["messages"]]
+    assert contents == ["q1", "a1", "q2", "a2", "q3", "a3"]
+    assert first.get("other user", "c") is None
+
+
+def test_recorded_turns_are_folded_into_a_summary(fake_llm):
+    conversation_id = str(uuid.uuid4())
+    fake_llm.reply = "They asked five questions."
+    for index in range(5):
+        service.record_turn("fake", None, "user", conversation_id, f"question {index}",
+                            {"content": f"answer {index}"}, max_history=4)
+
+    store = get_conversation_store()
+    assert wait_until(lambda: store.get("user", conversation_id)["summary"] == fake_llm.reply)
+    conversation = store.get("user", conversation_id)
+    assert conversation["start"] + len(conversation["messages"]) == 10
+    assert conversation["messages"][-1]["content"] == "answer 4"
+    history = service.conversation_history("user", conversation_id, None, max_history=4)
+    assert fake_llm.reply in history[0]["content"]
+
+
+def test_failed_summary_keeps_the_turns(fake_llm):
+    conversation_id = str(uuid.uuid4())
+    fake_llm.failures = [ValueError("no summary")]
+    # Compaction is due from the third turn on
+    for index in range(3):
+        service.record_turn("fake", None, "user", conversation_id, f"question {index}",
+                            {"content": f"answer {index}"}, max_history=4)
+
+    assert wait_until(lambda: fake_llm.calls == 1 and ("user", conversation_id) not in service._compacting)
+    conversation = get_conversation_store().get("user", conversation_id)
+    assert conversation["summary"] == "" and conversation["start"] == 0
+    assert len(conversation["messages"]) == 6
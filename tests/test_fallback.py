@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from conftest import FakeLLM
+from jupyterlab_ai_assistant import fallback, service
+from jupyterlab_ai_assistant.codec import BodyError
+from jupyterlab_ai_assistant.fallback import race_stages, request_deadline, run_with_fallback
+from jupyterlab_ai_assistant.llm import get_llm_instance, provider_registry
+
+CHAIN = [("fake", None), ("backup", None)]
+
+
+class BackupLLM(FakeLLM):
+    """Second fake provider to fall back to"""
+
+    llm_type = "backup"
+    provider_name = "Backup"
+    default_model = "backup-model"
+
+
+@pytest.fixture
+def backup_llm(fake_llm) -> BackupLLM:
+    provider_registry.register("backup", BackupLLM, "backup-model")
+    llm = get_llm_instance("backup")
+    llm.reply = "backup = 1"
+    return llm
+
+
+def _start_stream(stage_type, stage_model):
+    return service.stream_fix_errors(stage_type, stage_model, "x = ", [{"message": "SyntaxError"}], False)
+
+
+def test_failed_stage_falls_back(fake_llm, backup_llm):
+    fake_llm.failures = [RuntimeError("down")]
+    stage, result = run_with_fallback(CHAIN, _start_stream)
+    assert stage == ("backup", None)
+    assert result["fixed_code"] == "backup = 1"
+
+
+def test_slow_stage_is_hedged_and_its_stream_closed(fake_llm, backup_llm):
+    # The first chunk takes longer than the requested LLM's share of the deadline
+    fake_llm.chunks = ["slow = 1", " + 1"]
+    fake_llm.delay = 0.5
+    started = time.monotonic()
+    stage, result = run_with_fallback(CHAIN, _start_stream, deadline=0.6, hedge_percentile=None)
+    assert stage == ("backup", None)
+    # The loser is aborted at its first chunk instead of streaming to the end
+    assert fake_llm.closed.wait(2)
+    assert time.monotonic() - started < 2 * fake_llm.delay
+
+
+def test_deadline_gives_up_and_cancels_every_stage(fake_llm, backup_llm):
+    fake_llm.delay = backup_llm.delay = 0.3
+    fake_llm.chunks = backup_llm.chunks = ["a", "b", "c"]
+    started = time.monotonic()
+    assert run_with_fallback(CHAIN, _start_stream, deadline=0.2, hedge_percentile=None) == (None, None)
+    assert time.monotonic() - started < 0.3
+    assert fake_llm.closed.wait(2)
+    assert backup_llm.closed.wait(2)
+
+
+def test_stream_passes_on_the_events_of_the_winner(fake_llm, backup_llm):
+    fake_llm.failures = [RuntimeError("down")]
+    backup_llm.chunks = ["backup", " = 1"]
+    events = list(race_stages(CHAIN, _start_stream))
+    assert {stage for stage, _ in events} == {("backup", None)}
+    assert [event["content"] for _, event in events if event["type"] == "delta"] == ["backup", " = 1"]
+    assert events[-1][1]["type"] == "done"
+
+
+def test_every_stage_failing_reports_the_first_failure(fake_llm, backup_llm):
+    fake_llm.failures = [RuntimeError("down")]
+    backup_llm.failures = [RuntimeError("also down")]
+    stage, result = run_with_fallback(CHAIN, _start_stream)
+    assert stage == ("fake", None)
+    assert "down" in result["fixed_code"] and result["error"]
+
+
+@pytest.mark.parametrize("deadline_ms", ["soon", -5, 0, True, [1], float("nan")])
+def test_invalid_deadline_is_rejected(deadline_ms):
+    with pytest.raises(BodyError):
+        request_deadline({"deadline_ms": deadline_ms})
+
+
+def test_deadline_is_clamped(monkeypatch):
+    monkeypatch.setattr(fallback, "MAX_DEADLINE", 60.0)
+    assert request_deadline({"deadline_ms": 1500}) == 1.5
+    assert request_deadline({"deadline_ms": "10e9"}) == 60.0
+
+
+def test_invalid_deadline_is_answered_with_400():
+    import main
+
+    response = main.app.test_client().post("/ai-assistant/fix-error", json={
+        "llm_type": "fake", "code": "x = ", "errors": [], "deadline_ms": "soon"
+    })
+    assert response.status_code == 400
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from google.generativeai import protos
+from google.generativeai.types.generation_types import GenerateContentResponse
+
+from jupyterlab_ai_assistant.llm.gemini import GeminiLLM
+
+
+class _Call:
+    """Stand-in for the streaming call the SDK reads its chunks from, recording whether it was cancelled"""
+
+    def __init__(self, texts):
+        self.chunks = iter([
+            protos.GenerateContentResponse(candidates=[{"content": {"parts": [{"text": text}], "role": "model"}}])
+            for text in texts
+        ])
+        self.cancelled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def _llm(call):
+    llm = GeminiLLM()
+    generate = lambda contents, stream: GenerateContentResponse.from_iterator(call)
+    llm.gemini = SimpleNamespace(generate_content=generate)
+    return llm
+
+
+def test_stream_is_cancelled_when_the_consumer_stops_early():
+    call = _Call(["a", "b", "c"])
+    chunks = _llm(call)._stream("system", [{"role": "user", "content": "hi"}], 10)
+    assert next(chunks) == {"content": "a"}
+    chunks.close()
+    assert call.cancelled
+
+
+def test_finished_stream_is_not_cancelled():
+    call = _Call(["a", "b"])
+    chunks = list(_llm(call)._stream("system", [{"role": "user", "content": "hi"}], 10))
+    assert [chunk["content"] for chunk in chunks[:2]] == ["a", "b"]
+    assert not call.cancelled
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from conftest import wait_until
+from jupyterlab_ai_assistant import jobs
+from jupyterlab_ai_assistant.jobs import CANCELLED, DONE, JobLimitExceeded, JobManager
+
+
+def _script(texts, gate=None, closed=None):
+    """Start function of a job streaming ``texts``, waiting for ``gate`` before each one"""
+
+    def start():
+        try:
+            for text in texts:
+                if gate is not None:
+                    gate.wait(5)
+                yield {"type": "delta", "content": text}
+            yield {"type": "done", "content": "".join(texts)}
+        finally:
+            if closed is not None:
+                closed.set()
+
+    return start
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return JobManager(str(tmp_path / "jobs.sqlite3"), workers=2)
+
+
+def test_poll_returns_the_output_past_the_offset(manager):
+    job = manager.submit("user", "chat", _script(["ab", "cd"]))
+    snapshot = manager.wait("user", job["job_id"], 4, timeout=5)
+    assert snapshot["status"] == DONE
+
+    snapshot = manager.get("user", job["job_id"], offset=2)
+    assert snapshot["content"] == "cd" and snapshot["offset"] == 4
+    assert snapshot["result"] == {"content": "abcd"}
+    assert list(manager.events("user", job["job_id"], offset=2)) == [
+        {"type": "delta", "content": "cd"},
+        {"type": "done", "content": "abcd"}
+    ]
+
+
+def test_jobs_are_private_and_limited_per_user(manager):
+    gate = threading.Event()
+    manager.user_jobs = 1
+    job = manager.submit("user", "chat", _script(["a"], gate))
+    try:
+        assert manager.get("someone else", job["job_id"]) is None
+        assert manager.cancel("someone else", job["job_id"]) is None
+        with pytest.raises(JobLimitExceeded):
+            manager.submit("user", "chat", _script(["b"]))
+    finally:
+        gate.set()
+
+
+def test_cancel_stops_a_running_job_and_keeps_its_output(manager):
+    gate = threading.Event()
+    closed = threading.Event()
+
+    def start():
+        try:
+            yield {"type": "delta", "content": "a"}
+            gate.wait(5)
+            yield {"type": "delta", "content": "b"}
+            yield {"type": "done", "content": "ab"}
+        finally:
+            closed.set()
+
+    job = manager.submit("user", "chat", start)
+    assert manager.wait("user", job["job_id"], timeout=5)["content"] == "a"
+    manager.cancel("user", job["job_id"])
+    gate.set()
+    assert closed.wait(5)
+    assert wait_until(lambda: manager.get("user", job["job_id"])["status"] == CANCELLED)
+    snapshot = manager.get("user", job["job_id"])
+    assert snapshot["content"] == "a" and snapshot["result"] is None
+
+
+def test_cancel_of_a_queued_job_never_starts_it(tmp_path):
+    manager = JobManager(str(tmp_path / "jobs.sqlite3"), workers=1)
+    gate = threading.Event()
+    started = threading.Event()
+
+    def start():
+        started.set()
+        yield {"type": "done", "content": ""}
+
+    manager.submit("user", "chat", _script(["a"], gate))
+    queued = manager.submit("user", "chat", start)
+    assert manager.cancel("user", queued["job_id"])["status"] == CANCELLED
+    gate.set()
+    time.sleep(0.1)
+    assert not started.is_set()
+
+
+def test_cancel_from_another_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "_FLUSH_SECONDS", 0)
+    path = str(tmp_path / "jobs.sqlite3")
+    runner, other = JobManager(path), JobManager(path)
+    gate = threading.Event()
+    closed = threading.Event()
+    job = runner.submit("user", "chat", _script(["a", "b", "c"], gate, closed))
+    assert wait_until(lambda: other.get("user", job["job_id"])["status"] == "running")
+
+    other.cancel("user", job["job_id"])
+    gate.set()
+    assert closed.wait(5)
+    assert wait_until(lambda: runner.get("user", job["job_id"])["status"] == CANCELLED)
+
+
+def test_finished_jobs_expire(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    manager = JobManager(path, ttl=0.2)
+    job = manager.submit("user", "chat", _script(["a"]))
+    assert manager.wait("user", job["job_id"], 1, timeout=5)["status"] == DONE
+    assert JobManager(path).get("user", job["job_id"]) is not None
+
+    time.sleep(0.3)
+    assert manager.get("user", job["job_id"]) is None
+    assert JobManager(path).get("user", job["job_id"]) is None
+    assert list(manager.events("user", job["job_id"]))[-1]["error"]
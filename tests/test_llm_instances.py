@@ -0,0 +1,58 @@
+import threading
+import time
+
+from conftest import FakeLLM
+from jupyterlab_ai_assistant import llm as llm_package
+from jupyterlab_ai_assistant import metrics
+from jupyterlab_ai_assistant.llm import get_llm_instance, provider_registry
+
+
+class SlowLLM(FakeLLM):
+    """Provider whose constructor blocks until the test lets it finish"""
+
+    llm_type = "slow"
+    building = threading.Event()
+    finish = threading.Event()
+
+    def __init__(self, model=None):
+        SlowLLM.building.set()
+        SlowLLM.finish.wait(5)
+        super().__init__(model)
+
+
+def test_instances_are_shared_per_model(fake_llm):
+    assert get_llm_instance("fake") is fake_llm
+    assert get_llm_instance("fake", "other-model") is not fake_llm
+    assert get_llm_instance("fake", "other-model") is get_llm_instance("fake", "other-model")
+
+
+def test_least_recently_used_instances_are_dropped(fake_llm, monkeypatch):
+    monkeypatch.setattr(llm_package, "MAX_LLM_INSTANCES", 3)
+    for index in range(10):
+        get_llm_instance("fake", f"model-{index}")
+        # Used all along, so never the least recently used one
+        assert get_llm_instance("fake") is fake_llm
+    assert len(llm_package._instances) == 3
+
+
+def test_slow_constructor_does_not_hold_up_other_models(fake_llm):
+    provider_registry.register("slow", SlowLLM, "slow-model")
+    SlowLLM.building.clear()
+    SlowLLM.finish.clear()
+    builder = threading.Thread(target=get_llm_instance, args=("slow",))
+    builder.start()
+    try:
+        assert SlowLLM.building.wait(5)
+        started = time.monotonic()
+        get_llm_instance("fake", "not-built-yet")
+        assert time.monotonic() - started < 1
+    finally:
+        SlowLLM.finish.set()
+        builder.join()
+
+
+def test_unlisted_models_share_one_metrics_label(fake_llm):
+    assert metrics.model_label("fake", "fake-model") == "fake-model"
+    assert metrics.model_label("fake", "made-up-by-a-client") == metrics.OTHER_MODEL
+    metrics.list_models("fake", ["listed-later"])
+    assert metrics.model_label("fake", "listed-later") == "listed-later"
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+from jupyterlab_ai_assistant.llm.openai import OpenAILLM
+
+
+class _Stream:
+    """Stand-in for the SDK's Stream, recording whether it was closed"""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.closed = False
+
+    def __iter__(self):
+        for text in self.texts:
+            delta = SimpleNamespace(content=text)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+
+def _llm(stream):
+    llm = OpenAILLM()
+    create = lambda **kwargs: stream
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return llm
+
+
+def test_stream_is_closed_when_the_consumer_stops_early():
+    stream = _Stream(["a", "b", "c"])
+    chunks = _llm(stream)._stream("system", [{"role": "user", "content": "hi"}], 10)
+    assert next(chunks) == {"content": "a"}
+    chunks.close()
+    assert stream.closed
+
+
+def test_stream_is_closed_after_the_last_chunk():
+    stream = _Stream(["a", "b"])
+    chunks = list(_llm(stream)._stream("system", [{"role": "user", "content": "hi"}], 10))
+    assert chunks == [{"content": "a"}, {"content": "b"}]
+    assert stream.closed
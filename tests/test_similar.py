@@ -0,0 +1,62 @@
+from jupyterlab_ai_assistant import metrics, service
+
+CELL = "import pandas as pd\ndf = pd.read_csv('sales.csv')\ntotal = df['amount'].sum()\nprint(totl)\n"
+FIXED = "import pandas as pd\ndf = pd.read_csv('sales.csv')\ntotal = df['amount'].sum()\nprint(total)\n"
+ERRORS = [{"message": "NameError: name 'totl' is not defined"}]
+
+# The same cell with other names, as another student would write it
+SIMILAR_CELL = "import pandas as pd\ndata = pd.read_csv('orders.csv')\nrevenue = data['price'].sum()\nprint(revenu)\n"
+SIMILAR_ERRORS = [{"message": "NameError: name 'revenu' is not defined"}]
+
+
+def _similar_fixes() -> float:
+    value = metrics.REGISTRY.get_sample_value("ai_assistant_similar_fixes_total",
+                                              {"provider": "fake", "model": "fake-model", "endpoint": "fix"})
+    return value or 0.0
+
+
+def _learn(fake_llm):
+    fake_llm.reply = FIXED
+    assert service.fix_errors_response("fake", None, CELL, ERRORS)["fixed_code"] == FIXED.strip()
+    assert fake_llm.calls == 1
+
+
+def test_similar_cell_gets_the_remapped_fix(fake_llm):
+    _learn(fake_llm)
+    result = service.fix_errors_response("fake", None, SIMILAR_CELL, SIMILAR_ERRORS)
+    assert result["similar"] and result["cached"]
+    assert result["fixed_code"] == SIMILAR_CELL.replace("print(revenu)", "print(revenue)").strip()
+    assert fake_llm.calls == 1
+
+
+def test_repeated_similar_cell_counts_as_a_plain_cache_hit(fake_llm):
+    _learn(fake_llm)
+    before = _similar_fixes()
+    service.fix_errors_response("fake", None, SIMILAR_CELL, SIMILAR_ERRORS)
+    again = service.fix_errors_response("fake", None, SIMILAR_CELL, SIMILAR_ERRORS)
+    assert again["cached"] and not again.get("similar")
+    assert _similar_fixes() == before + 1
+
+
+def test_stream_of_similar_cell_replays_the_remapped_fix(fake_llm):
+    _learn(fake_llm)
+    events = list(service.stream_fix_errors("fake", None, SIMILAR_CELL, SIMILAR_ERRORS))
+    assert events[-1]["similar"] and "print(revenue)" in events[-1]["fixed_code"]
+    assert fake_llm.calls == 1
+
+
+def test_error_about_another_name_is_not_remapped(fake_llm):
+    _learn(fake_llm)
+    # Same cell, but the error is about another name than the one the remembered fix corrected
+    errors = [{"message": "NameError: name 'data' is not defined"}]
+    result = service.fix_errors_response("fake", None, SIMILAR_CELL, errors)
+    assert not result.get("similar")
+    assert fake_llm.calls == 2
+
+
+def test_different_cell_is_sent_to_the_provider(fake_llm):
+    _learn(fake_llm)
+    cell = "for row in rows:\n    print(totl)\n"
+    result = service.fix_errors_response("fake", None, cell, ERRORS)
+    assert not result.get("similar")
+    assert fake_llm.calls == 2
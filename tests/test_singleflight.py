@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import wait_until
+from jupyterlab_ai_assistant import service
+from jupyterlab_ai_assistant.singleflight import inflight_calls
+
+ERRORS = [{"message": "SyntaxError"}]
+
+
+def _fix(code="x = "):
+    return service.fix_errors_response("fake", None, code, ERRORS, False)
+
+
+def test_concurrent_identical_requests_share_one_call(fake_llm):
+    fake_llm.release = threading.Event()
+    with ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(_fix)
+        assert wait_until(lambda: fake_llm.calls == 1)
+        followers = [pool.submit(_fix) for _ in range(3)]
+        assert wait_until(lambda: all(f.running() for f in followers))
+        fake_llm.release.set()
+        results = [leader.result(5)] + [f.result(5) for f in followers]
+
+    assert fake_llm.calls == 1
+    assert {result["fixed_code"] for result in results} == {"fixed = 1"}
+    assert not results[0].get("coalesced")
+    assert all(result["coalesced"] for result in results[1:])
+    assert len(inflight_calls) == 0
+
+
+def test_different_requests_are_not_shared(fake_llm):
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(_fix, ["x = ", "y = "]))
+    assert fake_llm.calls == 2
+
+
+def test_async_requests_share_one_call(fake_llm):
+    fake_llm.release = threading.Event()
+
+    async def scenario():
+        requests = [asyncio.ensure_future(service.afix_errors_response("fake", None, "x = ", ERRORS, False))
+                    for _ in range(3)]
+        await asyncio.get_running_loop().run_in_executor(None, wait_until, lambda: fake_llm.calls == 1)
+        fake_llm.release.set()
+        return await asyncio.gather(*requests)
+
+    results = asyncio.run(scenario())
+    assert fake_llm.calls == 1
+    assert sum(1 for result in results if result.get("coalesced")) == 2
+
+
+def test_followers_call_themselves_when_the_leader_gives_up(fake_llm):
+    fake_llm.chunks = ["fixed", " = 1"]
+    leader = service.stream_fix_errors("fake", None, "x = ", ERRORS, False)
+    assert next(leader)["type"] == "delta"
+
+    with ThreadPoolExecutor(1) as pool:
+        follower = pool.submit(_fix)
+        assert wait_until(follower.running)
+        time.sleep(0.1)
+        assert not follower.done()
+        # Closed before its result, so the follower is not given one
+        leader.close()
+        result = follower.result(5)
+
+    assert fake_llm.calls == 2
+    assert result["fixed_code"] == "fixed = 1" and not result.get("coalesced")
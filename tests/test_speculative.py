@@ -0,0 +1,27 @@
+import asyncio
+
+from conftest import wait_until
+from jupyterlab_ai_assistant import service
+from jupyterlab_ai_assistant.admission import PRIORITY_CHAT
+from jupyterlab_ai_assistant.budget import speculative_budget
+
+ERRORS = [{"message": "SyntaxError"}]
+
+
+def test_busy_provider_is_not_speculated_on(fake_llm, admission):
+    user = "busy-user"
+
+    async def scenario():
+        async with admission.aadmit("fake", "someone", PRIORITY_CHAT):
+            return service.speculate_fix("fake", None, "x = ", ERRORS, user)
+
+    assert asyncio.run(scenario()) == "busy"
+    assert speculative_budget.spent(user) == 0
+    assert fake_llm.calls == 0
+
+
+def test_speculative_fix_is_cached_for_the_request(fake_llm, admission):
+    assert service.speculate_fix("fake", None, "x = ", ERRORS, "user") == "started"
+    assert wait_until(lambda: service.speculate_fix("fake", None, "x = ", ERRORS, "user") == "cached")
+    assert service.fix_errors_response("fake", None, "x = ", ERRORS, user="user")["cached"]
+    assert fake_llm.calls == 1